@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs LD50 without the gui and writes the energy deposits to disk
+
+Example:
+--------
+> python LD50_batch.py RAD Proton 10-100 -g Isotrop -n 10000 -o rad.npz
+"""
+import argparse
+
+
+def main(argv=None):
+    decode = lambda arg: arg.decode('utf-8')
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('geometry', type=decode,
+                        help='geometry defined in settings.py, e.g. RAD')
+    parser.add_argument('particle', type=decode,
+                        help='particle name, e.g. Proton')
+    parser.add_argument('energy', type=decode,
+                        help='energy in MeV, "E" or "E1-E2", or a spectrum '
+                             'of src/spectra.py, e.g. "GCR Proton"')
+    parser.add_argument('-g', '--gun', type=decode, default=u'Isotrop',
+                        help='particle source (default: Isotrop)')
+    parser.add_argument('-n', '--primaries', type=int, default=1000,
+                        help='number of primaries (default: 1000)')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='random seed (default: a random one; with -j it '
+                             'is printed and saved in the output)')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('-m', '--map', action='store_true',
+                        help='also store the deposit map')
+    parser.add_argument('-o', '--output', default='ld50.npz',
+                        help='output file (default: ld50.npz)')
+    parser.add_argument('-c', '--checkpoint', metavar='FILE',
+                        help='save the run state to FILE (FILE.<worker> '
+                             'with several workers) and continue from it '
+                             'if it exists')
+    parser.add_argument('--interval', type=float, default=300.,
+                        help='seconds between checkpoints (default: 300)')
+    parser.add_argument('--cut', type=float, metavar='MEV',
+                        help='track secondaries (recoil protons, electrons, '
+                             'delta rays) above this energy instead of '
+                             'depositing them locally')
+    parser.add_argument('--score', type=decode, action='append',
+                        metavar='VOLUME',
+                        help='score this volume, can be given several times '
+                             '(default: all but Background)')
+    parser.add_argument('--range-rejection', action='store_true',
+                        help='stop charged particles that cannot reach a '
+                             'scored volume')
+    parser.add_argument('--variance-reduction', action='store_true',
+                        help='splitting, Russian roulette and forced '
+                             'collisions with the settings of the geometry '
+                             'in settings.VARIANCE_REDUCTION')
+    parser.add_argument('--target-error', type=float, metavar='REL',
+                        help='stop once the relative error of the deposit '
+                             'is below REL (e.g. 0.01) in the target volumes;'
+                             ' -n is the maximum number of primaries then')
+    parser.add_argument('--target-volume', type=decode, action='append',
+                        metavar='VOLUME',
+                        help='volume of --target-error, can be given several '
+                             'times (default: all scored volumes)')
+    parser.add_argument('--time-limit', type=float, metavar='SECONDS',
+                        help='stop after this many seconds (per worker)')
+    parser.add_argument('-r', '--records', metavar='DIR',
+                        help='stream every single deposit to chunked .npy '
+                             'files in DIR (DIR.<worker> with several '
+                             'workers), see src/records.py')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='write the wall time per run phase as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='run with cProfile, write FILE and '
+                             'FILE.collapsed (flamegraph input)')
+    args = parser.parse_args(argv)
+    if args.workers > 1 and (args.stats or args.profile):
+        parser.error("--stats and --profile need a single worker")
+
+    from settings import GEOMETRIES, VARIANCE_REDUCTION
+    from src.simulation import simulate, save_result
+    from src.parallel import simulate_parallel
+    from src.particles import TABLE as p_tbl
+    from src.guns import TABLE as g_tbl
+    if args.geometry not in GEOMETRIES:
+        parser.error("unknown geometry %s, use one of %s" %
+                     (args.geometry, ', '.join(GEOMETRIES.keys())))
+    if args.particle not in p_tbl:
+        parser.error("unknown particle %s, use one of %s" %
+                     (args.particle, ', '.join(p_tbl.keys())))
+    if args.gun not in g_tbl:
+        parser.error("unknown gun %s, use one of %s" %
+                     (args.gun, ', '.join(g_tbl.keys())))
+
+    geometry = GEOMETRIES[args.geometry]
+    unknown = set((args.score or []) + (args.target_volume or [])) - \
+        set(geometry.get_name())
+    if unknown:
+        parser.error("unknown volume %s, use one of %s" %
+                     (', '.join(sorted(unknown)),
+                      ', '.join(geometry.get_name())))
+    scored = args.score or [name for name in geometry.get_name()
+                            if name != 'Background']
+    unscored = set(args.target_volume or []) - set(scored)
+    if unscored:
+        parser.error("target volume %s is not scored, add it with --score" %
+                     ', '.join(sorted(unscored)))
+    variance_reduction = None
+    if args.variance_reduction:
+        if args.geometry not in VARIANCE_REDUCTION:
+            parser.error("no variance reduction settings for %s" %
+                         args.geometry)
+        variance_reduction = VARIANCE_REDUCTION[args.geometry]
+    if args.workers > 1:
+        result = simulate_parallel(geometry, args.particle, args.energy,
+                                   args.gun, args.primaries,
+                                   seed=args.seed,
+                                   n_workers=args.workers,
+                                   deposit_map=args.map,
+                                   checkpoint=args.checkpoint,
+                                   interval=args.interval,
+                                   records=args.records, cut=args.cut,
+                                   scoring=args.score,
+                                   range_rejection=args.range_rejection,
+                                   variance_reduction=variance_reduction,
+                                   target_error=args.target_error,
+                                   target_volumes=args.target_volume,
+                                   time_limit=args.time_limit)
+    else:
+        from src.stats import RunStats, profile
+        stats = RunStats() if args.stats else None
+        run = (simulate, geometry, args.particle, args.energy, args.gun,
+               args.primaries)
+        options = dict(seed=args.seed, deposit_map=args.map, stats=stats,
+                       checkpoint=args.checkpoint, interval=args.interval,
+                       records=args.records, cut=args.cut,
+                       scoring=args.score,
+                       range_rejection=args.range_rejection,
+                       variance_reduction=variance_reduction,
+                       target_error=args.target_error,
+                       target_volumes=args.target_volume,
+                       time_limit=args.time_limit)
+        if args.profile:
+            result = profile(args.profile, *run, **options)
+        else:
+            result = run[0](*run[1:], **options)
+        if stats:
+            stats.dump(args.stats)
+    save_result(args.output, result)
+    print '%d primaries' % result['n_primaries']
+    if 'seed' in result:
+        print 'seed %d' % result['seed']
+    for name, edep, error, dose, dose_equivalent in zip(
+            result['names'], result['edep'], result['edep_error'],
+            result['dose'], result['dose_equivalent']):
+        print (u"%-20s %12g \xb1 %-9.2g MeV %12g Gy %12g Sv" % (
+            name, edep, error, dose, dose_equivalent)).encode('utf-8')
+
+if __name__ == '__main__':
+    main()
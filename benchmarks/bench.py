@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Times the transport hot paths and checks fixed seed physics results
+
+Every benchmark runs in a forked process of its own, so its peak memory
+(maximum resident set size) is not hidden by earlier benchmarks. The
+timings are compared with a JSON baseline of the same machine and slower
+results are flagged as regressions. The physics checks compare fixed seed
+results with benchmarks/physics_reference.json and with reference data,
+so that a speedup cannot change the results unnoticed.
+
+Example:
+--------
+> python benchmarks/bench.py --save       # write the baseline
+> python benchmarks/bench.py              # compare with the baseline
+> python benchmarks/bench.py -k run/ -q   # only the headless runs, short
+> python benchmarks/bench.py --physics    # only the physics checks
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+REFERENCE = os.path.join(ROOT, 'benchmarks', 'physics_reference.json')
+
+#(geometry, particle, energy in MeV, gun) of the headless runs
+RUNS = [('HUMAN', 'Proton', '10-100', u'Isotrop'),
+        ('RAD', 'Proton', '10-100', u'Isotrop'),
+        ('CANCER', 'Proton', '100', u'Strahl von Links'),
+        ('RPI', 'Elektron', '1-10', u'Isotrop')]
+
+
+def _timed(function, n_items, repeat):
+    """
+    Returns the best time of repeat calls of function and n_items per second
+    """
+    best = float('inf')
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    best = max(best, 1e-9)
+    return {'seconds': best, 'rate': n_items/best}
+
+
+def bench_particle_step(name, repeat):
+    """
+    Particle.step (the scalar reference implementation) over 1 cm of water,
+    rate is substeps/s
+    """
+    from settings import GEOMETRIES
+    from src.particles import TABLE as p_tbl
+    from src.physics import MeV, cm
+    world = GEOMETRIES['HUMAN']
+    particle = p_tbl[name](10*MeV, [.3, .4], 0)
+    particle.set_world(world)
+    def run():
+        particle.energy, particle.pos_x, particle.pos_y = 10*MeV, .3, .4
+        particle.step(1*cm)
+    return _timed(run, 100, repeat)
+
+
+def bench_store_step(name, repeat):
+    """
+    ParticleStore.step of 1000 particles over 1 cm, rate is particles/s
+    """
+    import numpy as np
+    from settings import GEOMETRIES
+    from src.particles import TABLE as p_tbl
+    from src.transport import ParticleStore
+    from src.physics import MeV, cm
+    prototype = p_tbl[name](10*MeV, [0, 0], 0)
+    store = ParticleStore(GEOMETRIES['HUMAN'], 1000,
+                          np.random.RandomState(1))
+    rng = np.random.RandomState(2)
+    idx = store.add_many(prototype.species, prototype.mass,
+                         prototype.charge, np.zeros(1000), 0, 0, 0)
+    def run():
+        store.energy[idx] = 10*MeV
+        store.x[idx] = .3 + .1*rng.rand(1000)
+        store.y[idx] = .4
+        store.dir[idx] = 0
+        store.step(1*cm)
+    return _timed(run, 1000, repeat)
+
+
+def bench_is_inside(repeat):
+    """
+    Volume.is_inside of the torso at random points, rate is calls/s
+    """
+    import numpy as np
+    from settings import GEOMETRIES
+    volume = GEOMETRIES['HUMAN'].volumes[0]
+    x0, y0, x1, y1 = volume.bbox
+    points = np.random.RandomState(1).rand(10000, 2)*[x1-x0, y1-y0]
+    def run():
+        for x, y in points:
+            volume.is_inside(x, y)
+    return _timed(run, len(points), repeat)
+
+
+def bench_get_volume(repeat):
+    """
+    MotherVolume.get_volume of RAD at random points, rate is calls/s
+    """
+    import numpy as np
+    from settings import GEOMETRIES
+    world = GEOMETRIES['RAD']
+    x0, y0, x1, y1 = world.bbox
+    points = np.random.RandomState(1).rand(10000, 2)*[x1-x0, y1-y0]
+    def run():
+        for x, y in points:
+            world.get_volume(x, y)
+    return _timed(run, len(points), repeat)
+
+
+def bench_lookup(repeat):
+    """
+    Vectorized CompiledGeometry.lookup of RAD, rate is points/s
+    """
+    import numpy as np
+    from settings import GEOMETRIES
+    geometry = GEOMETRIES['RAD'].compile()
+    x0, y0, x1, y1 = geometry.bbox
+    x, y = np.random.RandomState(1).rand(2, 10**6)*[[x1-x0], [y1-y0]]
+    return _timed(lambda: geometry.lookup(x, y), len(x), repeat)
+
+
+def bench_mfp(name, kind, repeat):
+    """
+    Material get_neutron_mfp/get_gamma_mfp and the CrossSectionTable of
+    10^5 energies, rate is energies/s
+    """
+    import numpy as np
+    from src.materials import TABLE as m_tbl
+    from src.tables import cross_section_table
+    from src.physics import MeV
+    material = m_tbl[name]
+    energy = np.exp(np.random.RandomState(1).uniform(np.log(.01*MeV),
+                                                     np.log(100*MeV), 10**5))
+    get_mfp = getattr(material, 'get_%s_mfp' % kind)
+    table = cross_section_table(material, kind)
+    result = _timed(lambda: get_mfp(energy), len(energy), repeat)
+    result['table_rate'] = _timed(lambda: table.mfp(energy), len(energy),
+                                  repeat)['rate']
+    return result
+
+
+def bench_gun(name, repeat):
+    """
+    Batch source sampling of 10^6 primaries, rate is primaries/s
+    """
+    import numpy as np
+    from src.guns import sample
+    rng = np.random.RandomState(1)
+    bbox = (0., 0., .8, 1.2)
+    return _timed(lambda: sample(name, '1-100', bbox, 10**6, rng), 10**6,
+                  repeat)
+
+
+def bench_spectrum(name, repeat):
+    """
+    Alias sampling of 10^6 energies of a tabulated spectrum, rate is
+    energies/s
+    """
+    import numpy as np
+    from src.spectra import TABLE as s_tbl
+    rng = np.random.RandomState(1)
+    spectrum = s_tbl[name]
+    return _timed(lambda: spectrum.sample(10**6, rng), 10**6, repeat)
+
+
+def bench_run(geometry, particle, energy, gun, n, repeat):
+    """
+    Headless simulate run, rate is histories/s
+    """
+    from settings import GEOMETRIES
+    from src.simulation import simulate
+    world = GEOMETRIES[geometry]
+    world.compile()
+    return _timed(lambda: simulate(world, particle, energy, gun, n, seed=1),
+                  n, repeat)
+
+
+def benchmarks(quick=False):
+    """
+    Returns the list of (name, function, args) of all benchmarks
+    """
+    from src.particles import TABLE as p_tbl
+    from src.materials import TABLE as m_tbl
+    from src.guns import TABLE as g_tbl
+    from src.spectra import TABLE as s_tbl
+    repeat = 1 if quick else 3
+    n = 100 if quick else 1000
+    tasks = []
+    for name in p_tbl.keys():
+        tasks.append((u'particle_step/' + name, bench_particle_step,
+                      (name, repeat)))
+    for name in p_tbl.keys():
+        tasks.append((u'store_step/' + name, bench_store_step,
+                      (name, repeat)))
+    tasks.append((u'geometry/is_inside', bench_is_inside, (repeat,)))
+    tasks.append((u'geometry/get_volume', bench_get_volume, (repeat,)))
+    tasks.append((u'geometry/lookup', bench_lookup, (repeat,)))
+    for name in m_tbl.keys():
+        for kind in ('neutron', 'gamma'):
+            tasks.append((u'mfp/%s/%s' % (name, kind), bench_mfp,
+                          (name, kind, repeat)))
+    for name in g_tbl.keys():
+        tasks.append((u'gun/' + name, bench_gun, (name, repeat)))
+    for name in s_tbl.keys():
+        tasks.append((u'spectrum/' + name, bench_spectrum, (name, repeat)))
+    for geometry, particle, energy, gun in RUNS:
+        tasks.append((u'run/%s/%s' % (geometry, particle), bench_run,
+                      (geometry, particle, energy, gun, n, repeat)))
+    return tasks
+
+
+def _child(function, args, pipe):
+    """
+    Runs a benchmark in a forked process and sends back its result
+    """
+    import resource
+    import warnings
+    warnings.simplefilter('ignore')
+    try:
+        result = function(*args)
+        #ru_maxrss is given in kB on linux
+        result['peak_mb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss/1024.
+        pipe.send(result)
+    except Exception as error:
+        pipe.send({'error': repr(error)})
+
+
+def run_isolated(function, args):
+    """
+    Returns the result of function(*args) run in a forked process
+    """
+    import multiprocessing
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_child,
+                                      args=(function, args, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the names of the benchmarks with a rate more than tolerance
+    (fraction) below the baseline
+    """
+    slower = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference or 'rate' not in result or 'rate' not in reference:
+            continue
+        if result['rate'] < (1-tolerance)*reference['rate']:
+            slower.append(name)
+    return sorted(slower)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-k', '--select', default='',
+                        help='only run benchmarks containing this string')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='single repetition and fewer histories')
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help='baseline file (default: benchmarks/'
+                             'baseline.json)')
+    parser.add_argument('-t', '--tolerance', type=float, default=.2,
+                        help='flag rates this fraction below the baseline '
+                             '(default: 0.2)')
+    parser.add_argument('--save', action='store_true',
+                        help='write the results as new baseline')
+    parser.add_argument('--physics', action='store_true',
+                        help='only run the physics checks')
+    parser.add_argument('--save-reference', action='store_true',
+                        help='write the fixed seed physics results as new '
+                             'reference')
+    args = parser.parse_args(argv)
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    from checks import run_checks
+
+    failed = []
+    if not args.physics:
+        results = {}
+        for name, function, function_args in benchmarks(args.quick):
+            if args.select not in name:
+                continue
+            result = run_isolated(function, function_args)
+            results[name] = result
+            if 'error' in result:
+                line = u'%-36s ERROR %s' % (name, result['error'])
+            else:
+                line = u'%-36s %12.4g /s %8.3f s %7.1f MB' % (
+                    name, result['rate'], result['seconds'],
+                    result['peak_mb'])
+            print line.encode('utf-8')
+        if args.save:
+            with open(args.baseline, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+            print 'baseline written to', args.baseline
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            failed = compare(results, baseline, args.tolerance)
+            for name in failed:
+                print (u'REGRESSION %s: %.4g /s, baseline %.4g /s' % (
+                    name, results[name]['rate'],
+                    baseline[name]['rate'])).encode('utf-8')
+    if not args.select or args.physics:
+        failed += run_checks(REFERENCE, args.save_reference)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
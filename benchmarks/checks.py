@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the fixed seed physics checks of benchmarks/bench.py.
+
+Each check returns a list of (name, value, expected, relative tolerance).
+The deposits per volume of fixed seed runs are compared with the stored
+reference; they are statistical results, so they only agree within the
+tolerance once the order of the random numbers changes.
+
+Usage example:
+--------------
+> failed = run_checks('benchmarks/physics_reference.json')
+"""
+import json
+import os
+
+#(geometry, particle, energy in MeV, gun, primaries) of the deposit checks
+DEPOSIT_RUNS = [('HUMAN', 'Proton', '10-100', u'Isotrop', 2000),
+                ('RAD', 'Proton', '10-100', u'Isotrop', 2000),
+                ('RAD', 'Gamma', '0.1-10', u'Isotrop', 2000),
+                ('HUMAN', 'Neutron', '1-10', u'Isotrop', 2000),
+                ('CANCER', 'Proton', '100', u'Strahl von Links', 500)]
+DEPOSIT_TOLERANCE = .25
+
+
+def check_csda_range():
+    """
+    CSDA range of protons in water against NIST PSTAR
+    """
+    from src.tables import get_table
+    from src.physics import MeV, cm
+    proton = get_table('Proton', 'H2O')
+    return [('csda/Proton/10 MeV', proton.range(10*MeV)/cm, .1230, .03),
+            ('csda/Proton/100 MeV', proton.range(100*MeV)/cm, 7.718, .03)]
+
+
+def check_transported_range():
+    """
+    Path length of a 100 MeV proton stopping in the torso against the CSDA
+    range of the table
+    """
+    import numpy as np
+    from settings import GEOMETRIES
+    from src.transport import ParticleStore, CHARGED
+    from src.tables import get_table
+    from src.physics import MeV, amu, q_e, cm
+    store = ParticleStore(GEOMETRIES['HUMAN'], rng=np.random.RandomState(1))
+    i = store.add(CHARGED, 1*amu, 1*q_e, 100*MeV, .3, .4, 0)
+    while store.energy[i] >= 1e-3*MeV:
+        store.step(1*cm)
+    expected = get_table('Proton', 'H2O').range(100*MeV)/cm
+    return [('range/Proton/100 MeV', (store.x[i]-.3)/cm, expected, .01)]
+
+
+def check_energy_conservation():
+    """
+    A proton beam stopping in the torso deposits all of its energy
+    """
+    from settings import GEOMETRIES
+    from src.simulation import simulate
+    result = simulate(GEOMETRIES['HUMAN'], 'Proton', '100',
+                      u'Strahl von Links', 200, seed=1)
+    return [('conservation/Proton/100 MeV', result['edep'].sum(), 200*100.,
+             1e-6)]
+
+
+def deposits():
+    """
+    Returns the deposits per volume of the fixed seed DEPOSIT_RUNS
+    """
+    from settings import GEOMETRIES
+    from src.simulation import simulate
+    values = {}
+    for geometry, particle, energy, gun, n in DEPOSIT_RUNS:
+        result = simulate(GEOMETRIES[geometry], particle, energy, gun, n,
+                          seed=1)
+        for name, edep in zip(result['names'], result['edep']):
+            values[u'deposit/%s/%s/%s' % (geometry, particle, name)] = edep
+    return values
+
+
+def run_checks(reference_fn, save=False):
+    """
+    Runs all checks, prints the results and returns the names of the
+    failed checks. With save the deposits are written to reference_fn.
+    """
+    import warnings
+    warnings.simplefilter('ignore')
+    checks = check_csda_range() + check_transported_range() + \
+        check_energy_conservation()
+    values = deposits()
+    if save:
+        with open(reference_fn, 'w') as f:
+            json.dump(values, f, indent=1, sort_keys=True)
+        print 'physics reference written to', reference_fn
+    if os.path.exists(reference_fn):
+        with open(reference_fn) as f:
+            reference = json.load(f)
+        total = {}
+        for name, value in reference.items():
+            run = name.rsplit('/', 1)[0]
+            total[run] = total.get(run, 0) + value
+        for name in sorted(values):
+            if name in reference:
+                #volumes with a small share of the deposit are too noisy
+                if reference[name] < .05*total[name.rsplit('/', 1)[0]]:
+                    continue
+                checks.append((name, values[name], reference[name],
+                               DEPOSIT_TOLERANCE))
+    failed = []
+    for name, value, expected, tolerance in checks:
+        ok = abs(value - expected) <= tolerance*abs(expected)
+        if not ok:
+            failed.append(name)
+        print (u'%-4s %-44s %12.5g expected %12.5g +- %g%%' % (
+            'ok' if ok else 'FAIL', name, value, expected,
+            100*tolerance)).encode('utf-8')
+    return failed
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compiles the geometries of settings.py into memory mapped bundle files
+
+The bundles (gfx/.cache/<NAME>.geo, see src/bundle.py) are also written on
+the first use of a geometry. Compiling them ahead of time saves this for
+the first run, e.g. before many workers start at once.
+
+Example:
+--------
+> python compile_geometry.py            # all geometries
+> python compile_geometry.py RAD RPI
+"""
+import argparse
+import os
+import sys
+import time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('geometry', nargs='*',
+                        help='geometries defined in settings.py (default: '
+                             'all)')
+    args = parser.parse_args(argv)
+
+    from settings import BUNDLES
+    from src.bundle import write_bundle, load_bundle
+    bundles = dict((bundle.name, bundle) for bundle in BUNDLES)
+    unknown = set(args.geometry) - set(bundles)
+    if unknown:
+        parser.error("unknown geometry %s, use one of %s" %
+                     (', '.join(sorted(unknown)),
+                      ', '.join(bundle.name for bundle in BUNDLES)))
+    failed = False
+    for name in args.geometry or [bundle.name for bundle in BUNDLES]:
+        bundle = bundles[name]
+        start = time.time()
+        world = bundle.factory()
+        try:
+            write_bundle(bundle.fn, world, bundle.key())
+        except (IOError, OSError, ValueError) as error:
+            print >> sys.stderr, 'could not write bundle for %s: %s' % (
+                name, error)
+            failed = True
+            continue
+        built = time.time() - start
+        start = time.time()
+        load_bundle(bundle.fn, bundle.key())
+        loaded = time.time() - start
+        print '%-8s %s %8.1f kB  build %6.3f s  load %6.3f s' % (
+            name, bundle.fn, os.path.getsize(bundle.fn)/1024., built, loaded)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
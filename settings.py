@@ -3,27 +3,70 @@
 Created on Sun Oct  5 17:58:59 2014
 Some file to define geometry
 @author: koehler
+
+The geometries are built on first access, so a launcher only loads the
+images of the geometry it uses:
+> from settings import GEOMETRIES
+> geometry = GEOMETRIES['RAD']
+
+Every geometry is compiled into a bundle file (gfx/.cache/<NAME>.geo, see
+src/bundle.py) when it is built. Later starts memory map the bundle instead
+of decoding the images; a changed image or function below builds it again.
+compile_geometry.py writes the bundles ahead of time.
 """
 from src.physics import Volume, MotherVolume, cm
 from src.materials import TABLE as m_tbl
+from src.registry import LazyTable
+from src.bundle import BundledGeometry
+
+GEOMETRIES = LazyTable()
+
+#splitting/roulette importances, forced collision volumes and weight cutoff
+#of the variance reduction of each geometry (see src/variance.py), used by
+#LD50_batch.py --variance-reduction
+VARIANCE_REDUCTION = {
+    'RAD': {'importance': {'A (Si)': 4, 'B (Si)': 4, 'C (Si)': 4},
+            'forced': ['A (Si)', 'B (Si)', 'C (Si)'],
+            'weight_cutoff': .01},
+    'RPI': {'importance': {'Si': 4},
+            'forced': ['Si'],
+            'weight_cutoff': .01}}
+
+
+def human():
+    return MotherVolume([Volume('gfx/torso2.png', 'Body', m_tbl['H2O'])])
+
+
+def rad():
+    s2px = 1192./16/cm
+    A = Volume("gfx/RAD_A.png", "A (Si)", m_tbl['Silicon'], s2px=s2px)
+    B = Volume("gfx/RAD_B.png", "B (Si)", m_tbl['Silicon'], s2px=s2px)
+    C = Volume("gfx/RAD_C.png", "C (Si)", m_tbl['Silicon'], s2px=s2px)
+    D = Volume("gfx/RAD_D.png", "D (CsI)", m_tbl['CsI'], s2px=s2px)
+    E = Volume("gfx/RAD_E.png", "E (BC430)", m_tbl['H2O'], s2px=s2px)
+    F = Volume("gfx/RAD_F.png", "F (BC430)", m_tbl['H2O'], s2px=s2px)
+    BG = Volume("gfx/RAD_BG.png", "Background", m_tbl['Vacuum'], s2px=s2px)
+    return MotherVolume([BG, A, B, C, D, E, F])
+
 
-HUMAN = MotherVolume([Volume('gfx/torso2.png', 'Body', m_tbl['H2O'])])
+def cancer():
+    s2px = 700./16/cm
+    CANCER_BG = Volume("gfx/cancer_bg.png", "Gesundes Gewebe", m_tbl['H2O'], s2px=s2px)
+    CANCER_FG = Volume("gfx/cancer_fg.png", "Krankes gewebe", m_tbl['H2O'], s2px=s2px)
+    return MotherVolume([CANCER_BG, CANCER_FG])
 
-A = Volume("gfx/RAD_A.png", "A (Si)", m_tbl['Silicon'], s2px=1192./16/cm)
-B = Volume("gfx/RAD_B.png", "B (Si)", m_tbl['Silicon'], s2px=1192./16/cm)
-C = Volume("gfx/RAD_C.png", "C (Si)", m_tbl['Silicon'], s2px=1192./16/cm)
-D = Volume("gfx/RAD_D.png", "D (CsI)", m_tbl['CsI'], s2px=1192./16/cm)
-E = Volume("gfx/RAD_E.png", "E (BC430)", m_tbl['H2O'], s2px=1192./16/cm)
-F = Volume("gfx/RAD_F.png", "F (BC430)", m_tbl['H2O'], s2px=1192./16/cm)
-BG = Volume("gfx/RAD_BG.png", "Background", m_tbl['Vacuum'], s2px=1192./16/cm)
-RAD = MotherVolume([BG, A, B, C, D, E, F])
 
-CANCER_BG = Volume("gfx/cancer_bg.png", "Gesundes Gewebe", m_tbl['H2O'], s2px=700./16/cm)
-CANCER_FG = Volume("gfx/cancer_fg.png", "Krankes gewebe", m_tbl['H2O'], s2px=700./16/cm)
-CANCER = MotherVolume([CANCER_BG, CANCER_FG])
+def rpi():
+    s2px = 1192./16/cm
+    RPI_BG = Volume("gfx/RPIRENA_BG.png", "Background", m_tbl['Vacuum'], s2px=s2px)
+    RPI_Si = Volume("gfx/RPIRENA_Si.png", "Si", m_tbl['Silicon'], s2px=s2px)
+    RPI_CsI = Volume("gfx/RPIRENA_CsI.png", 'CsI', m_tbl['CsI'], s2px=s2px)
+    return MotherVolume([RPI_BG, RPI_Si, RPI_CsI])
 
-RPI_BG = Volume("gfx/RPIRENA_BG.png", "Background", m_tbl['Vacuum'], s2px=1192./16/cm)
-RPI_Si = Volume("gfx/RPIRENA_Si.png", "Si", m_tbl['Silicon'], s2px=1192./16/cm)
-RPI_CsI = Volume("gfx/RPIRENA_CsI.png", 'CsI', m_tbl['CsI'], s2px=1192./16/cm)
-RPI = MotherVolume([RPI_BG, RPI_Si, RPI_CsI])
 
+BUNDLES = [BundledGeometry('HUMAN', human),
+           BundledGeometry('RAD', rad),
+           BundledGeometry('CANCER', cancer),
+           BundledGeometry('RPI', rpi)]
+for bundle in BUNDLES:
+    GEOMETRIES.register(bundle.name, bundle)
@@ -1,2 +1,9 @@
-from src.gui import start_gui
 from src.base import RunManager
+from src.simulation import simulate
+
+def start_gui(run_manager):
+    """
+    Starts the Qt gui (PyQt4 is only imported here)
+    """
+    from src.gui import start_gui
+    start_gui(run_manager)
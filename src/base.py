@@ -10,34 +10,162 @@ class RunManager():
     The RunManager handles the propagation of one or more particles
     in the world volume. It also handles connection to plotting canvas
     and  the energy deposit table.
+
+    The RunManager itself does not depend on Qt. A gui connects a timer
+    (anything with a stop method) that calls step. If draw_on_step is
+    False, step leaves canvas and energy table alone; the gui then draws
+    snapshots of a SimulationThread (see worker.py) instead.
+
+    self.stats (a RunStats, see stats.py) counts the wall time of the
+    phases of step and of the transport once it is enabled. If
+    self.writer is a DepositWriter (see records.py), every single deposit
+    is streamed to it.
+
+    Only the volumes with self.scored set are scored (by default all but
+    'Background'), see set_scoring. With range rejection (see
+    enable_range_rejection) charged particles which cannot reach one of
+    them any more are stopped early.
+
+    With variance reduction (see set_variance_reduction) the particles
+    carry statistical weights and every deposit is scored with the weight
+    of its particle.
+
+    self.history_tally (a HistoryTally) collects the scored energy per
+    history, i.e. per primary with its secondaries, for the statistical
+    error of self.edeps.
+
+    Besides the energy per volume self.edeps, self.let_tally (a LETTally,
+    see tally.py) sorts the deposits into LET bins for the absorbed dose
+    and the dose equivalent. The geometry is 2D, for the masses every
+    volume is taken as a slab of thickness depth.
+
+    Args:
+    -----
+    world : Volume
+        The world volume
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
+    depth : float
+        Thickness of the volumes in m (default=1 cm)
     """
-    def __init__(self, world):
+    def __init__(self, world, rng=None, depth=.01):
         self.world = world
-        from PyQt4 import QtCore
-        self.timer = QtCore.QTimer()
-        QtCore.QObject.connect(self.timer, QtCore.SIGNAL("timeout()"), \
-                               self.step)        
+        self.timer = None
+        self.draw_on_step = True
         self.canvas = None
+        from src.transport import ParticleStore
+        self.store = ParticleStore(world, rng=rng)
+        self.stats = self.store.stats
         self.particles = []
         self.energy_tbl = None
-        self.names = []
-        self.edeps = []
+        import numpy as np
+        self.names = self.world.get_name()
+        self.edeps = np.zeros(len(self.names))
+        self.scored = np.array([name != 'Background' for name in self.names])
+        self.mesh_tally = None
+        self.writer = None
+        from src.tally import LETTally
+        self.depth = depth
+        self.let_tally = LETTally(self.get_masses())
+        from src.tally import HistoryTally
+        self.history_tally = HistoryTally(len(self.names))
+
+    def set_scoring(self, names):
+        """
+        Score the volumes names (all others are ignored by edeps and
+        let_tally)
+        """
+        import numpy as np
+        unknown = set(names) - set(self.names)
+        if unknown:
+            raise ValueError("unknown volumes %s" % ', '.join(sorted(unknown)))
+        self.scored = np.array([name in names for name in self.names])
+        if self.store.rejection is not None:
+            self.enable_range_rejection()
+
+    def enable_range_rejection(self, enabled=True):
+        """
+        Stop charged particles whose residual range is too short to reach
+        a scoring volume; their energy is deposited where they are
+        """
+        from src.geometry import RangeRejection
+        self.store.rejection = RangeRejection(self.store.get_geometry(),
+                                              self.scored) \
+            if enabled else None
+
+    def set_variance_reduction(self, settings=None):
+        """
+        Switch on the splitting, Russian roulette and forced collisions of
+        a settings dict (see settings.VARIANCE_REDUCTION and variance.py),
+        None switches them off
+        """
+        from src.variance import variance_reduction
+        self.store.variance = variance_reduction(
+            self.store.get_geometry(), self.names, settings) \
+            if settings is not None else None
+
+    def get_masses(self):
+        """
+        Returns the mass of every volume in kg
+        """
+        import numpy as np
+        geometry = self.store.get_geometry()
+        rho = np.array([volume.material.rho for volume in geometry.volumes])
+        return geometry.areas()*self.depth*rho
+
+    def get_let(self, idx, edep, dl):
+        """
+        Returns the LET (J/m) of the deposits edep over the substeps dl of
+        the particles idx
+
+        Charged particles have the LET edep/dl. Neutron deposits are taken
+        as recoil protons of the deposited energy (their stopping power in
+        water), gamma deposits as electrons with an LET below all bins.
+        """
+        import numpy as np
+        from src.transport import CHARGED, NEUTRON
+        from src.tables import get_table
+        species = self.store.species[idx]
+        let = np.zeros(len(idx))
+        charged = (species == CHARGED) & (dl > 0)
+        let[charged] = edep[charged]/dl[charged]
+        neutron = species == NEUTRON
+        if neutron.any():
+            let[neutron] = get_table('Proton', 'H2O').dedx(edep[neutron])
+        return let
+
+    def enable_deposit_map(self, shape=None):
+        """
+        Record the deposited energy (in MeV) in a MeshTally over the world
+        bbox, self.mesh_tally.
+        By default the mesh has the pixels of the compiled world geometry.
+        """
+        from src.tally import MeshTally
+        if shape is None:
+            shape = self.store.get_geometry().shape
+        self.mesh_tally = MeshTally(self.world.bbox, shape)
 
     def set_energy_tbl(self, energy_tbl):
         """
         Set energy table, energy_tbl is a QtTable object
+        The check boxes of the names show the scored volumes.
         """
-        from PyQt4 import QtGui
-        self.names = self.world.get_name()
+        from PyQt4 import QtGui, QtCore
         self.energy_tbl = energy_tbl
-        energy_tbl.setColumnCount(2)        
+        energy_tbl.setColumnCount(4)
         energy_tbl.setRowCount(len(self.names))
         for i in xrange(len(self.names)):
-            energy_tbl.setItem(i, 0, QtGui.QTableWidgetItem(self.names[i]))
-            self.edeps.append(0)
-        energy_tbl.setHorizontalHeaderLabels(('Detektor', 'Energiedeposit / MeV'))
-        energy_tbl.horizontalHeader().setResizeMode(0, QtGui.QHeaderView.Stretch)
-        energy_tbl.horizontalHeader().setResizeMode(1, QtGui.QHeaderView.Stretch)
+            item = QtGui.QTableWidgetItem(self.names[i])
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Checked if self.scored[i]
+                               else QtCore.Qt.Unchecked)
+            energy_tbl.setItem(i, 0, item)
+        energy_tbl.setHorizontalHeaderLabels(('Detektor', 'Energiedeposit / MeV',
+                                              'Dosis / Gy',
+                                              u'Äquivalentdosis / Sv'))
+        for column in xrange(4):
+            energy_tbl.horizontalHeader().setResizeMode(
+                column, QtGui.QHeaderView.Stretch)
         self.update_energy_tbl()
         
     def set_canvas(self, canvas):
@@ -50,66 +178,152 @@ class RunManager():
             raise 
         self.canvas = canvas
         self.canvas.set_world(self.world)
+        if self.mesh_tally is None:
+            self.enable_deposit_map(self.canvas.get_mesh_shape())
 
     def add_particle(self, particle):
         """
         Add particle to run_manager
         """
         particle.set_world(self.world)
+        self.store.adopt(particle)
         self.particles.append(particle)
-        self.canvas.add_particle(particle)
+
+    def add_particles(self, particle, energy, pos_x, pos_y, direction):
+        """
+        Add many particles at once, without Particle objects
+
+        Args:
+        -----
+        particle : str
+            Name of the particle in particles.TABLE
+        energy, pos_x, pos_y, direction : array
+            Energies, positions and directions of the particles
+        """
+        from src.particles import TABLE as p_tbl
+        prototype = p_tbl[particle](energy[0], [0, 0], 0)
+        return self.store.add_many(prototype.species, prototype.mass,
+                                   prototype.charge, energy, pos_x, pos_y,
+                                   direction)
 
     def step(self, ds=None):
         """
         propagate all particles by ds
         If No ds value is given, ds will be selected according to the world size
         """
+        import numpy as np
         from src.physics import MeV, eV
         if not ds:
             ds = (self.world.bbox[2]-self.world.bbox[0])/100.
-        pos_edep = []
-        for particle in self.particles:
-            pos, dE, dl = particle.step(ds)
-            pos_x, pos_y = pos.mean(axis=0)
-            dE = sum(dE)
-            if dE/MeV > 0.001:
-                pos_edep.append((pos_x, pos_y, dE))
-                volume = self.world.get_volume(pos_x, pos_y)
-                if volume and volume.name not in ['Background']: #for now the background is excluded
-                    i = self.names.index(volume.name)
-                    self.edeps[i]+=dE/MeV
-            if particle.energy <= 1*eV or \
-               not self.world.is_in_bbox(particle.pos_x, particle.pos_y):
-                if self.canvas:
-                    i = self.particles.index(particle)
-                    dot = self.canvas.p_dots.pop(i)
-                    self.canvas.scene().removeItem(dot)
-                self.particles.remove(particle)
+        store = self.store
+        stats = self.stats
+        with stats.phase('transport'):
+            idx, pos, edep, dl = store.step(ds)
+        with stats.phase('scoring'):
+            #every substep deposit is scored in the volume it occurred in
+            hit = edep > 0
+            slot = np.broadcast_to(idx, edep.shape)[hit]
+            x, y = pos[hit][:, 0], pos[hit][:, 1]
+            dE, length = edep[hit], dl[hit]
+            weight = store.weight_buf[:edep.shape[0], :edep.shape[1]][hit]
+            extra = store.deposits
+            if len(extra):
+                n = len(extra)
+                slot = np.concatenate((slot, extra.slot[:n]))
+                x = np.concatenate((x, extra.x[:n]))
+                y = np.concatenate((y, extra.y[:n]))
+                dE = np.concatenate((dE, extra.edep[:n]))
+                length = np.concatenate((length, np.zeros(n)))
+                weight = np.concatenate((weight, extra.weight[:n]))
+            weighted = dE*weight/MeV
+            geometry = store.get_geometry()
+            vol = geometry.lookup(x, y)[0]
+            scored = np.where((vol >= 0) & self.scored[vol], vol, -1)
+            inside = scored >= 0
+            self.edeps += np.bincount(vol[inside], weighted[inside],
+                                      minlength=len(self.names))
+            if self.mesh_tally is not None:
+                self.mesh_tally.fill(x, y, weighted)
+            self.let_tally.fill(scored, self.get_let(slot, dE, length),
+                                weighted)
+            self.history_tally.fill(store.primary[slot], scored, weighted)
+            if self.writer is not None:
+                self.writer.write(primary=store.primary[slot],
+                                  species=store.species[slot], x=x, y=y,
+                                  dE=dE/MeV, weight=weight, volume=vol,
+                                  dl=length)
+        with stats.phase('removal'):
+            x, y = store.x[idx], store.y[idx]
+            x0, y0, x1, y1 = self.world.bbox
+            gone = (store.energy[idx] <= 1*eV) | \
+                ~((x0 <= x) & (x <= x1) & (y0 <= y) & (y <= y1))
+            store.remove(idx[gone])
+            live = store.live()
+            self.history_tally.close(store.primary[live].min() if len(live)
+                                     else store.next_primary)
+            self.particles = [particle for particle in self.particles
+                              if store.alive[particle._index]]
+        if stats.enabled:
+            stats.steps += 1
+            stats.substeps += np.count_nonzero(dl)
+            stats.live = len(store)
 
-        if self.canvas:
-            self.canvas.draw_edep(pos_edep)
-            self.canvas.draw_particles(self.particles)
-        if self.energy_tbl:
-            self.update_energy_tbl()
-        if len(self.particles) == 0:
+        with stats.phase('draw'):
+            if self.canvas and self.draw_on_step:
+                live = store.live()
+                self.canvas.draw_tally(self.mesh_tally)
+                self.canvas.draw_particles(store.x[live], store.y[live])
+                if stats.enabled:
+                    stats.scene_items = self.canvas.count_items()
+            if self.energy_tbl and self.draw_on_step:
+                self.update_energy_tbl()
+        if len(store) == 0 and self.timer:
             self.timer.stop()
+
+    def run(self, ds=None):
+        """
+        Propagate all particles until none is left
+        """
+        while len(self.store):
+            self.step(ds)
             
-    def update_energy_tbl(self):
+    def update_energy_tbl(self, edeps=None, let_values=None, errors=None):
         """
-        Update content of energy tbl
+        Update content of energy tbl, with self.edeps, its errors and the
+        doses of self.let_tally or the given values
         """
+        import numpy as np
         from PyQt4 import QtGui
-        for i in xrange(len(self.edeps)):
-            self.energy_tbl.setItem(i,1, QtGui.QTableWidgetItem(str(self.edeps[i])))
+        if edeps is None:
+            edeps = self.edeps
+        if errors is None:
+            errors = self.history_tally.error()
+        dose = self.let_tally.dose(let_values)
+        dose_equivalent = self.let_tally.dose_equivalent(let_values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dose_errors = np.where(edeps > 0, dose*errors/edeps, 0)
+        for i in xrange(len(edeps)):
+            self.energy_tbl.setItem(i, 1, QtGui.QTableWidgetItem(
+                u'%.6g \xb1 %.2g' % (edeps[i], errors[i])))
+            self.energy_tbl.setItem(i, 2, QtGui.QTableWidgetItem(
+                u'%.4g \xb1 %.2g' % (dose[i], dose_errors[i])))
+            self.energy_tbl.setItem(i, 3, QtGui.QTableWidgetItem(
+                '%.4g' % dose_equivalent[i]))
     def clear(self):
         """
         Remove all particles, stop propagation, reset canvas and energy tbl
         """
-        self.timer.stop()
+        if self.timer:
+            self.timer.stop()
+        self.store.remove(self.store.live())
         self.particles = []
+        self.edeps[:] = 0
+        self.let_tally.clear()
+        self.history_tally.clear(self.store.next_primary)
+        self.stats.reset()
+        if self.mesh_tally is not None:
+            self.mesh_tally.clear()
         if self.energy_tbl:
-            for i in xrange(len(self.edeps)):
-                self.edeps[i] = 0
             self.update_energy_tbl()
         if self.canvas:
             self.canvas.clear()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the precompiled geometry bundles.
+
+A bundle is a single file with everything a compiled world needs: the
+label raster, the safety map, the bit-packed masks, names, offsets and
+image files of the volumes, the names of their materials in
+materials.TABLE (the cross sections are loaded from there) and the bbox.
+It starts with a JSON header, the arrays follow at page aligned offsets and
+are memory mapped on load. So a geometry opens without decoding a single
+image, and all processes that open the same bundle share its pages.
+
+The header stores a hash of the image files and a key of the code behind
+the bundle: the function that builds the geometry, its module (e.g.
+settings.py with its helpers) and geometry.py, physics.py and bundle.py,
+which compute the arrays. BundledGeometry builds the geometry again (and
+rewrites the bundle) as soon as one of them changes.
+
+Usage example:
+--------------
+> write_bundle('rad.geo', settings.rad())
+> world = load_bundle('rad.geo')
+>
+> GEOMETRIES.register('RAD', BundledGeometry('RAD', rad))
+"""
+import json
+import os
+import numpy as np
+from .files import replace
+
+BUNDLE_DIR = 'gfx/.cache'
+MAGIC = 'LD50 geometry bundle\n'
+#changes of the format need a new version (changes of the code that
+#computes the arrays are caught by BundledGeometry.key)
+VERSION = 1
+#offsets of the arrays are multiples of the page size
+ALIGN = 4096
+
+
+def _aligned(n):
+    return -(-n // ALIGN)*ALIGN
+
+
+def _file_hash(fn):
+    from hashlib import sha1
+    with open(fn, 'rb') as f:
+        return sha1(f.read()).hexdigest()
+
+
+def write_bundle(fn, world, key=None):
+    """
+    Writes the compiled MotherVolume world to the bundle file fn
+
+    key identifies the definition of world (e.g. a hash of the function
+    that builds it), load_bundle can check it. All materials have to be
+    entries of materials.TABLE.
+    """
+    from .materials import TABLE as m_tbl
+    geometry = world.compile()
+    material_names = dict((id(m_tbl[name]), name) for name in m_tbl
+                          if m_tbl.is_built(name))
+    volumes = []
+    arrays = [('labels', geometry.labels), ('safety', geometry.safety)]
+    for i, volume in enumerate(geometry.volumes):
+        if id(volume.material) not in material_names:
+            raise ValueError("the material of %s is not in materials.TABLE"
+                             % volume.name)
+        dx, dy = geometry.offsets[i]
+        volumes.append({'name': volume.name,
+                        'material': material_names[id(volume.material)],
+                        'image': volume.fn_image, 's2px': volume.s2px,
+                        'offset': [dx, dy], 'shape': list(volume.shape)})
+        arrays.append(('bits.%d' % i, volume.bits))
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                        'offset': offset}
+        offset += _aligned(array.nbytes)
+    header = json.dumps({'version': VERSION, 'key': key,
+                         'sources': dict((volume.fn_image,
+                                          _file_hash(volume.fn_image))
+                                         for volume in geometry.volumes),
+                         'bbox': list(world.bbox), 'volumes': volumes,
+                         'arrays': layout})
+    prefix = MAGIC + '%d\n' % len(header) + header
+    directory = os.path.dirname(fn)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(prefix)
+            start = _aligned(len(prefix))
+            for name, array in arrays:
+                f.seek(start + layout[name]['offset'])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(start + offset)
+        replace(tmp, fn)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_header(fn):
+    """
+    Returns the header dict of the bundle file fn and the file offset of
+    its arrays
+    """
+    with open(fn, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError("%s is not a geometry bundle" % fn)
+        length = int(f.readline())
+        header = json.loads(f.read(length))
+        return header, _aligned(f.tell())
+
+
+def load_bundle(fn, key=None):
+    """
+    Returns the MotherVolume of the bundle file fn, with its compiled
+    geometry on memory maps of the file
+
+    With key the bundle is only loaded if it was written with the same key
+    and its image files did not change since, else None is returned.
+    """
+    from .physics import Volume, MotherVolume
+    from .geometry import CompiledGeometry
+    from .materials import TABLE as m_tbl
+    header, start = read_header(fn)
+    if header['version'] != VERSION:
+        return None
+    if key is not None:
+        if header['key'] != key:
+            return None
+        for source, digest in header['sources'].items():
+            if not os.path.exists(source) or _file_hash(source) != digest:
+                return None
+
+    def array(name):
+        layout = header['arrays'][name]
+        return np.memmap(fn, np.dtype(str(layout['dtype'])), 'r',
+                         start + layout['offset'], tuple(layout['shape']))
+
+    volumes = [Volume.from_mask(volume['image'], volume['name'],
+                                m_tbl[volume['material']],
+                                array('bits.%d' % i), volume['shape'],
+                                volume['s2px'])
+               for i, volume in enumerate(header['volumes'])]
+    world = MotherVolume(volumes, [tuple(volume['offset'])
+                                   for volume in header['volumes']])
+    world.bbox = tuple(header['bbox'])
+    world._compiled = CompiledGeometry(world, array('labels'),
+                                       array('safety'))
+    return world
+
+
+class BundledGeometry(object):
+    """
+    Factory of a geometry (for settings.GEOMETRIES) that loads the bundle
+    of the geometry if it is up to date, else builds the geometry and
+    writes the bundle
+
+    Args:
+    -----
+    name : str
+        Name of the geometry, the bundle is directory/name.geo
+    factory : function
+        Builds the MotherVolume of the geometry
+    directory : str
+        Directory of the bundle (default=BUNDLE_DIR)
+    """
+    def __init__(self, name, factory, directory=BUNDLE_DIR):
+        self.name = name
+        self.factory = factory
+        self.fn = os.path.join(directory, name + '.geo')
+
+    def key(self):
+        """
+        Returns the hash of the code of factory (byte code, constants and
+        names, but not the file name or line numbers) and of the sources of
+        its module and of the modules that compute the bundled arrays
+        """
+        import inspect
+        import marshal
+        import sys
+        from hashlib import sha1
+        from . import geometry, physics
+
+        def content(code):
+            consts = tuple(content(const) if hasattr(const, 'co_code')
+                           else const for const in code.co_consts)
+            return code.co_code, consts, code.co_names
+
+        key = sha1(marshal.dumps(content(self.factory.__code__)))
+        for module in (inspect.getmodule(self.factory), geometry, physics,
+                       sys.modules[__name__]):
+            source = module and inspect.getsourcefile(module)
+            if source and os.path.exists(source):
+                key.update(_file_hash(source))
+        return key.hexdigest()
+
+    def __call__(self):
+        if os.path.exists(self.fn):
+            world = load_bundle(self.fn, self.key())
+            if world is not None:
+                return world
+        return self.build()
+
+    def build(self):
+        """
+        Builds the geometry with factory and writes its bundle. If the
+        bundle cannot be written (no write access, materials that are not
+        in materials.TABLE), the geometry is built on every start.
+        """
+        world = self.factory()
+        try:
+            write_bundle(self.fn, world, self.key())
+        except (IOError, OSError, ValueError):
+            pass
+        return world
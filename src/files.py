@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains helpers for writing files safely.
+
+Checkpoints, record schemas and geometry bundles are written to a
+temporary file first and then moved over the old file, so a crash never
+leaves a half written file behind. os.rename cannot do that on Windows
+(it fails if the destination exists), replace can.
+
+Usage example:
+--------------
+> with open(fn + '.tmp', 'wb') as f:
+>     f.write(data)
+> replace(fn + '.tmp', fn)
+"""
+import os
+import sys
+
+
+def replace(src, dst):
+    """
+    Renames the file src to dst, replacing dst if it exists
+
+    On Windows MoveFileEx replaces dst in a single step as os.rename does
+    on POSIX systems. Raises OSError if the file cannot be moved.
+    """
+    if os.name != 'nt':
+        os.rename(src, dst)
+        return
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    MOVEFILE_WRITE_THROUGH = 0x8
+    encoding = sys.getfilesystemencoding()
+    src, dst = [name if isinstance(name, unicode) else name.decode(encoding)
+                for name in (src, dst)]
+    if not ctypes.windll.kernel32.MoveFileExW(
+            src, dst, MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
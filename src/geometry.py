@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the compiled geometry.
+
+A CompiledGeometry flattens a (Mother)Volume into a single raster of volume
+indices on a common pixel grid. Position lookups are then a single array
+indexing operation, for any number of positions at once.
+
+Usage example:
+--------------
+> geometry = CompiledGeometry(settings.GEOMETRIES['RAD'])
+> vol, mat = geometry.lookup(x_array, y_array)
+> names = [geometry.volumes[i].name for i in vol if i >= 0]
+>
+> rejection = RangeRejection(geometry, scored)
+> distance = rejection.distance(x_array, y_array)
+"""
+import numpy as np
+
+
+class CompiledGeometry(object):
+    """
+    Label raster of a world volume
+
+    The grid uses the finest pixel scale of all volumes. If there are
+    overlaps between different volumes, the last volume wins, as in
+    MotherVolume.
+
+    Args:
+    -----
+    world : Volume
+        Volume or MotherVolume to compile
+    labels, safety : array
+        Precomputed label raster and safety map of world, e.g. the memory
+        maps of a geometry bundle (default=None, computed from the volume
+        masks)
+
+    Attributes:
+    -----------
+    volumes : list
+        The (leaf) volumes, in the order of world.get_name()
+    materials : list
+        The distinct materials of all volumes
+    volume_material : array
+        Index into materials for every volume
+    labels : array
+        Volume index of every pixel, -1 where there is no volume
+    mexpot, edens : array
+        Mean excitation potential and electron density per material.
+        One additional entry at the end holds the values for "no material",
+        so that index -1 can be used directly.
+    safety : array
+        Distance of every pixel to the closest volume boundary
+    """
+    def __init__(self, world, labels=None, safety=None):
+        leaves = world.get_volumes()
+        self.volumes = [volume for volume, offset in leaves]
+        self.offsets = np.array([offset for volume, offset in leaves], float)
+        self.bbox = world.bbox
+        self.s2px = max([volume.s2px for volume in self.volumes])
+        x0, y0, x1, y1 = self.bbox
+        self.shape = (int(np.ceil((y1-y0)*self.s2px)),
+                      int(np.ceil((x1-x0)*self.s2px)))
+        if labels is None:
+            self.labels = np.empty(self.shape, np.int16)
+            self.labels.fill(-1)
+            for i in xrange(len(self.volumes)):
+                self._paint(i)
+        elif tuple(labels.shape) != self.shape:
+            raise ValueError("the label raster does not match the world")
+        else:
+            self.labels = labels
+
+        self.materials = []
+        volume_material = []
+        for volume in self.volumes:
+            ids = [id(material) for material in self.materials]
+            if id(volume.material) not in ids:
+                self.materials.append(volume.material)
+                ids.append(id(volume.material))
+            volume_material.append(ids.index(id(volume.material)))
+        self.volume_material = np.array(volume_material, int)
+        self.mexpot = np.array([m.get_mean_ex_pot() for m in self.materials]
+                               + [1e-30])
+        self.edens = np.array([m.get_e_density() for m in self.materials]
+                              + [0.])
+        self.safety = self._distance_map(self.labels) if safety is None \
+            else safety
+
+    def _paint(self, i):
+        """
+        Write volume i into the label raster
+        """
+        volume = self.volumes[i]
+        mask = volume.get_mask()
+        ox, oy = self.offsets[i]
+        x0, y0 = self.bbox[:2]
+        ny, nx = self.shape
+        #pixel centers of the grid in volume coordinates
+        cx = x0 - ox + (np.arange(nx) + .5)/self.s2px
+        cy = y0 - oy + (np.arange(ny) + .5)/self.s2px
+        px = np.floor(cx*volume.s2px).astype(int)
+        py = np.floor(cy*volume.s2px).astype(int)
+        gx = np.flatnonzero((px >= 0) & (px < mask.shape[1]))
+        gy = np.flatnonzero((py >= 0) & (py < mask.shape[0]))
+        inside = mask[np.ix_(py[gy], px[gx])]
+        region = self.labels[np.ix_(gy, gx)]
+        region[inside] = i
+        self.labels[np.ix_(gy, gx)] = region
+
+    def _distance_map(self, labels):
+        """
+        Returns the distance of every pixel to the closest pixel at a
+        boundary between different labels.
+        """
+        boundary = np.zeros(labels.shape, bool)
+        vertical = labels[1:] != labels[:-1]
+        boundary[1:] |= vertical
+        boundary[:-1] |= vertical
+        horizontal = labels[:, 1:] != labels[:, :-1]
+        boundary[:, 1:] |= horizontal
+        boundary[:, :-1] |= horizontal
+        return self.distance_map(boundary)
+
+    def distance_map(self, targets):
+        """
+        Returns the distance of every pixel to the closest of the pixels
+        targets (bool raster), inf if there are none.
+        The distance is reduced by 1.5 pixel, so it holds for every
+        position inside the pixel.
+        """
+        from scipy.ndimage import distance_transform_edt
+        if not targets.any():
+            distance = np.empty(targets.shape)
+            distance.fill(np.inf)
+            return distance
+        distance = distance_transform_edt(~targets)
+        return np.maximum(distance - 1.5, 0)/self.s2px
+
+    def to_pixel(self, pos_x, pos_y):
+        """
+        Returns the grid pixel indices (row, column) of the positions
+        """
+        x0, y0 = self.bbox[:2]
+        col = np.floor((np.asarray(pos_x) - x0)*self.s2px).astype(int)
+        row = np.floor((np.asarray(pos_y) - y0)*self.s2px).astype(int)
+        return row, col
+
+    def lookup(self, pos_x, pos_y):
+        """
+        Returns the volume and material indices of the positions.
+        Both are -1 outside of all volumes.
+        """
+        row, col = self.to_pixel(pos_x, pos_y)
+        ny, nx = self.shape
+        inside = (row >= 0) & (row < ny) & (col >= 0) & (col < nx)
+        vol = np.empty(row.shape, int)
+        vol.fill(-1)
+        vol[inside] = self.labels[row[inside], col[inside]]
+        mat = np.where(vol >= 0, self.volume_material[vol], -1)
+        return vol, mat
+
+    def areas(self):
+        """
+        Returns the area of every volume in m^2 (only the pixels where the
+        volume is not covered by later volumes)
+        """
+        counts = np.bincount(self.labels[self.labels >= 0],
+                             minlength=len(self.volumes))
+        return counts/float(self.s2px)**2
+
+    def get_safety(self, pos_x, pos_y):
+        """
+        Returns the distance from the positions to the closest volume
+        boundary. Outside of the raster it is 0.
+        """
+        return self.sample(self.safety, pos_x, pos_y)
+
+    def sample(self, raster, pos_x, pos_y):
+        """
+        Returns the values of a raster of the grid at the positions.
+        Outside of the raster they are 0.
+        """
+        row, col = self.to_pixel(pos_x, pos_y)
+        ny, nx = self.shape
+        inside = (row >= 0) & (row < ny) & (col >= 0) & (col < nx)
+        values = np.zeros(row.shape)
+        values[inside] = raster[row[inside], col[inside]]
+        return values
+
+
+class RangeRejection(object):
+    """
+    Distance maps for killing charged particles that cannot reach a
+    scoring volume
+
+    A particle in material m can only cover more than its CSDA range in m
+    after it entered a material with a lower stopping power (e.g. vacuum or
+    the space between the volumes). For every material the map holds the
+    distance to the closest pixel of a scoring volume or of such a less
+    stopping material; a particle with a smaller range stops before it
+    gets there. The stopping powers are compared at a fixed velocity
+    (that of a 100 MeV proton) with the Bethe Bloch formula.
+
+    Args:
+    -----
+    geometry : CompiledGeometry
+        The compiled world
+    scored : array
+        True for the scoring volumes, in the order of geometry.volumes
+    """
+    def __init__(self, geometry, scored):
+        from .physics import eV
+        self.geometry = geometry
+        self.scored = np.asarray(scored, bool)
+        #2 m_e c**2 beta**2 gamma**2 of a 100 MeV proton is 228.5 keV
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stopping = np.nan_to_num(geometry.edens*np.log(
+                228.5e3*eV/geometry.mexpot))
+        labels = geometry.labels
+        material = np.where(labels >= 0, geometry.volume_material[labels],
+                            -1)
+        scoring = np.zeros(labels.shape, bool)
+        scoring[labels >= 0] = self.scored[labels[labels >= 0]]
+        self.maps = []
+        for m in xrange(len(geometry.materials)):
+            weaker = np.flatnonzero(stopping < stopping[m])
+            #stopping[-1] belongs to the pixels without material
+            weaker = np.where(weaker == len(stopping)-1, -1, weaker)
+            targets = scoring | np.in1d(material, weaker).reshape(
+                labels.shape)
+            self.maps.append(geometry.distance_map(targets))
+
+    def distance(self, pos_x, pos_y):
+        """
+        Returns the distance (for the material at the positions) to the
+        closest pixel a particle has to reach to get into a scoring volume;
+        0 outside of all volumes
+        """
+        mat = self.geometry.lookup(pos_x, pos_y)[1]
+        distance = np.zeros(len(mat))
+        for m in np.unique(mat[mat >= 0]):
+            sel = mat == m
+            distance[sel] = self.geometry.sample(self.maps[m], pos_x[sel],
+                                                 pos_y[sel])
+        return distance
@@ -21,11 +21,12 @@ class ParticleCanvas(QtGui.QGraphicsView):
 
         self.world = None
         self.p_dots = []
-        self.dmg_dots = []
+        self.heatmap = None
+        self.heatmap_data = None
+        self.size = 100.
+        self.color_scale = 'linear'
         self.p_pen = QtGui.QPen(QtGui.QColor(0,0,255,0))
         self.p_brush = QtGui.QBrush(QtGui.QColor(0,0,255))
-        self.dmg_pen = QtGui.QPen(QtGui.QColor(255,0,0,0))
-        self.dmg_brush = QtGui.QBrush(QtGui.QColor(255,0,0,100))
 
     def set_world(self, world):
         self.world = world
@@ -42,6 +43,7 @@ class ParticleCanvas(QtGui.QGraphicsView):
             s_image = scene.addPixmap(image)
             y_offset = (self.world.bbox[3]-y1)*self.s2px
             s_image.setOffset(x0*self.s2px,y_offset)
+        self.heatmap = scene.addPixmap(QtGui.QPixmap())
         self.setScene(scene)
 
     def world_to_canvas(self, pos_x, pos_y):
@@ -51,35 +53,55 @@ class ParticleCanvas(QtGui.QGraphicsView):
         x0, y0, x1, y1 = self.world.bbox
         return (pos_x-x0)*self.s2px, (y1-pos_y)*self.s2px
         
-    def add_particle(self, particle):
-        pos_x, pos_y = self.world_to_canvas(particle.pos_x, particle.pos_y)
-        dot = self.scene().addEllipse(pos_x-5, pos_y-5, 10, 10, 
-                                      self.p_pen, self.p_brush)
-        self.p_dots.append(dot)
-        
-    def draw_particles(self, particles):
-        for particle, dot in zip(particles, self.p_dots):
-            px_x, px_y = self.world_to_canvas(particle.pos_x, particle.pos_y)
+    def get_mesh_shape(self):
+        """
+        Returns the (rows, columns) of a mesh with one cell per canvas pixel
+        """
+        x0, y0, x1, y1 = self.world.bbox
+        return int((y1-y0)*self.s2px), int((x1-x0)*self.s2px)
+
+    def draw_particles(self, pos_x, pos_y):
+        """
+        Draws a dot for each particle position, dots are reused
+        """
+        while len(self.p_dots) > len(pos_x):
+            self.scene().removeItem(self.p_dots.pop())
+        while len(self.p_dots) < len(pos_x):
+            self.p_dots.append(self.scene().addEllipse(0, 0, 10, 10,
+                                                       self.p_pen,
+                                                       self.p_brush))
+        for x, y, dot in zip(pos_x, pos_y, self.p_dots):
+            px_x, px_y = self.world_to_canvas(x, y)
             dot.setRect(px_x-5, px_y-5, 10, 10)
             
-    def draw_edep(self, pos_edep):
-        from src.physics import MeV
-        for pos_x, pos_y, dE in pos_edep:
-            px_x, px_y = self.world_to_canvas(pos_x, pos_y)
-            radius = (dE/MeV*self.size)/100.
-            dmg = self.scene().addEllipse(px_x-radius, px_y-radius, 
-                                          radius*2, radius*2, 
-                                          self.dmg_pen, self.dmg_brush)
-            self.dmg_dots.append(dmg)
+    def draw_tally(self, tally):
+        """
+        Shows the MeshTally tally as heatmap, replacing the previous one
+        """
+        import numpy as np
+        rgba = tally.to_image(self.color_scale, gain=self.size/100.)
+        #QImage.Format_ARGB32 is stored as BGRA
+        self.heatmap_data = np.ascontiguousarray(rgba[..., [2, 1, 0, 3]])
+        height, width = self.heatmap_data.shape[:2]
+        image = QtGui.QImage(self.heatmap_data.data, width, height,
+                             width*4, QtGui.QImage.Format_ARGB32)
+        x0, y0, x1, y1 = tally.bbox
+        pixmap = QtGui.QPixmap.fromImage(image).scaled(
+            (x1-x0)*self.s2px, (y1-y0)*self.s2px)
+        self.heatmap.setPixmap(pixmap)
+        self.heatmap.setOffset(*self.world_to_canvas(x0, y1))
+
+    def count_items(self):
+        """
+        Returns the number of items in the scene
+        """
+        return len(self.scene().items())
 
-            
     def clear(self):
         for dot in self.p_dots:
             self.scene().removeItem(dot)
         self.p_dots = []
-        for dot in self.dmg_dots:
-            self.scene().removeItem(dot)
-        self.dmg_dots = []
+        self.heatmap.setPixmap(QtGui.QPixmap())
 
 
 class ApplicationWindow(QtGui.QMainWindow):
@@ -91,6 +113,17 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.file_menu.addAction('&Quit', self.fileQuit,
                                  QtCore.Qt.CTRL + QtCore.Qt.Key_Q)
         self.menuBar().addMenu(self.file_menu)
+        self.view_menu = QtGui.QMenu('&Ansicht', self)
+        self.stats_action = self.view_menu.addAction(u'&Laufzeitstatistik')
+        self.stats_action.setCheckable(True)
+        self.stats_action.toggled.connect(self.show_stats)
+        self.menuBar().addMenu(self.view_menu)
+        self.sim_menu = QtGui.QMenu('&Simulation', self)
+        self.rejection_action = self.sim_menu.addAction(
+            u'&Reichweitenabbruch')
+        self.rejection_action.setCheckable(True)
+        self.rejection_action.toggled.connect(self.set_range_rejection)
+        self.menuBar().addMenu(self.sim_menu)
         self.help_menu = QtGui.QMenu('&Help', self)
         self.menuBar().addSeparator()
         self.menuBar().addMenu(self.help_menu)
@@ -108,7 +141,11 @@ class ApplicationWindow(QtGui.QMainWindow):
         
         ui_grid.addWidget(self.selector, 0, 1)
         ui_grid.addWidget(QtGui.QLabel("Energie / MeV:"), 1, 0)
-        self.energy = QtGui.QLineEdit("100")
+        #a single energy, a range or the name of a tabulated spectrum
+        self.energy = QtGui.QComboBox()
+        self.energy.setEditable(True)
+        from src.spectra import TABLE as s_tbl
+        self.energy.addItems(['100'] + s_tbl.keys())
         ui_grid.addWidget(self.energy, 1, 1)
 
         ui_grid.addWidget(QtGui.QLabel("Einfallsrichtung:"), 2, 0)
@@ -122,7 +159,17 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.b_size.setMaximum(5000)
         self.b_size.setValue(100)
         ui_grid.addWidget(self.b_size, 3, 1)
-        ui_grid.setRowMinimumHeight(4, 20)
+        ui_grid.addWidget(QtGui.QLabel(u"Skala:"), 4, 0)
+        self.sel_scale = QtGui.QComboBox()
+        self.sel_scale.addItems(['linear', 'log'])
+        self.sel_scale.currentIndexChanged.connect(self.set_scale)
+        ui_grid.addWidget(self.sel_scale, 4, 1)
+        ui_grid.addWidget(QtGui.QLabel(u"Ablauf:"), 5, 0)
+        self.sel_mode = QtGui.QComboBox()
+        self.sel_mode.addItems([u'Echtzeit', u'So schnell wie möglich'])
+        self.sel_mode.currentIndexChanged.connect(self.set_mode)
+        ui_grid.addWidget(self.sel_mode, 5, 1)
+        ui_grid.setRowMinimumHeight(6, 20)
 
         btn_start = QtGui.QPushButton("Start")
         btn_start.clicked.connect(self.start_run)
@@ -152,10 +199,23 @@ class ApplicationWindow(QtGui.QMainWindow):
 
         self.run_manager = run_manager
         run_manager.set_energy_tbl(energy_tbl)
+        energy_tbl.itemChanged.connect(self.set_scoring)
         run_manager.set_canvas(self.rad_plot)
         self.set_rad_setting()
 
+        #the simulation runs in its own thread, the gui shows its latest
+        #state at display refresh rate
+        from src.worker import SimulationThread
+        self.last_tally = None
+        self.worker = SimulationThread(run_manager)
+        self.worker.start()
+        self.frame_timer = QtCore.QTimer()
+        self.frame_timer.timeout.connect(self.refresh)
+        self.frame_timer.start(16)
+        self.statusBar().setVisible(False)
+
     def fileQuit(self):
+        self.worker.stop()
         self.close()
 
     def closeEvent(self, ce):
@@ -170,51 +230,93 @@ Ein Tool zur Visualisierung von Strahlenschäden .
  
     def start_run(self):
         self.particle_generator()
-        self.run_manager.timer.start(20)
 
     def clear(self):
-        self.run_manager.clear()
+        self.worker.clear()
+
+    def refresh(self):
+        """
+        Draw the latest snapshot of the simulation thread
+        """
+        snapshot = self.worker.latest()
+        if snapshot is None:
+            return
+        stats = self.run_manager.stats
+        with stats.phase('draw'):
+            self.rad_plot.draw_particles(snapshot['pos_x'],
+                                         snapshot['pos_y'])
+            if snapshot['tally'] is not None:
+                self.rad_plot.draw_tally(snapshot['tally'])
+                self.last_tally = snapshot['tally']
+            self.run_manager.update_energy_tbl(snapshot['edeps'],
+                                               snapshot['let'],
+                                               snapshot['errors'])
+        if stats.enabled:
+            stats.scene_items = self.rad_plot.count_items()
+            self.statusBar().showMessage(stats.summary())
+
+    def set_scoring(self, item):
+        """
+        Score the volumes checked in the energy table
+        """
+        if item.column() != 0:
+            return
+        table = item.tableWidget()
+        names = [self.run_manager.names[i] for i in xrange(table.rowCount())
+                 if table.item(i, 0).checkState() == QtCore.Qt.Checked]
+        with self.worker.lock:
+            self.run_manager.set_scoring(names)
+
+    def set_range_rejection(self, enabled):
+        """
+        Switch the range rejection of charged particles on or off
+        """
+        with self.worker.lock:
+            self.run_manager.enable_range_rejection(enabled)
+
+    def show_stats(self, enabled):
+        """
+        Switch the run statistics and the status bar on or off
+        """
+        stats = self.run_manager.stats
+        stats.reset()
+        stats.enabled = enabled
+        self.statusBar().setVisible(enabled)
+
+    def set_scale(self):
+        self.rad_plot.color_scale = str(self.sel_scale.currentText())
+        if self.last_tally is not None:
+            self.rad_plot.draw_tally(self.last_tally)
+
+    def set_mode(self):
+        self.worker.realtime = self.sel_mode.currentIndex() == 0
 
     def particle_generator(self):
         from src.physics import MeV
+        from src.guns import sample
         self.rad_plot.size = float(self.b_size.text())
-        energy = self.energy.text().replace(',', '.')
-        if len(energy.split('-')) == 2:
-            from numpy.random import rand
-            e1 = float(energy.split('-')[0])
-            e2 = float(energy.split('-')[1])
-            energy = e1*(e2/e1)**rand() #-1 power law
-        else:
-            energy = float(self.energy.text())
-        from src.guns import TABLE as g_tbl
         gun = unicode(self.sel_dir.currentText())
-        pos, dir = g_tbl[gun](self.run_manager.world.bbox)
+        energy, pos_x, pos_y, dir = sample(gun,
+                                           unicode(self.energy.currentText()),
+                                           self.run_manager.world.bbox, 1)
 
         from src.particles import TABLE as p_tbl
         particle = str(self.selector.currentText())
-        self.run_manager.add_particle(p_tbl[particle](energy*MeV, pos, dir))
+        self.worker.add_particle(p_tbl[particle](energy[0]*MeV,
+                                                 [pos_x[0], pos_y[0]],
+                                                 dir[0]))
 
     def set_rad_setting(self):
-        if str(self.selector.currentText()) == 'kosmisches Muon':
-            self.b_size.setValue(1000)
-            self.energy.setText("1000-10000")
-            self.sel_dir.setCurrentIndex(self.sel_dir.findText(u"Höhenstrahlung"))
-        elif str(self.selector.currentText()) == 'Gammazerfall':
-            self.b_size.setValue(1000)
-            self.energy.setText("0.1-3")
-            self.sel_dir.setCurrentIndex(self.sel_dir.findText("Isotrop"))
-        elif str(self.selector.currentText()) == 'Alphazerfall':
-            self.b_size.setValue(100)
-            self.energy.setText("1-6")
-            self.sel_dir.setCurrentIndex(self.sel_dir.findText("Isotrop"))
-        elif str(self.selector.currentText()) == 'Betazerfall':
-            self.b_size.setValue(1000)
-            self.energy.setText("1-6")
-            self.sel_dir.setCurrentIndex(self.sel_dir.findText("Isotrop"))
-        elif str(self.selector.currentText()) == 'X-Ray':
-            self.b_size.setValue(4000)
-            self.energy.setText("0.01-0.25")
-            self.sel_dir.setCurrentIndex(self.sel_dir.findText("Isotrop"))
+        """
+        Apply the preset of the selected particle, see spectra.PRESETS
+        """
+        from src.spectra import PRESETS
+        preset = PRESETS.get(str(self.selector.currentText()))
+        if preset is None:
+            return
+        self.b_size.setValue(preset['size'])
+        self.energy.setEditText(preset['energy'])
+        self.sel_dir.setCurrentIndex(self.sel_dir.findText(preset['gun']))
 
 def start_gui(run_manager):
     """
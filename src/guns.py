@@ -3,45 +3,131 @@
 This file contains methods to create particle positions an directions
 and a TABLE of available mathods
 
+Every method in TABLE samples a batch of n primaries at once and returns
+the arrays pos_x, pos_y, dir. The gen_* functions return a single
+primary.
+
 TABLE usage example:
 --------------------
 > list_of_available_methods = TABLE.keys()
-> pos, dir = TABLE['CosLaw'](bbox)
+> pos_x, pos_y, dir = TABLE[u'Isotrop'](bbox, 1000)
+> energy, pos_x, pos_y, dir = sample(u'Isotrop', '10-100', bbox, 1000)
 """
+import numpy as np
+from .registry import LazyTable
+
+TABLE = LazyTable()
+
+def _rand(rng):
+    """
+    Returns the rand function of rng (default=numpy.random)
+    """
+    if rng is None:
+        import numpy.random as rng
+    return rng.rand
+
+def get_energy(spec, rng=None):
+    """
+    Returns an energy in MeV for an energy specification
+
+    Args:
+    -----
+    spec : str
+        A single energy "E" or a range "E1-E2" in MeV or the name of a
+        spectrum in spectra.TABLE. Energies in a range are distributed
+        logarithmically flat, i.e. E^-1.
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
+    """
+    return sample_energy(spec, 1, rng)[0]
+
+def sample_energy(spec, n, rng=None):
+    """
+    Returns an array of n energies in MeV for an energy specification,
+    see get_energy
+    """
+    from .spectra import TABLE as s_tbl
+    if spec in s_tbl:
+        return s_tbl[spec].sample(n, rng)
+    spec = spec.replace(',', '.')
+    if len(spec.split('-')) == 2:
+        e1 = float(spec.split('-')[0])
+        e2 = float(spec.split('-')[1])
+        return e1*(e2/e1)**_rand(rng)(n) #-1 power law
+    return np.repeat(float(spec), n)
+
+def sample(gun, spec, bbox, n, rng=None):
+    """
+    Returns n primaries of a gun in TABLE with energies following spec
+
+    Args:
+    -----
+    gun : str
+        Name of the method in TABLE
+    spec : str
+        Energy specification in MeV, see get_energy
+    bbox : tuple
+        The worlds bbox
+    n : int
+        Number of primaries
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
+
+    Returns:
+    --------
+    energy, pos_x, pos_y, dir : array, array, array, array
+        energy in MeV, the positions and the angles
+    """
+    energy = sample_energy(spec, n, rng)
+    pos_x, pos_y, direction = TABLE[gun](bbox, n, rng)
+    return energy, pos_x, pos_y, direction
 
-TABLE = {}
 
-def cos_law():
+def cos_law(n=None, rng=None):
     """
-    Returns a cosine law angle.
+    Returns cosine law angles (a single one if n is None).
     Used to generate an isotropic distribution
+
+    The distribution cos(theta)*sin(theta) on [0, pi/2] is sampled by the
+    inverse of its distribution function sin(theta)**2.
     """
-    from numpy.random import rand
-    from numpy import cos, sin, pi
-    while True:
-        theta = 0.5*rand()*pi
-        y = rand()
-        if y < cos(theta)*sin(theta):
-            break
-    if rand() > .5:
-        theta *= -1
-    return theta
-
-def cos_square():
-    """
-    """
-    from numpy.random import rand
-    from numpy import cos, pi
-    while True:
-        theta = 0.5*rand()*pi
-        y = rand()
-        if y < cos(theta)**2:#*sin(theta):
-            break
-    if rand() > .5:
-        theta *= -1
-    return theta
-    
-def gen_beam_top(bbox):
+    rand = _rand(rng)
+    size = 1 if n is None else n
+    theta = np.arcsin(np.sqrt(rand(size)))
+    theta[rand(size) > .5] *= -1
+    return theta[0] if n is None else theta
+
+def cos_square(n=None, rng=None):
+    """
+    Returns cos**2 distributed angles (a single one if n is None).
+
+    There is no closed form inverse, so the angles are drawn by rejection,
+    a whole batch at a time.
+    """
+    rand = _rand(rng)
+    size = 1 if n is None else n
+    theta = np.empty(0)
+    while len(theta) < size:
+        trial = 0.5*rand(2*(size-len(theta)) + 16)*np.pi
+        accept = rand(len(trial)) < np.cos(trial)**2
+        theta = np.concatenate((theta, trial[accept]))
+    theta = theta[:size]
+    theta[rand(size) > .5] *= -1
+    return theta[0] if n is None else theta
+
+def _single(sampler):
+    """
+    Returns a function returning a single ([x, y], dir) of sampler
+    """
+    def gen(bbox, rng=None):
+        pos_x, pos_y, direction = sampler(bbox, 1, rng)
+        return [pos_x[0], pos_y[0]], direction[0]
+    gen.__doc__ = """
+    Returns [x, y], dir of a single primary of %s
+    """ % sampler.__name__
+    return gen
+
+def sample_beam_top(bbox, n, rng=None):
     """
     Returns a 20% wide beam wich hits the volume from the top
     
@@ -49,21 +135,24 @@ def gen_beam_top(bbox):
     -----
     bbox : tuple
         The worlds bbox
+    n : int
+        Number of primaries
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
         
     Returns:
     --------
-    pos, dir : list, float
-        pos is the [x, y] position, dir the angle
+    pos_x, pos_y, dir : array, array, array
+        The positions and the angles
     """
     from .physics import deg
-    from numpy.random import rand
+    rand = _rand(rng)
     x0, y0, x1, y1 = bbox
-    x = (x0+x1)/2 + (x1-x0)/5 * (rand()-.5)
-    y = y1
-    dir = 270*deg
-    return [x, y], dir    
+    x = (x0+x1)/2 + (x1-x0)/5 * (rand(n)-.5)
+    y = np.repeat(float(y1), n)
+    return x, y, np.repeat(270*deg, n)
     
-def gen_beam_left(bbox):
+def sample_beam_left(bbox, n, rng=None):
     """
     Returns a 20% wide beam wich hits the volume from the left
     
@@ -71,20 +160,23 @@ def gen_beam_left(bbox):
     -----
     bbox : tuple
         The worlds bbox
+    n : int
+        Number of primaries
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
         
     Returns:
     --------
-    pos, dir : list, float
-        pos is the [x, y] position, dir the angle
+    pos_x, pos_y, dir : array, array, array
+        The positions and the angles
     """
-    from numpy.random import rand
+    rand = _rand(rng)
     x0, y0, x1, y1 = bbox
-    x = x0
-    y = (y0+y1)/2 + (y1-y0)/5 * (rand()-.5)
-    dir = 0
-    return [x, y], dir    
+    x = np.repeat(float(x0), n)
+    y = (y0+y1)/2 + (y1-y0)/5 * (rand(n)-.5)
+    return x, y, np.zeros(n)
 
-def gen_beam_right(bbox):
+def sample_beam_right(bbox, n, rng=None):
     """
     Returns a 20% wide beam wich hits the volume from the right
     
@@ -92,57 +184,57 @@ def gen_beam_right(bbox):
     -----
     bbox : tuple
         The worlds bbox
+    n : int
+        Number of primaries
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
         
     Returns:
     --------
-    pos, dir : list, float
-        pos is the [x, y] position, dir the angle
+    pos_x, pos_y, dir : array, array, array
+        The positions and the angles
     """
     from .physics import deg
-    from numpy.random import rand
+    rand = _rand(rng)
     x0, y0, x1, y1 = bbox
-    x = x1
-    y = (y0+y1)/2 + (y1-y0)/5 * (rand()-.5)
-    dir = 180*deg
-    return [x, y], dir
+    x = np.repeat(float(x1), n)
+    y = (y0+y1)/2 + (y1-y0)/5 * (rand(n)-.5)
+    return x, y, np.repeat(180*deg, n)
     
-def gen_isotrop(bbox):
+def sample_isotrop(bbox, n, rng=None):
     """
     Returns an isotropic radiation field
     
+    The primaries enter through the left, top, right and bottom side
+    with the weights height, width, height and 2*height.
+
     Args:
     -----
     bbox : tuple
         The worlds bbox
+    n : int
+        Number of primaries
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
         
     Returns:
     --------
-    pos, dir : list, float
-        pos is the [x, y] position, dir the angle
+    pos_x, pos_y, dir : array, array, array
+        The positions and the angles
     """
     from .physics import deg
-    from numpy.random import rand
+    rand = _rand(rng)
     x0, y0, x1, y1 = bbox    
-    side = rand()*((x1-x0)+2*(y1-y0)*2)
-    if side < y1-y0:
-        dir = cos_law()
-        pos_x = x0
-        pos_y = y0 + rand()*(y1-y0)
-    elif side < y1-y0 + x1-x0:
-        dir = cos_law() + 270*deg
-        pos_x = x0 + rand()*(x1-x0)
-        pos_y = y1
-    elif side < (y1-y0)*2 + x1-x0:
-        dir= cos_law() + 180*deg
-        pos_x = x1
-        pos_y = y0 + rand()*(y1-y0)   
-    else:
-        dir = cos_law() + 90*deg
-        pos_x = x0 + rand()*(x1-x0)
-        pos_y = y0  
-    return [pos_x, pos_y], dir
-
-def gen_cos2(bbox):
+    width, height = x1-x0, y1-y0
+    side = np.searchsorted([height, height+width, 2*height+width],
+                           rand(n)*(width+4*height), side='right')
+    along = rand(n)
+    pos_x = np.choose(side, [x0, x0 + along*width, x1, x0 + along*width])
+    pos_y = np.choose(side, [y0 + along*height, y1, y0 + along*height, y0])
+    direction = cos_law(n, rng) + np.array([0, 270, 180, 90])[side]*deg
+    return pos_x, pos_y, direction
+
+def sample_cos2(bbox, n, rng=None):
     """
     Returns an cos2 radiation field
     
@@ -150,21 +242,31 @@ def gen_cos2(bbox):
     -----
     bbox : tuple
         The worlds bbox
+    n : int
+        Number of primaries
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
         
     Returns:
     --------
-    pos, dir : list, float
-        pos is the [x, y] position, dir the angle
+    pos_x, pos_y, dir : array, array, array
+        The positions and the angles
     """    
     from .physics import deg
-    from numpy.random import rand
+    rand = _rand(rng)
     x0, y0, x1, y1 = bbox    
-    dir = cos_square() + 270*deg
-    pos_x = x0 + (.2  + .6*rand())*(x1-x0)
-    return [pos_x, y1], dir
-    
-TABLE[u'Isotrop'] = gen_isotrop
-TABLE[u'Strahl von Oben'] = gen_beam_top
-TABLE[u'Strahl von Links'] = gen_beam_left
-TABLE[u'Strahl von Rechts'] = gen_beam_right
-TABLE[u'Höhenstrahlung'] = gen_cos2
+    direction = cos_square(n, rng) + 270*deg
+    pos_x = x0 + (.2  + .6*rand(n))*(x1-x0)
+    return pos_x, np.repeat(float(y1), n), direction
+
+gen_beam_top = _single(sample_beam_top)
+gen_beam_left = _single(sample_beam_left)
+gen_beam_right = _single(sample_beam_right)
+gen_isotrop = _single(sample_isotrop)
+gen_cos2 = _single(sample_cos2)
+
+TABLE[u'Isotrop'] = sample_isotrop
+TABLE[u'Strahl von Oben'] = sample_beam_top
+TABLE[u'Strahl von Links'] = sample_beam_left
+TABLE[u'Strahl von Rechts'] = sample_beam_right
+TABLE[u'Höhenstrahlung'] = sample_cos2
@@ -6,11 +6,40 @@ This file contains the Material classes and a TABLE of defined Materials
 TABLE usage example:
 --------------------
 > list_of_available_materials = TABLE.keys()
-> water = TABLE['Water']
+> water = TABLE['H2O']
+
+The materials (and their cross sections) are built on first access.
 """
 
 from .physics import q_e, g, cm3, amu, eV, MeV, cm2, m3, N_A, barn
-TABLE = {}
+from .xsections import load_table, load_neutron
+from .registry import LazyTable
+TABLE = LazyTable()
+
+def clamped(x, y):
+    """
+    Linear interpolation of the table x, y.
+    Outside of the table the first and last value are used, so particles
+    slowing down below a tabulated range do not stop the whole batch.
+    """
+    from numpy import interp
+    function = lambda energy: interp(energy, x, y)
+    function.grid = x
+    return function
+
+def union_grid(functions):
+    """
+    Returns the sorted union of the grids of the clamped functions
+
+    A grid point given twice (an absorption edge) is kept, together with
+    a point just below it, so the edge stays a step.
+    """
+    from numpy import concatenate, unique, diff
+    grids = [f.grid for f in functions if hasattr(f, 'grid')]
+    if not grids:
+        return unique([])
+    edges = [grid[1:][diff(grid) == 0]*(1-1e-9) for grid in grids]
+    return unique(concatenate(grids + edges))
 
 class Material(object):
     """
@@ -37,15 +66,12 @@ class Material(object):
         self.n_xsec = lambda x : 1e-30
         self.g_attn = lambda x : 1e-30
         if n_x_sections:
-            from numpy import loadtxt
-            from scipy.interpolate import interp1d
-            energy = loadtxt(n_x_sections, usecols=[0,2,4]).ravel()
-            sigma= loadtxt(n_x_sections, usecols=[1,3,5]).ravel()
-            self.n_xsec = interp1d(energy*eV, sigma*barn)
+            energy, sigma = load_neutron(n_x_sections)
+            self.n_xsec = clamped(energy*eV, sigma*barn)
         if g_x_sections:
-            g_energy, attenuation = loadtxt(g_x_sections, usecols=[0, 2], 
-                                            unpack=True)
-            self.g_attn = interp1d(g_energy*MeV, attenuation*cm2/g)
+            g_energy, attenuation = load_table(g_x_sections, 
+                                               usecols=[0, 2]).T
+            self.g_attn = clamped(g_energy*MeV, attenuation*cm2/g)
     def get_mean_ex_pot(self):
         """
         returns the means excitation potential
@@ -61,6 +87,14 @@ class Material(object):
         MFP for neutrons
         """
         return [1./(self.nr_dens*self.n_xsec(energy))]
+    def get_energy_grid(self, kind):
+        """
+        Returns the union energy grid of the neutron ('neutron') or gamma
+        ('gamma') cross sections, i.e. of all attributes n_xsec* or g_attn*
+        """
+        prefix = {'neutron': 'n_xsec', 'gamma': 'g_attn'}[kind]
+        return union_grid([value for name, value in vars(self).items()
+                           if name.startswith(prefix)])
 
 
     def get_gamma_mfp(self, energy):
@@ -96,6 +130,13 @@ class Compound(Material):
         self.A = mean([material.A for material in materials])
         self.sumA = sum([material.A for material in materials])
         self.nr_dens = self.rho/(amu*self.sumA)
+    def get_energy_grid(self, kind):
+        """
+        Returns the union energy grid of the cross sections of all materials
+        """
+        attribute = {'neutron': 'n_xsec', 'gamma': 'g_attn'}[kind]
+        return union_grid([getattr(material, attribute)
+                           for material in self.materials])
     def get_neutron_mfp(self, energy):
         """
         MFP for neutrons
@@ -115,24 +156,16 @@ class Water(Material):
         from .physics import barn
         super(Water, self).__init__(8., 16., 1.*g/cm3)      
         if load_x_sections:
-            from numpy import loadtxt
-            from scipy.interpolate import interp1d
-            energy_H = loadtxt("X-sections/n_X_section_H.txt", 
-                               usecols=[0,2,4]).ravel()
-            sigma_H = loadtxt("X-sections/n_X_section_H.txt", 
-                              usecols=[1,3,5]).ravel()
-            energy_O = loadtxt("X-sections/n_X_section_O.txt",
-                               usecols=[0,2,4]).ravel()
-            sigma_O = loadtxt("X-sections/n_X_section_O.txt", 
-                              usecols=[1,3,5]).ravel()
-            self.n_xsec_H = interp1d(energy_H*eV, sigma_H*barn)
-            self.n_xsec_O = interp1d(energy_O*eV, sigma_O*barn)
+            energy_H, sigma_H = load_neutron("X-sections/n_X_section_H.txt")
+            energy_O, sigma_O = load_neutron("X-sections/n_X_section_O.txt")
+            self.n_xsec_H = clamped(energy_H*eV, sigma_H*barn)
+            self.n_xsec_O = clamped(energy_O*eV, sigma_O*barn)
             self.n_dens_H = 2*33.3679e27/m3
             self.n_dens_O = 33.3679e27/m3
-            g_energy, attenuation = loadtxt('X-sections/g_X_section_H20.txt', 
-                                            skiprows=9,
-                                            usecols=[0, 7], unpack=True)
-            self.g_attn = interp1d(g_energy*MeV, attenuation*cm2/g)
+            g_energy, attenuation = load_table('X-sections/g_X_section_H20.txt', 
+                                               skiprows=9,
+                                               usecols=[0, 7]).T
+            self.g_attn = clamped(g_energy*MeV, attenuation*cm2/g)
                                             
     def get_mean_ex_pot(self):
         return 75*q_e
@@ -156,24 +189,17 @@ class CesiumIodide(Material):
         from .physics import barn
         self.rho = 4.51*g/cm3
         if load_x_sections:
-            from numpy import loadtxt
-            from scipy.interpolate import interp1d
-            energy_Cs = loadtxt("X-sections/n_X_section_Cs.txt", 
-                               usecols=[0,2,4]).ravel()
-            sigma_Cs = loadtxt("X-sections/n_X_section_Cs.txt", 
-                              usecols=[1,3,5]).ravel()
-            energy_I = loadtxt("X-sections/n_X_section_I.txt",
-                               usecols=[0,2,4], skiprows=2).ravel()
-            sigma_I = loadtxt("X-sections/n_X_section_I.txt", 
-                              usecols=[1,3,5], skiprows=2).ravel()
-            self.n_xsec_Cs = interp1d(energy_Cs*eV, sigma_Cs*barn)
-            self.n_xsec_I = interp1d(energy_I*eV, sigma_I*barn)
+            energy_Cs, sigma_Cs = load_neutron("X-sections/n_X_section_Cs.txt")
+            energy_I, sigma_I = load_neutron("X-sections/n_X_section_I.txt",
+                                             skiprows=2)
+            self.n_xsec_Cs = clamped(energy_Cs*eV, sigma_Cs*barn)
+            self.n_xsec_I = clamped(energy_I*eV, sigma_I*barn)
             self.n_dens_Cs = 1./(259.81*g/N_A)*4.51*g/cm3
             self.n_dens_I = 1./(259.81*g/N_A)*4.51*g/cm3
-            g_energy, attenuation = loadtxt('X-sections/g_X_section_CsI.txt', 
-                                            skiprows=3,
-                                            usecols=[0, 2], unpack=True)
-            self.g_attn = interp1d(g_energy*MeV, attenuation*cm2/g)
+            g_energy, attenuation = load_table('X-sections/g_X_section_CsI.txt', 
+                                               skiprows=3,
+                                               usecols=[0, 2]).T
+            self.g_attn = clamped(g_energy*MeV, attenuation*cm2/g)
                                             
     def get_mean_ex_pot(self):
         return 10 * q_e * (55.+53.)/2
@@ -192,10 +218,9 @@ class CesiumIodide(Material):
         """        
         return [1./(self.g_attn(energy)*self.rho)]    
 
-TABLE['H2O'] = Water()
-TABLE['CsI'] = CesiumIodide()
-TABLE['Silicon'] = Material(14, 28.085, 2.336*g/cm3 ,
-                            "X-sections/n_X_section_Si.txt", 
-                            "X-sections/g_X_section_Si.txt" )
-TABLE['Vacuum'] = Material(1, 1 , 1e-30*g/cm3)                            
-            
\ No newline at end of file
+TABLE.register('H2O', Water)
+TABLE.register('CsI', CesiumIodide)
+TABLE.register('Silicon', lambda: Material(14, 28.085, 2.336*g/cm3 ,
+                                           "X-sections/n_X_section_Si.txt", 
+                                           "X-sections/g_X_section_Si.txt" ))
+TABLE.register('Vacuum', lambda: Material(1, 1 , 1e-30*g/cm3))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the parallel (multi process) version of simulate.
+
+The primaries are split over a pool of worker processes. Worker i uses its
+own random stream RandomState([seed, i]), so a result only depends on the
+seed and the number of workers. Without a seed a random one is drawn and
+returned with the result, so the run can be repeated. The geometry,
+including its compiled raster, the cross sections and the stopping power
+tables of the primary particle, is handed to the workers once when the
+pool starts. On systems that fork, the workers share these pages with the
+parent process.
+
+Usage example:
+--------------
+> from settings import GEOMETRIES
+> result = simulate_parallel(GEOMETRIES['RAD'], 'Proton', '10-100',
+>                            u'Isotrop', 10**5, seed=1, n_workers=32)
+"""
+import numpy as np
+
+#state of a worker process, set by _init_worker
+_WORKER = {}
+
+
+def _init_worker(geometry):
+    _WORKER['geometry'] = geometry
+
+
+def _run_worker(args):
+    """
+    Simulates the share of one worker
+    """
+    from .simulation import simulate
+    worker, seed, n_primaries, run_args, run_kwargs = args
+    for key in ('checkpoint', 'records'):
+        #every worker has checkpoint file and record directory of its own
+        if run_kwargs.get(key):
+            run_kwargs = dict(run_kwargs, **{key: '%s.%d' % (
+                run_kwargs[key], worker)})
+    return simulate(_WORKER['geometry'], *run_args, n_primaries=n_primaries,
+                    seed=[seed, worker], **run_kwargs)
+
+
+def split(n_primaries, n_workers):
+    """
+    Returns the number of primaries of each worker
+    """
+    shares = np.empty(n_workers, int)
+    shares.fill(n_primaries//n_workers)
+    shares[:n_primaries % n_workers] += 1
+    return shares
+
+
+def merge(results):
+    """
+    Sums a list of simulate results, in the order of the list
+    """
+    merged = dict(results[0])
+    from .tally import history_error
+    summed = ['edep', 'edep_squares', 'dose', 'dose_equivalent', 'let_edep']
+    for key in summed:
+        merged[key] = results[0][key].copy()
+    if merged['deposit_map'] is not None:
+        merged['deposit_map'] = results[0]['deposit_map'].copy()
+    for result in results[1:]:
+        for key in summed:
+            merged[key] += result[key]
+        if merged['deposit_map'] is not None:
+            merged['deposit_map'] += result['deposit_map']
+        merged['n_primaries'] += result['n_primaries']
+    merged['edep_error'] = history_error(merged['edep'],
+                                         merged['edep_squares'],
+                                         merged['n_primaries'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        merged['relative_error'] = np.where(
+            merged['edep'] > 0, merged['edep_error']/merged['edep'], np.inf)
+    return merged
+
+
+def simulate_parallel(geometry, particle, energy_spec, gun, n_primaries,
+                      seed=None, n_workers=None, **kwargs):
+    """
+    Simulates n_primaries particles in geometry with n_workers processes
+
+    The arguments are the same as for simulation.simulate, additionally:
+
+    Args:
+    -----
+    seed : int
+        Seed of the random streams (default=None, a random seed, or the
+        seed of the checkpoints of a continued run)
+    n_workers : int
+        Number of worker processes (default=number of CPUs)
+
+    Every worker stops at target_error*sqrt(n_workers), so that the merged
+    result has about target_error.
+
+    Returns:
+    --------
+    result : dict
+        The summed results of all workers, see simulation.simulate, and
+        'seed' : the seed of the run
+    """
+    import os
+    import multiprocessing
+    from .simulation import Simulation
+    if seed is None:
+        checkpoint = kwargs.get('checkpoint')
+        if checkpoint and os.path.exists(checkpoint + '.0'):
+            seed = Simulation.read_header(checkpoint + '.0')['options'][
+                'seed'][0]
+        else:
+            seed = np.random.randint(2**31)
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, n_primaries))
+    #build the shared read only structures before the workers start
+    from .particles import TABLE as p_tbl
+    from .tables import stopping_table, cross_section_table
+    from .transport import CHARGED, NEUTRON, GAMMA
+    compiled = geometry.compile()
+    prototype = p_tbl[particle](1., [0, 0], 0)
+    for material in compiled.materials:
+        if prototype.species == CHARGED:
+            stopping_table(prototype.mass, prototype.charge, material)
+        elif prototype.species in (NEUTRON, GAMMA):
+            cross_section_table(material, 'neutron' if prototype.species ==
+                                NEUTRON else 'gamma')
+    if kwargs.get('target_error'):
+        kwargs = dict(kwargs, target_error=kwargs['target_error']*
+                      np.sqrt(n_workers))
+    tasks = [(i, seed, n, (particle, energy_spec, gun), kwargs)
+             for i, n in enumerate(split(n_primaries, n_workers))]
+    if n_workers == 1:
+        _init_worker(geometry)
+        results = map(_run_worker, tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers, _init_worker, (geometry,))
+        try:
+            results = pool.map(_run_worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    result = merge(results)
+    result['seed'] = seed
+    return result
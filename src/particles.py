@@ -6,20 +6,44 @@ TABLE usage example:
 --------------------
 > list_of_available_particles = TABLE.keys()
 > proton = TABLE['Proton'](energy, [x, y], dir)
+
+The keys keep the order of definition (the order shown in the gui).
 """
 from .physics import mm, eV, c_light, amu, q_e, m_e, m_muon, MeV, deg, pi, \
     epsilon_0, keV
+from .transport import ParticleStore, PASSIVE, CHARGED, NEUTRON, GAMMA
+from .registry import LazyTable
+
+TABLE = LazyTable()
 
-TABLE = {}
+def _field(name):
+    """
+    Property reading and writing the particle's slot in its store
+    """
+    def fget(self):
+        return getattr(self._store, name)[self._index]
+    def fset(self, value):
+        getattr(self._store, name)[self._index] = value
+    return property(fget, fset)
 
 class Particle(object):
+    """
+    A single particle, seen as a view on one slot of a ParticleStore.
+    Each particle starts in a store of its own and is moved into the
+    run's store by ParticleStore.adopt.
+    """
+    species = PASSIVE
+    mass = _field('mass')
+    charge = _field('charge')
+    energy = _field('energy')
+    pos_x = _field('x')
+    pos_y = _field('y')
+    dir = _field('dir')
+
     def __init__(self, mass, charge, energy, pos, direction):
-        self.mass = mass
-        self.charge = charge    #e
-        self.energy = energy
-        self.pos_x = pos[0]
-        self.pos_y = pos[1]
-        self.dir = direction
+        self._store = ParticleStore(capacity=1)
+        self._index = self._store.add(self.species, mass, charge,
+                                      energy, pos[0], pos[1], direction)
 
         self.world = None
 
@@ -60,6 +84,7 @@ class Particle(object):
 
 
 class ChargedParticle(Particle):
+    species = CHARGED
     def energy_loss(self, ds):
         """
         Beethe Bloch
@@ -74,6 +99,7 @@ class ChargedParticle(Particle):
             (log(2*m_e*c_light**2*beta**2/mexpot/(1-beta**2))-beta**2)*ds
 
 class Neutron(Particle):
+    species = NEUTRON
     def __init__(self, energy, pos, direction):
         super(Neutron, self).__init__(amu, 0, energy, pos, direction) 
     def energy_loss(self, ds):
@@ -90,6 +116,7 @@ class Neutron(Particle):
         return dE
 
 class Gamma(Particle):
+    species = GAMMA
     def __init__(self, energy, pos, direction):
         super(Gamma, self).__init__(0, 0, energy, pos, direction)     
     def energy_loss(self, ds):
@@ -40,37 +40,100 @@ barn = 1e-28
 
 def quality_factor(L):
     """
-    Quality factor according to wikipedia
+    Quality factor Q(L) of ICRP 60 for the unrestricted LET L in water
+    (J/m, a number or an array)
     """
-    from numpy import sqrt
-    L /= (keV/um)
-    if L < 10:
-        return 1
-    elif L < 100:
-        return 0.32*L-2.2
-    else:
-        return 300./sqrt(L)
+    import numpy as np
+    L = np.asarray(L, float)/(keV/um)
+    Q = np.where(L < 10, 1., np.where(L < 100, 0.32*L-2.2,
+                                      300./np.sqrt(np.maximum(L, 100))))
+    return Q if Q.ndim else float(Q)
 
 
 class Volume(object):
+    """
+    A volume of a single material, given by the opaque pixels of an image
+
+    Only the alpha channel is kept, as a bit-packed mask (one bit per
+    pixel). The image itself is read again from fn_image when it is needed
+    for display, see image.
+
+    Args:
+    -----
+    fn_image : str
+        Image file, the pixels with alpha > 0 belong to the volume
+    name : str
+        Name of the volume
+    material : Material
+        Material of the volume
+    s2px : float
+        Pixels per m (default=1e3)
+
+    Attributes:
+    -----------
+    shape : tuple
+        (rows, columns) of the image
+    bits : array
+        Bit-packed mask, row py (from the bottom) and bit px of the pixel
+        (px, py), see get_mask
+    """
     def __init__(self, fn_image, name, material, s2px=1e3):
-        from scipy.misc import imread
+        import numpy as np
         self.fn_image = fn_image
-        self.image = imread(fn_image)
+        image = self.image
+        self.shape = image.shape[:2]
+        #mask row py holds image row -py, see is_inside
+        rows = -np.arange(self.shape[0]) % self.shape[0]
+        self.bits = np.packbits(image[rows, :, 3] > 0, axis=1)
+        del image
         self.name = name
         self.s2px = s2px
         self.material = material
         self._set_bbox()
+    @classmethod
+    def from_mask(cls, fn_image, name, material, bits, shape, s2px=1e3):
+        """
+        Returns the Volume of the bit-packed mask bits (see bits) of an
+        image with shape (rows, columns), without reading the image
+        """
+        volume = cls.__new__(cls)
+        volume.fn_image = fn_image
+        volume.shape = tuple(shape)
+        volume.bits = bits
+        volume.name = name
+        volume.s2px = s2px
+        volume.material = material
+        volume._set_bbox()
+        return volume
+    @property
+    def image(self):
+        """
+        The RGBA image, read from fn_image on every access
+        """
+        from scipy.misc import imread
+        return imread(self.fn_image, mode='RGBA')
     def is_inside(self, pos_x, pos_y):
-        """ """
+        """
+        Returns True for the positions inside of the volume (numbers or
+        arrays)
+        """
         x0, y0, x1, y1 = self.bbox
-        if (x0 <= pos_x < x1) and (y0 <= pos_y < y1):
-            pos_x = int(pos_x*self.s2px)
-            pos_y = int(pos_y*self.s2px)
-            if self.image[-pos_y][pos_x][3]>0:
-                return True
-        else:
-            return False
+        if isinstance(pos_x, float) and isinstance(pos_y, float):
+            #single positions without the array overhead
+            if not ((x0 <= pos_x < x1) and (y0 <= pos_y < y1)):
+                return False
+            px = int(pos_x*self.s2px)
+            byte = self.bits.item(int(pos_y*self.s2px), px >> 3)
+            return (byte >> (7 - (px & 7))) & 1 == 1
+        import numpy as np
+        pos_x = np.asarray(pos_x, float)
+        pos_y = np.asarray(pos_y, float)
+        inside = (x0 <= pos_x) & (pos_x < x1) & (y0 <= pos_y) & (pos_y < y1)
+        px = np.where(inside, pos_x*self.s2px, 0).astype(int)
+        py = np.where(inside, pos_y*self.s2px, 0).astype(int)
+        bit = (self.bits[py, px >> 3] >> (7 - (px & 7))) & 1
+        inside &= bit > 0
+        return inside if inside.ndim else bool(inside)
     def get_mexpot_edens(self, pos_x, pos_y):
         """
         Returns a tuple o the
@@ -99,8 +162,8 @@ class Volume(object):
     def _set_bbox(self):
         self.bbox =  (0, #x0
                       0, #y0
-                      self.image.shape[1]/self.s2px,  #x1
-                      self.image.shape[0]/self.s2px) #y1
+                      self.shape[1]/self.s2px,  #x1
+                      self.shape[0]/self.s2px) #y1
     def is_in_bbox(self, pos_x, pos_y):
         x0, y0, x1, y1 = self.bbox
         if (x0 <= pos_x <= x1) and (y0 <= pos_y <= y1):
@@ -115,6 +178,18 @@ class Volume(object):
         return [[self.fn_image, self.bbox]]
     def get_name(self):
         return [self.name]
+    def get_volumes(self):
+        """
+        Returns a list of [volume, offset]
+        """
+        return [[self, (0, 0)]]
+    def get_mask(self):
+        """
+        Returns a bool array, mask[py, px] is True where is_inside is True
+        for the pixel px, py
+        """
+        from numpy import unpackbits
+        return unpackbits(self.bits, axis=1)[:, :self.shape[1]].astype(bool)
 
 
 class MotherVolume(Volume):
@@ -143,6 +218,7 @@ class MotherVolume(Volume):
             offsets = [(0,0) for i in xrange(len(volumes))]
         self.offsets = numpy.array(offsets)
         self._set_bbox()
+        self._compiled = None
     def add_volume(self, volume, offset=(0,0)):
         """
         Add another voume, offset pair to the mothervolume
@@ -150,18 +226,27 @@ class MotherVolume(Volume):
         self.volumes.append(volume)
         self.offsets.append(offset)
         self._set_bbox()
+        self._compiled = None
+    def compile(self):
+        """
+        Returns the CompiledGeometry of this volume.
+        It is created on the first call.
+        """
+        if self._compiled is None:
+            from .geometry import CompiledGeometry
+            self._compiled = CompiledGeometry(self)
+        return self._compiled
     def get_volume(self, pos_x, pos_y):
-        for i in xrange(1, len(self.volumes)+1):
-            x0, y0 = self.offsets[-i]
-            if self.volumes[-i].is_inside(pos_x-x0, pos_y-y0):
-                return self.volumes[-i]
+        """
+        Returns the (innermost) volume at pos_x, pos_y or None
+        """
+        geometry = self.compile()
+        vol = geometry.lookup(pos_x, pos_y)[0]
+        if vol >= 0:
+            return geometry.volumes[vol]
         return None
     def is_inside(self, pos_x, pos_y):
-        for i in xrange(1, len(self.volumes)+1):
-            x0, y0 = self.offsets[-i]
-            if self.volumes[-i].is_inside(pos_x-x0, pos_y-y0):
-                return True
-        return False
+        return self.compile().lookup(pos_x, pos_y)[0] >= 0
     def get_mexpot_edens(self, pos_x, pos_y):
         """
         Returns a tuple o the
@@ -169,7 +254,8 @@ class MotherVolume(Volume):
         """
         volume = self.get_volume(pos_x, pos_y)
         if volume:
-            return volume.get_mexpot_edens(pos_x, pos_y)
+            return volume.material.get_mean_ex_pot(), \
+                volume.material.get_e_density()
         return 1e-30, 0
 
     def get_neutron_mfp(self, pos_x, pos_y, energy):
@@ -225,5 +311,16 @@ class MotherVolume(Volume):
         for volume in self.volumes:
             names += volume.get_name()
         return names
+
+    def get_volumes(self):
+        """
+        Returns a list of [volume, offset] for all (non mother) volumes
+        """
+        leaves = []
+        for i in xrange(len(self.volumes)):
+            dx, dy = self.offsets[i]
+            for volume, (x0, y0) in self.volumes[i].get_volumes():
+                leaves.append([volume, (x0+dx, y0+dy)])
+        return leaves
             
 
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the streaming output of single energy deposits.
+
+A DepositWriter buffers deposit records (one per substep with an energy
+deposit) in fixed size column arrays. A full buffer is written as a chunk,
+one .npy file per column, so the memory stays the same however long the
+run is. schema.json in the output directory lists the columns and the
+written chunks. DepositRecords reads the chunks back as memory maps.
+
+Usage example:
+--------------
+> run_manager.writer = DepositWriter('records')
+> run_manager.run()
+> run_manager.writer.close()
+>
+> records = DepositRecords('records')
+> for chunk in records.chunks(['volume', 'dE', 'weight']):
+>     totals += np.bincount(chunk['volume'] + 1,
+>                           chunk['dE']*chunk['weight'])
+"""
+import json
+import os
+import numpy as np
+from .files import replace
+
+#name, dtype and unit of the columns
+COLUMNS = [('primary', np.int64, ''),
+           ('species', np.int8, ''),
+           ('x', np.float32, 'm'),
+           ('y', np.float32, 'm'),
+           ('dE', np.float32, 'MeV'),
+           ('weight', np.float32, ''),
+           ('volume', np.int16, ''),
+           ('dl', np.float32, 'm')]
+SPECIES = ['passive', 'charged', 'neutron', 'gamma']
+
+
+def _chunk_file(directory, name, index):
+    return os.path.join(directory, '%s.%05d.npy' % (name, index))
+
+
+class DepositWriter(object):
+    """
+    Writes deposit records to chunked column files in directory
+
+    Args:
+    -----
+    directory : str
+        Output directory, created if needed
+    chunk_size : int
+        Number of records per chunk (default=2**20)
+    names : list
+        Volume names stored in the schema, i.e. the meaning of the volume
+        ids (default=None)
+    append : bool
+        Continue after the chunks listed in an existing schema.json, else
+        start with the first chunk (default=False)
+    """
+    def __init__(self, directory, chunk_size=2**20, names=None,
+                 append=False):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.names = list(names) if names is not None else None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.buffers = dict((name, np.empty(chunk_size, dtype))
+                            for name, dtype, unit in COLUMNS)
+        self.n_buffered = 0
+        self.chunks = []
+        schema = os.path.join(directory, 'schema.json')
+        if append and os.path.exists(schema):
+            with open(schema) as f:
+                self.chunks = json.load(f)['chunks']
+
+    def write(self, **columns):
+        """
+        Append records, all COLUMNS are given as arrays (or scalars) of the
+        same length
+        """
+        n = len(columns['dE'])
+        start = 0
+        while start < n:
+            free = self.chunk_size - self.n_buffered
+            stop = min(n, start + free)
+            for name, dtype, unit in COLUMNS:
+                value = np.broadcast_to(columns[name], (n,))
+                self.buffers[name][self.n_buffered:
+                                   self.n_buffered + stop - start] = \
+                    value[start:stop]
+            self.n_buffered += stop - start
+            start = stop
+            if self.n_buffered == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records as a new chunk and update the schema
+        """
+        if not self.n_buffered:
+            return
+        index = len(self.chunks)
+        for name, dtype, unit in COLUMNS:
+            fn = _chunk_file(self.directory, name, index)
+            tmp = fn + '.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, self.buffers[name][:self.n_buffered])
+            replace(tmp, fn)
+        self.chunks.append(self.n_buffered)
+        self.n_buffered = 0
+        self.write_schema()
+
+    def truncate(self, n_chunks):
+        """
+        Drop the buffer and all chunks after the first n_chunks, e.g. to
+        continue a run from a checkpoint
+        """
+        for index in xrange(n_chunks, len(self.chunks)):
+            for name, dtype, unit in COLUMNS:
+                os.remove(_chunk_file(self.directory, name, index))
+        self.chunks = self.chunks[:n_chunks]
+        self.n_buffered = 0
+        self.write_schema()
+
+    def write_schema(self):
+        """
+        Write schema.json, replacing the previous one
+        """
+        schema = {'columns': [{'name': name, 'dtype': np.dtype(dtype).str,
+                               'unit': unit}
+                              for name, dtype, unit in COLUMNS],
+                  'species': SPECIES,
+                  'names': self.names,
+                  'chunks': self.chunks}
+        fn = os.path.join(self.directory, 'schema.json')
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(schema, f, indent=1)
+        replace(fn + '.tmp', fn)
+
+    def close(self):
+        self.flush()
+        self.write_schema()
+
+
+class DepositRecords(object):
+    """
+    Lazy reader of the output directory of a DepositWriter
+
+    Attributes:
+    -----------
+    columns : list
+        The column names
+    names : list
+        The volume names (None if not stored)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'schema.json')) as f:
+            self.schema = json.load(f)
+        self.columns = [column['name'] for column in self.schema['columns']]
+        self.names = self.schema['names']
+
+    def __len__(self):
+        return sum(self.schema['chunks'])
+
+    def chunks(self, columns=None):
+        """
+        Yields one dict of memory mapped column arrays per chunk
+        """
+        for index in xrange(len(self.schema['chunks'])):
+            yield dict((name, np.load(_chunk_file(self.directory, name,
+                                                  index), mmap_mode='r'))
+                       for name in columns or self.columns)
+
+    def column(self, name):
+        """
+        Returns the complete column name as one array (read into memory)
+        """
+        parts = [chunk[name] for chunk in self.chunks([name])]
+        if not parts:
+            dtype = dict((column['name'], column['dtype'])
+                         for column in self.schema['columns'])[name]
+            return np.zeros(0, dtype)
+        return np.concatenate(parts)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the LazyTable, the registry behind the TABLEs of
+materials, particles, guns and the geometries in settings.py.
+
+Entries are declared by name with a factory function and built on first
+access. The result is kept, so every entry is built at most once.
+
+Usage example:
+--------------
+> TABLE = LazyTable()
+> TABLE.register('Silicon', lambda: Material(14, 28.085, 2.336*g/cm3))
+> TABLE.keys()          # nothing is built yet
+> silicon = TABLE['Silicon']
+"""
+
+
+class LazyTable(object):
+    """
+    Ordered, dict like table of lazily built entries
+
+    Values assigned with table[name] = value are stored as they are.
+    """
+    def __init__(self):
+        self._names = []
+        self._factories = {}
+        self._values = {}
+
+    def register(self, name, factory):
+        """
+        Declare name, factory() is called on the first access
+        """
+        if name not in self._factories and name not in self._values:
+            self._names.append(name)
+        self._values.pop(name, None)
+        self._factories[name] = factory
+
+    def __setitem__(self, name, value):
+        if name not in self._factories and name not in self._values:
+            self._names.append(name)
+        self._factories.pop(name, None)
+        self._values[name] = value
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            #the factory is only dropped once it succeeded, so a failing
+            #build raises the same error again on the next access
+            self._values[name] = self._factories[name]()
+            del self._factories[name]
+        return self._values[name]
+
+    def is_built(self, name):
+        """
+        Returns True if the entry name has been built already
+        """
+        return name in self._values
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def pop(self, name, *default):
+        """
+        Removes name without building it. Returns the value of a built
+        entry, else its factory (call it to build the value), see is_built.
+        """
+        if name not in self:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        self._names.remove(name)
+        if name in self._values:
+            return self._values.pop(name)
+        return self._factories.pop(name)
+
+    def __contains__(self, name):
+        return name in self._factories or name in self._values
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return [self[name] for name in self._names]
+
+    def items(self):
+        return [(name, self[name]) for name in self._names]
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the headless (GUI free) simulation API.
+
+Usage example:
+--------------
+> from settings import GEOMETRIES
+> result = simulate(GEOMETRIES['RAD'], 'Proton', '10-100', u'Isotrop', 1000,
+>                   seed=1)
+> zip(result['names'], result['edep'])
+>
+> #long runs, continued from run.ckpt if it exists
+> result = simulate(GEOMETRIES['RAD'], 'Proton', '10-100', u'Isotrop', 10**7,
+>                   seed=1, checkpoint='run.ckpt')
+>
+> #until the relative error in A (Si) is below 1%, at most one hour
+> result = simulate(GEOMETRIES['RAD'], 'Proton', '10-100', u'Isotrop', 10**7,
+>                   target_error=.01, target_volumes=['A (Si)'],
+>                   time_limit=3600)
+"""
+import numpy as np
+
+
+def simulate(geometry, particle, energy_spec, gun, n_primaries, seed=None,
+             deposit_map=False, batch_size=1000, ds=None, stats=None,
+             checkpoint=None, interval=300., records=None, cut=None,
+             scoring=None, range_rejection=False, variance_reduction=None,
+             target_error=None, target_volumes=None, time_limit=None):
+    """
+    Simulates n_primaries particles in geometry
+
+    With target_error or time_limit the run can stop earlier, after the
+    batch in which the target error is reached or the time is up.
+
+    Args:
+    -----
+    geometry : Volume
+        The world volume, e.g. settings.GEOMETRIES['RAD']
+    particle : str
+        Name of the particle in particles.TABLE
+    energy_spec : str
+        Energy in MeV, "E" or "E1-E2" (see guns.get_energy)
+    gun : str
+        Name of the particle source in guns.TABLE
+    n_primaries : int
+        (Maximum) number of primary particles
+    seed : int
+        Seed of the random number generator (default=None)
+    deposit_map : bool or tuple
+        Also return the deposited energy on a mesh over the bbox. True uses
+        the pixels of the compiled geometry, a tuple (rows, columns) sets
+        the mesh size (default=False)
+    batch_size : int
+        Number of primaries transported at the same time (default=1000)
+    ds : float
+        Step length of RunManager.step (default=None)
+    stats : RunStats
+        Counts the wall time of the run phases (default=None)
+    checkpoint : str
+        File for the run state. If it exists, the run continues from it
+        (default=None)
+    interval : float
+        Seconds between two checkpoints (default=300)
+    records : str
+        Directory for the stream of single deposits, see records.py
+        (default=None)
+    cut : float or dict
+        Production cut in MeV for all materials, or a dict of cuts by
+        material name (key 'default' for all others). Secondaries above the cut
+        are tracked, see transport.ProductionCuts (default=None, no
+        secondaries)
+    scoring : list
+        Names of the scored volumes (default=None, all but 'Background')
+    range_rejection : bool
+        Stop charged particles that cannot reach a scored volume any more,
+        see geometry.RangeRejection (default=False)
+    variance_reduction : dict
+        Importances, forced volumes and weight cutoff of the splitting,
+        Russian roulette and forced collisions, e.g.
+        settings.VARIANCE_REDUCTION['RAD'], see variance.py (default=None)
+    target_error : float
+        Stop once the relative error of the deposit is below target_error
+        in all target_volumes (default=None)
+    target_volumes : list
+        Names of the volumes of target_error, all of them scored
+        (default=None, all scored volumes)
+    time_limit : float
+        Stop after this many seconds (default=None)
+
+    Returns:
+    --------
+    result : dict
+        'names' : the volume names,
+        'edep' : array of the deposited energy per volume in MeV (0 for
+        volumes that are not scored), 'scored' : bool array of the scored
+        volumes,
+        'edep_error', 'relative_error' : arrays of the statistical error of
+        edep (standard error from the spread of the histories) in MeV and
+        relative to edep, 'edep_squares' : the sum of the squared deposits
+        per history in MeV^2,
+        'dose', 'dose_equivalent' : arrays of the absorbed dose in Gy and
+        the dose equivalent in Sv per volume (volumes 1 cm thick),
+        'let_edep', 'let_edges' : LETTally.values and edges,
+        'deposit_map' : MeshTally.values of the deposited energy in MeV
+        (None if not requested), 'bbox' : the bbox of the deposit map,
+        'n_primaries' : the number of simulated primaries
+    """
+    import os
+    from .records import DepositWriter
+    options = dict(particle=particle, energy_spec=energy_spec, gun=gun,
+                   n_primaries=n_primaries, seed=seed,
+                   deposit_map=deposit_map, batch_size=batch_size, ds=ds,
+                   cut=cut, scoring=scoring, range_rejection=range_rejection,
+                   variance_reduction=variance_reduction,
+                   target_error=target_error, target_volumes=target_volumes,
+                   time_limit=time_limit)
+    resume = checkpoint and os.path.exists(checkpoint)
+    if resume:
+        #check the checkpoint before the records after it are dropped
+        header = Simulation.read_header(checkpoint)
+        if header['names'] != geometry.get_name() or \
+           Simulation.normalize_options(geometry, **header['options']) != \
+           Simulation.normalize_options(geometry, **options):
+            raise ValueError("%s is the checkpoint of a different run" %
+                             checkpoint)
+    writer = None
+    if records:
+        writer = DepositWriter(records, names=geometry.get_name(),
+                               append=resume)
+    if resume:
+        simulation = Simulation.load(checkpoint, geometry, stats=stats,
+                                     writer=writer)
+    else:
+        simulation = Simulation(geometry, stats=stats, writer=writer,
+                                **options)
+    return simulation.run(checkpoint, interval)
+
+
+class Simulation(object):
+    """
+    A headless run which can be saved to a checkpoint file and continued
+
+    The other arguments are those of simulate. A run continued from a
+    checkpoint gives bit identical results to an uninterrupted run.
+
+    Usage example:
+    --------------
+    > simulation = Simulation(geometry, 'Proton', '10-100', u'Isotrop', 10**6)
+    > result = simulation.run('run.ckpt', interval=600)
+    > #after a crash
+    > result = Simulation.load('run.ckpt', geometry).run('run.ckpt')
+
+    Args:
+    -----
+    writer : DepositWriter
+        Stream of the single deposits (default=None). A checkpoint stores
+        the number of written chunks, so a continued run drops the
+        records written after the checkpoint.
+
+    Attributes:
+    -----------
+    n_started : int
+        Number of primaries added to the run so far
+    elapsed : float
+        Seconds of run time so far, for time_limit
+    """
+    def __init__(self, geometry, particle, energy_spec, gun, n_primaries,
+                 seed=None, deposit_map=False, batch_size=1000, ds=None,
+                 cut=None, scoring=None, range_rejection=False,
+                 variance_reduction=None, target_error=None,
+                 target_volumes=None, time_limit=None, stats=None,
+                 writer=None):
+        from .base import RunManager
+        self.options = options = self.normalize_options(
+            geometry, particle, energy_spec, gun, n_primaries, seed=seed,
+            deposit_map=deposit_map, batch_size=batch_size, ds=ds, cut=cut,
+            scoring=scoring, range_rejection=range_rejection,
+            variance_reduction=variance_reduction, target_error=target_error,
+            target_volumes=target_volumes, time_limit=time_limit)
+        self.geometry = geometry
+        self.rng = np.random.RandomState(options['seed'])
+        self.run_manager = RunManager(geometry, rng=self.rng)
+        if stats is not None:
+            self.run_manager.stats = self.run_manager.store.stats = stats
+        self.run_manager.writer = writer
+        if options['cut'] is not None:
+            self.run_manager.store.cuts = production_cuts(options['cut'])
+        if options['scoring'] is not None:
+            self.run_manager.set_scoring(options['scoring'])
+        if options['range_rejection']:
+            self.run_manager.enable_range_rejection()
+        if options['variance_reduction'] is not None:
+            self.run_manager.set_variance_reduction(
+                options['variance_reduction'])
+        deposit_map = options['deposit_map']
+        if deposit_map:
+            self.run_manager.enable_deposit_map(None if deposit_map is True
+                                                else deposit_map)
+        self.n_started = 0
+        self.elapsed = 0.
+        self._started = None
+
+    @staticmethod
+    def normalize_options(geometry, particle, energy_spec, gun, n_primaries,
+                          seed=None, deposit_map=False, batch_size=1000,
+                          ds=None, cut=None, scoring=None,
+                          range_rejection=False, variance_reduction=None,
+                          target_error=None, target_volumes=None,
+                          time_limit=None):
+        """
+        Returns the options dict of a run with the arguments of simulate,
+        in the form stored in checkpoints (so two runs can be compared)
+        """
+        if isinstance(deposit_map, (tuple, list)):
+            deposit_map = [int(n) for n in deposit_map]
+        if isinstance(seed, (tuple, list)):
+            seed = [int(n) for n in seed]
+        if isinstance(cut, dict):
+            cut = dict((unicode(name), float(value))
+                       for name, value in cut.items())
+        elif cut is not None:
+            cut = float(cut)
+        if scoring is not None:
+            scoring = [unicode(name) for name in scoring]
+        if variance_reduction is not None:
+            variance_reduction = dict(
+                importance=dict((unicode(name), float(value)) for name, value
+                                in (variance_reduction.get('importance') or
+                                    {}).items()),
+                forced=[unicode(name) for name in
+                        variance_reduction.get('forced') or []],
+                weight_cutoff=float(variance_reduction.get('weight_cutoff',
+                                                           .01)))
+        if target_volumes is not None:
+            target_volumes = [unicode(name) for name in target_volumes]
+            unknown = set(target_volumes) - set(geometry.get_name())
+            if unknown:
+                raise ValueError("unknown volumes %s" %
+                                 ', '.join(sorted(unknown)))
+            #the others never get a deposit, so their error stays inf
+            scored = scoring if scoring is not None else \
+                [name for name in geometry.get_name() if name != 'Background']
+            unscored = set(target_volumes) - set(scored)
+            if unscored:
+                raise ValueError("target volumes %s are not scored" %
+                                 ', '.join(sorted(unscored)))
+        return dict(particle=particle, energy_spec=energy_spec, gun=gun,
+                    n_primaries=int(n_primaries), seed=seed,
+                    deposit_map=deposit_map, batch_size=int(batch_size),
+                    ds=ds, cut=cut, scoring=scoring,
+                    range_rejection=bool(range_rejection),
+                    variance_reduction=variance_reduction,
+                    target_error=None if target_error is None
+                    else float(target_error),
+                    target_volumes=target_volumes,
+                    time_limit=None if time_limit is None
+                    else float(time_limit))
+
+    def converged(self):
+        """
+        Returns True if the relative errors of the target volumes are below
+        target_error
+        """
+        target_error = self.options['target_error']
+        if target_error is None or not self.n_started:
+            return False
+        run_manager = self.run_manager
+        names = self.options['target_volumes']
+        target = run_manager.scored if names is None else \
+            np.array([name in names for name in run_manager.names])
+        error = run_manager.history_tally.relative_error()[target]
+        return bool(len(error)) and bool(np.all(error <= target_error))
+
+    def advance(self):
+        """
+        Make a single RunManager step, add the next batch of primaries if no
+        particle is left. Returns False once the run is complete, i.e. all
+        primaries are done, the target error is reached or the time is up.
+        """
+        import time
+        options = self.options
+        run_manager = self.run_manager
+        if self._started is not None:
+            self.elapsed = time.time() - self._started
+        if not len(run_manager.store):
+            n = min(options['batch_size'],
+                    options['n_primaries'] - self.n_started)
+            time_limit = options['time_limit']
+            if n <= 0 or self.converged() or \
+               (time_limit is not None and self.elapsed >= time_limit):
+                return False
+            add_primaries(run_manager, options['particle'],
+                          options['energy_spec'], options['gun'], n, self.rng)
+            self.n_started += n
+        run_manager.step(options['ds'])
+        return True
+
+    def run(self, checkpoint=None, interval=300.):
+        """
+        Simulate until all primaries are done, returns result()
+
+        With checkpoint the state is written to this file every interval
+        seconds and at the end of the run.
+        """
+        import time
+        last = time.time()
+        self._started = last - self.elapsed
+        while self.advance():
+            if checkpoint and time.time() - last > interval:
+                self.save(checkpoint)
+                last = time.time()
+        if checkpoint:
+            self.save(checkpoint)
+        if self.run_manager.writer is not None:
+            self.run_manager.writer.close()
+        return self.result()
+
+    def result(self):
+        """
+        Returns the result dict of the run, see simulate
+        """
+        run_manager = self.run_manager
+        histories = run_manager.history_tally
+        return {'names': run_manager.names,
+                'edep': run_manager.edeps.copy(),
+                'edep_error': histories.error(),
+                'relative_error': histories.relative_error(),
+                'edep_squares': histories.squares.copy(),
+                'scored': run_manager.scored.copy(),
+                'dose': run_manager.let_tally.dose(),
+                'dose_equivalent': run_manager.let_tally.dose_equivalent(),
+                'let_edep': run_manager.let_tally.values.copy(),
+                'let_edges': run_manager.let_tally.edges,
+                'deposit_map': run_manager.mesh_tally.values
+                               if self.options['deposit_map'] else None,
+                'bbox': np.array(self.geometry.bbox),
+                'n_primaries': self.n_started}
+
+    def save(self, fn):
+        """
+        Writes the run state to the checkpoint file fn
+
+        The file is written next to fn first and then renamed, so fn always
+        holds a complete checkpoint.
+        """
+        import os
+        import json
+        from .files import replace
+        run_manager = self.run_manager
+        writer = run_manager.writer
+        if writer is not None:
+            writer.flush()
+        name, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+        arrays = dict(('store_' + key, value) for key, value in
+                      run_manager.store.get_state().items())
+        arrays.update(
+            header=np.array(json.dumps({'options': self.options,
+                                        'names': run_manager.names,
+                                        'n_started': self.n_started,
+                                        'elapsed': self.elapsed,
+                                        'record_chunks': len(writer.chunks)
+                                        if writer is not None else 0,
+                                        'rng': [name, int(pos),
+                                                int(has_gauss),
+                                                float(cached_gaussian)]})),
+            rng_keys=keys,
+            edeps=run_manager.edeps,
+            let=run_manager.let_tally.values)
+        arrays.update(('history_' + key, value) for key, value in
+                      run_manager.history_tally.get_state().items())
+        if run_manager.mesh_tally is not None:
+            arrays['mesh'] = run_manager.mesh_tally.values
+        tmp = '%s.%d.tmp' % (fn, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        replace(tmp, fn)
+
+    @staticmethod
+    def read_header(fn):
+        """
+        Returns the header dict of the checkpoint file fn (options, volume
+        names, number of started primaries ...) without loading the state
+        """
+        import json
+        with np.load(fn) as data:
+            return json.loads(str(data['header']))
+
+    @classmethod
+    def load(cls, fn, geometry, stats=None, writer=None):
+        """
+        Returns the Simulation saved in the checkpoint file fn
+
+        geometry has to be the world volume of the saved run. The chunks
+        of writer written after the checkpoint are removed.
+        """
+        import json
+        with np.load(fn) as data:
+            arrays = dict(data.items())
+        header = json.loads(str(arrays.pop('header')))
+        if header['names'] != geometry.get_name():
+            raise ValueError("%s was written for a different geometry" % fn)
+        simulation = cls(geometry, stats=stats, writer=writer,
+                         **header['options'])
+        if writer is not None:
+            writer.truncate(header.get('record_chunks', 0))
+        run_manager = simulation.run_manager
+        simulation.n_started = header['n_started']
+        simulation.elapsed = header.get('elapsed', 0.)
+        name, pos, has_gauss, cached_gaussian = header['rng']
+        simulation.rng.set_state((str(name), arrays.pop('rng_keys'), pos,
+                                  has_gauss, cached_gaussian))
+        run_manager.edeps[:] = arrays.pop('edeps')
+        run_manager.let_tally.values[:] = arrays.pop('let')
+        if 'mesh' in arrays:
+            run_manager.mesh_tally.values[:] = arrays.pop('mesh')
+        run_manager.history_tally.set_state(dict(
+            (key[len('history_'):], value) for key, value in arrays.items()
+            if key.startswith('history_')))
+        run_manager.store.set_state(dict(
+            (key[len('store_'):], value) for key, value in arrays.items()
+            if key.startswith('store_')))
+        return simulation
+
+
+def production_cuts(cut):
+    """
+    Returns the ProductionCuts of the cut option of simulate
+    """
+    from .physics import MeV
+    from .transport import ProductionCuts
+    if not isinstance(cut, dict):
+        return ProductionCuts(default=cut*MeV)
+    cuts = dict(cut)
+    default = cuts.pop('default', np.inf)
+    return ProductionCuts(default=default*MeV,
+                          cuts=dict((name, value*MeV)
+                                    for name, value in cuts.items()))
+
+
+def add_primaries(run_manager, particle, energy_spec, gun, n, rng=None):
+    """
+    Adds n primary particles to the run_manager
+    """
+    from .physics import MeV
+    from .guns import sample
+    energy, pos_x, pos_y, direction = sample(gun, energy_spec,
+                                             run_manager.world.bbox, n, rng)
+    return run_manager.add_particles(particle, energy*MeV, pos_x, pos_y,
+                                     direction)
+
+
+def save_result(fn, result):
+    """
+    Writes a result of simulate to the numpy .npz file fn
+    """
+    arrays = dict((key, value) for key, value in result.items()
+                  if value is not None)
+    arrays['names'] = np.array(result['names'], dtype=unicode)
+    np.savez(fn, **arrays)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the tabulated energy spectra, a TABLE of available
+spectra and the source PRESETS of the gui.
+
+A spectrum is read from a text file with the columns energy in MeV and
+differential flux (any unit per MeV), see spectra/*.txt. The flux is
+interpolated linearly between the points. An alias table over the
+intervals is built once per spectrum, so every energy costs the same few
+random numbers and array lookups however fine the table is.
+
+The names in TABLE can be used wherever an energy specification "E" or
+"E1-E2" is accepted, e.g. in guns.sample, simulate and LD50_batch.py.
+
+TABLE usage example:
+--------------------
+> list_of_available_spectra = TABLE.keys()
+> energy = TABLE['GCR Proton'].sample(1000)
+> energy, pos_x, pos_y, dir = sample(u'Isotrop', 'GCR Proton', bbox, 1000)
+"""
+import numpy as np
+from .registry import LazyTable
+
+TABLE = LazyTable()
+
+
+def alias_table(weights):
+    """
+    Returns the alias table (probability, alias) of Vose's method for
+    drawing index i with probability weights[i]/sum(weights)
+    """
+    n = len(weights)
+    scaled = np.asarray(weights, float)*n/np.sum(weights)
+    probability = np.ones(n)
+    alias = np.arange(n)
+    small = list(np.nonzero(scaled < 1)[0])
+    large = list(np.nonzero(scaled >= 1)[0])
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1 - scaled[less]
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    #the rest only differs from 1 by rounding errors
+    return probability, alias
+
+
+class Spectrum(object):
+    """
+    Tabulated energy spectrum, linearly interpolated
+
+    Args:
+    -----
+    energy : array
+        Increasing energies in MeV
+    flux : array
+        Differential flux (or probability) per MeV at energy
+
+    Attributes:
+    -----------
+    weights : array
+        Integral of the flux over every interval
+    probability, alias : array, array
+        Alias table of the intervals
+    """
+    def __init__(self, energy, flux):
+        self.energy = np.asarray(energy, float)
+        self.flux = np.asarray(flux, float)
+        if len(self.energy) < 2 or np.any(np.diff(self.energy) <= 0):
+            raise ValueError("the energies of a spectrum have to increase")
+        if np.any(self.flux < 0) or not np.any(self.flux > 0):
+            raise ValueError("the flux of a spectrum has to be positive")
+        self.weights = np.diff(self.energy)*(self.flux[1:]+self.flux[:-1])/2
+        self.probability, self.alias = alias_table(self.weights)
+
+    def integral(self):
+        """
+        Returns the integral flux of the spectrum
+        """
+        return self.weights.sum()
+
+    def mean(self):
+        """
+        Returns the mean energy in MeV
+        """
+        e0, e1 = self.energy[:-1], self.energy[1:]
+        f0, f1 = self.flux[:-1], self.flux[1:]
+        #integral of E*f(E) over the linear intervals
+        first = (e1-e0)*(f0*(2*e0+e1) + f1*(e0+2*e1))/6
+        return first.sum()/self.integral()
+
+    def sample(self, n, rng=None):
+        """
+        Returns an array of n energies in MeV
+
+        The interval is drawn from the alias table, the energy within the
+        interval by inverting the distribution function of the linear
+        flux.
+
+        Args:
+        -----
+        n : int
+            Number of energies
+        rng : numpy.random.RandomState
+            Source of random numbers (default=numpy.random)
+        """
+        if rng is None:
+            import numpy.random as rng
+        n_bins = len(self.weights)
+        bins = np.minimum((rng.rand(n)*n_bins).astype(int), n_bins-1)
+        bins = np.where(rng.rand(n) < self.probability[bins], bins,
+                        self.alias[bins])
+        u = rng.rand(n)
+        f0, f1 = self.flux[bins], self.flux[bins+1]
+        #root of (f1-f0)/2*t**2 + f0*t = u*(f0+f1)/2 without cancellation
+        root = f0 + np.sqrt(f0**2 + u*(f1**2-f0**2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(root > 0, u*(f0+f1)/root, u)
+        e0 = self.energy[bins]
+        return e0 + t*(self.energy[bins+1]-e0)
+
+
+def load_spectrum(fn):
+    """
+    Returns the Spectrum of the text file fn (columns energy in MeV and
+    flux per MeV, lines starting with # are comments)
+    """
+    from .xsections import load_table
+    energy, flux = load_table(fn, usecols=[0, 1]).T
+    return Spectrum(energy, flux)
+
+
+TABLE.register('GCR Proton', lambda: load_spectrum('spectra/gcr_proton.txt'))
+TABLE.register('GCR Alpha', lambda: load_spectrum('spectra/gcr_alpha.txt'))
+TABLE.register('Sr-90', lambda: load_spectrum('spectra/beta_sr90.txt'))
+
+#gui settings applied when a particle is selected: damage scaling, energy
+#specification (range or spectrum name) and gun
+PRESETS = {'kosmisches Muon': {'size': 1000, 'energy': '1000-10000',
+                               'gun': u'Höhenstrahlung'},
+           'Gammazerfall': {'size': 1000, 'energy': '0.1-3',
+                            'gun': u'Isotrop'},
+           'Alphazerfall': {'size': 100, 'energy': '1-6',
+                            'gun': u'Isotrop'},
+           'Betazerfall': {'size': 1000, 'energy': 'Sr-90',
+                           'gun': u'Isotrop'},
+           'X-Ray': {'size': 4000, 'energy': '0.01-0.25',
+                     'gun': u'Isotrop'}}
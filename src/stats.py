@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the run statistics (per phase wall time counters) and
+the profiling helpers.
+
+The counters are switched off by default. Then RunStats.phase returns a
+shared object that does nothing, so the instrumented code only pays for
+one method call per phase.
+
+Usage example:
+--------------
+> run_manager.stats.enabled = True
+> run_manager.run()
+> print run_manager.stats.summary()
+> run_manager.stats.dump('stats.json')
+>
+> result = profile('run.prof', simulate, geometry, 'Proton', '10', u'Isotrop',
+>                  1000)
+"""
+import json
+import time
+
+
+class _NullPhase(object):
+    """
+    Phase of disabled stats, does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL = _NullPhase()
+
+
+class _Phase(object):
+    """
+    Adds the wall time of a with block to a phase of RunStats
+    """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add(self.name, time.time() - self.start)
+        return False
+
+
+class RunStats(object):
+    """
+    Per phase wall time counters of a run
+
+    The phases of RunManager.step are 'transport', 'scoring', 'removal'
+    and 'draw'. Within 'transport' the ParticleStore counts 'step_length',
+    'energy_loss' and 'flight', and 'geometry' for the geometry lookups
+    inside of those.
+
+    Args:
+    -----
+    enabled : bool
+        Count (default=True)
+
+    Attributes:
+    -----------
+    seconds, calls : dict
+        Wall time and number of calls of each phase
+    steps, substeps : int
+        Number of RunManager steps and of particle substeps
+    live : int
+        Number of live particles after the last step
+    scene_items : int
+        Number of items in the gui scene after the last drawing
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.steps = 0
+        self.substeps = 0
+        self.live = 0
+        self.scene_items = 0
+        self.started = time.time()
+
+    def phase(self, name):
+        """
+        Returns a context manager adding its wall time to phase name
+        """
+        if not self.enabled:
+            return _NULL
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        """
+        Adds seconds to phase name
+        """
+        self.seconds[name] = self.seconds.get(name, 0.) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def report(self):
+        """
+        Returns all counters as dict
+        """
+        seconds = dict(self.seconds)
+        wall = time.time() - self.started
+        transport = seconds.get('transport', 0.)
+        return {'wall_seconds': wall,
+                'phases': dict((name, {'seconds': value,
+                                       'calls': self.calls.get(name, 0),
+                                       'fraction': value/wall if wall else 0})
+                               for name, value in seconds.items()),
+                'steps': self.steps,
+                'substeps': self.substeps,
+                'substeps_per_second': self.substeps/transport
+                                       if transport else 0.,
+                'live_particles': self.live,
+                'scene_items': self.scene_items}
+
+    def summary(self):
+        """
+        Returns a single line summary, e.g. for a status bar
+        """
+        report = self.report()
+        phases = sorted(report['phases'].items(),
+                        key=lambda item: -item[1]['seconds'])
+        return u'%d Teilchen, %d Objekte, %.3g Teilschritte/s | %s' % (
+            report['live_particles'], report['scene_items'],
+            report['substeps_per_second'],
+            u', '.join(u'%s %.0f%%' % (name, 100*phase['fraction'])
+                       for name, phase in phases))
+
+    def dump(self, fn):
+        """
+        Writes report() to the JSON file fn
+        """
+        with open(fn, 'w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+
+
+def profile(fn, function, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs) with cProfile and returns its result
+
+    The profile is written to fn (pstats format) and as collapsed stacks
+    for flamegraph tools to fn + '.collapsed'.
+    """
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(fn)
+        write_collapsed(pstats.Stats(profiler), fn + '.collapsed')
+
+
+def write_collapsed(stats, fn):
+    """
+    Writes the pstats.Stats stats as collapsed stacks ("a;b;c 123", times
+    in microseconds) to fn
+
+    cProfile only records caller/callee pairs, so the time of a function
+    is split between its callers in proportion to the time spent in each
+    call pair.
+    """
+    def label(func):
+        filename, line, name = func
+        return '%s:%d:%s' % (filename.split('/')[-1], line, name)
+
+    children = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            children.setdefault(caller, []).append((func, edge[3]))
+    lines = {}
+
+    def walk(func, fraction, stack, path):
+        tt, ct = stats.stats[func][2:4]
+        stack = stack + [label(func)]
+        own = int(tt*fraction*1e6)
+        if own:
+            key = ';'.join(stack)
+            lines[key] = lines.get(key, 0) + own
+        for child, edge_time in children.get(func, []):
+            child_ct = stats.stats[child][3]
+            #skip recursion and negligible branches (below 1 us)
+            if child in path or fraction*edge_time < 1e-6:
+                continue
+            walk(child, fraction*edge_time/child_ct, stack, path | {child})
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, 1., [], {func})
+    with open(fn, 'w') as f:
+        for key in sorted(lines):
+            f.write('%s %d\n' % (key, lines[key]))
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains precomputed stopping power and range tables.
+
+For a charged particle (mass, charge) in a material, a StoppingTable holds
+the Bethe Bloch dE/dx and the integrated (CSDA) range on a log spaced
+energy grid. Tables are built on first use and cached.
+
+With the range table a particle crosses a homogeneous segment of known
+length with a single lookup, instead of integrating dE/dx step by step.
+
+For neutrons and gammas a CrossSectionTable holds the macroscopic cross
+section of every interaction channel (nuclide) of a material on the union
+of the energy grids of the channels.
+
+Usage example:
+--------------
+> table = get_table('Proton', 'H2O')
+> table.range(100*MeV)
+> energy = table.energy_after(100*MeV, 5*cm)
+> xs = cross_section_table(m_tbl['H2O'], 'neutron')
+> mfp = xs.mfp(energies)
+> sigma_max = majorant_table(geometry.materials, 'gamma').total_sigma(E)
+"""
+import numpy as np
+from .physics import eV, MeV, pi, c_light, q_e, m_e, epsilon_0
+
+_CACHE = {}
+
+
+class StoppingTable(object):
+    """
+    dE/dx and range table of a charged particle in a material
+
+    Below the maximum of the Bethe Bloch curve (Bragg peak) the formula is
+    not valid any more. There dE/dx is kept at its maximum value, so that
+    every particle comes to rest after a finite range.
+
+    Args:
+    -----
+    mass : float
+        Particle mass
+    charge : float
+        Particle charge
+    material : Material
+        The traversed material
+    e_min, e_max : float
+        Energy range of the table (default=1 eV, 1e5 MeV)
+    n_per_decade : int
+        Number of grid points per decade of energy (default=100)
+    """
+    def __init__(self, mass, charge, material, e_min=1*eV, e_max=1e5*MeV,
+                 n_per_decade=100):
+        self.mass = mass
+        self.charge = charge
+        self.material = material
+        n = int(np.log10(e_max/e_min)*n_per_decade) + 1
+        self.energy = np.logspace(np.log10(e_min), np.log10(e_max), n)
+        self.log_energy = np.log(self.energy)
+        self.dEdx = self._bethe_bloch(self.energy)
+        peak = self.dEdx.argmax()
+        self.dEdx[:peak] = self.dEdx[peak]
+        #range: R(E) = int dE/(dE/dx), with constant dE/dx below e_min
+        integrand = self.energy/self.dEdx
+        self.csda = np.empty(n)
+        self.csda[0] = self.energy[0]/self.dEdx[0]
+        self.csda[1:] = self.csda[0] + np.cumsum(
+            (integrand[1:] + integrand[:-1])/2*np.diff(self.log_energy))
+
+    def _bethe_bloch(self, energy):
+        """
+        Bethe Bloch dE/dx for an array of energies
+        """
+        material = self.material
+        mexpot = material.get_mean_ex_pot()
+        edens = material.get_e_density()
+        z = self.charge/q_e
+        beta2 = 1-(energy/(self.mass*c_light**2)+1)**-2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dEdx = 4*pi*edens*z**2/(m_e*c_light**2*beta2)*\
+                (q_e**2/(4*pi*epsilon_0))**2* \
+                (np.log(2*m_e*c_light**2*beta2/mexpot/(1-beta2))-beta2)
+        return np.nan_to_num(dEdx)
+
+    def dedx(self, energy):
+        """
+        Returns the stopping power dE/dx at the given energies
+        """
+        return np.interp(np.log(energy), self.log_energy, self.dEdx)
+
+    def range(self, energy):
+        """
+        Returns the residual (CSDA) range at the given energies
+        """
+        energy = np.asarray(energy, float)
+        with np.errstate(divide='ignore'):
+            csda = np.interp(np.log(energy), self.log_energy, self.csda,
+                             left=0)
+        #beyond the table the last dE/dx value is used
+        above = energy > self.energy[-1]
+        csda = np.where(above, self.csda[-1] +
+                        (energy-self.energy[-1])/self.dEdx[-1], csda)
+        below = energy < self.energy[0]
+        return np.where(below, energy/self.dEdx[0], csda)
+
+    def energy_after(self, energy, length):
+        """
+        Returns the energy left after traversing length in the material
+        """
+        energy = np.asarray(energy, float)
+        csda = self.range(energy)
+        residual = csda - length
+        after = np.exp(np.interp(residual, self.csda, self.log_energy))
+        above = residual > self.csda[-1]
+        after = np.where(above, self.energy[-1] +
+                         (residual-self.csda[-1])*self.dEdx[-1], after)
+        below = residual < self.csda[0]
+        after = np.where(below, np.maximum(residual, 0)*self.dEdx[0], after)
+        #for segments much shorter than the range the difference of ranges
+        #is dominated by rounding, there dE/dx is constant
+        short = length < 1e-6*csda
+        after = np.where(short, energy - self.dedx(energy)*length, after)
+        #never gain energy by rounding
+        return np.minimum(after, energy)
+
+
+class CrossSectionTable(object):
+    """
+    Macroscopic cross sections of all channels of a material
+
+    The cross sections are tabulated on the union of the energy grids of
+    the channels, so linear interpolation on this grid reproduces the
+    material's get_neutron_mfp or get_gamma_mfp. Outside of the grid the
+    first and last values are used.
+
+    Args:
+    -----
+    material : Material
+        The traversed material
+    kind : str
+        'neutron' or 'gamma'
+
+    Attributes:
+    -----------
+    energy : array
+        The union energy grid
+    sigma : array
+        Macroscopic cross section (1/mfp) per channel and energy,
+        shape (channels, energies)
+    total : array
+        Sum of sigma over the channels
+    """
+    def __init__(self, material, kind):
+        self.material = material
+        self.kind = kind
+        get_mfp = {'neutron': material.get_neutron_mfp,
+                   'gamma': material.get_gamma_mfp}[kind]
+        energy = material.get_energy_grid(kind)
+        if not len(energy):
+            energy = np.array([1*eV, 1e5*MeV])
+        self.energy = energy
+        with np.errstate(divide='ignore'):
+            mfp = np.broadcast_arrays(energy, *get_mfp(energy))[1:]
+            self.sigma = 1./np.array(mfp, float)
+        self.total = self.sigma.sum(axis=0)
+
+    def _locate(self, energy):
+        """
+        Returns the grid intervals and interpolation weights of energy
+        """
+        grid = self.energy
+        energy = np.clip(energy, grid[0], grid[-1])
+        i = np.clip(np.searchsorted(grid, energy), 1, len(grid)-1)
+        weight = (energy - grid[i-1])/(grid[i] - grid[i-1])
+        return i, weight
+
+    def channel_sigma(self, energy):
+        """
+        Returns the macroscopic cross section of every channel at the given
+        energies, shape (channels, energies)
+        """
+        i, weight = self._locate(np.asarray(energy, float))
+        return self.sigma[:, i-1]*(1-weight) + self.sigma[:, i]*weight
+
+    def total_sigma(self, energy):
+        """
+        Returns the total macroscopic cross section at the given energies
+        """
+        return np.interp(energy, self.energy, self.total)
+
+    def mfp(self, energy):
+        """
+        Returns the total mean free path at the given energies
+        """
+        with np.errstate(divide='ignore'):
+            return 1./self.total_sigma(energy)
+
+    def fractions(self, energy):
+        """
+        Returns the probability of every channel at the given energies,
+        shape (channels, energies). All fractions are 0 where the total
+        cross section is 0.
+        """
+        sigma = self.channel_sigma(energy)
+        total = sigma.sum(axis=0)
+        return sigma/np.where(total > 0, total, 1)
+
+    def sample_channel(self, energy, rand=np.random.rand):
+        """
+        Returns a random channel for every energy, chosen according to the
+        fractions of the channels
+        """
+        energy = np.asarray(energy, float)
+        cumulative = np.cumsum(self.fractions(energy), axis=0)
+        u = rand(len(energy))
+        return np.minimum((cumulative < u).sum(axis=0), len(self.sigma)-1)
+
+
+def cross_section_table(material, kind):
+    """
+    Returns the (cached) CrossSectionTable of material for kind 'neutron'
+    or 'gamma'
+    """
+    key = (kind, id(material))
+    if key not in _CACHE:
+        _CACHE[key] = CrossSectionTable(material, kind)
+    return _CACHE[key]
+
+
+class MajorantTable(object):
+    """
+    Upper bound of the total macroscopic cross section of several materials
+    (Woodcock tracking)
+
+    The totals of all materials are evaluated on the union of their grids
+    and the maximum is taken at every grid point. As the maximum of linear
+    functions is convex, the interpolation between the grid points is an
+    upper bound, too.
+
+    Args:
+    -----
+    materials : list
+        The materials of the geometry
+    kind : str
+        'neutron' or 'gamma'
+    """
+    def __init__(self, materials, kind):
+        self.kind = kind
+        tables = [cross_section_table(material, kind)
+                  for material in materials]
+        self.energy = np.unique(np.concatenate(
+            [table.energy for table in tables] + [[1*eV, 1e5*MeV]]))
+        self.total = np.max([table.total_sigma(self.energy)
+                             for table in tables] +
+                            [np.zeros(len(self.energy))], axis=0)
+
+    def total_sigma(self, energy):
+        """
+        Returns the majorant cross section at the given energies
+        """
+        return np.interp(energy, self.energy, self.total)
+
+
+def majorant_table(materials, kind):
+    """
+    Returns the (cached) MajorantTable of the materials for kind 'neutron'
+    or 'gamma'
+    """
+    key = (kind, 'majorant') + tuple(id(material) for material in materials)
+    if key not in _CACHE:
+        _CACHE[key] = MajorantTable(materials, kind)
+    return _CACHE[key]
+
+
+def stopping_table(mass, charge, material):
+    """
+    Returns the (cached) StoppingTable for mass, charge and material
+    """
+    key = (float(mass), float(charge), id(material))
+    if key not in _CACHE:
+        _CACHE[key] = StoppingTable(mass, charge, material)
+    return _CACHE[key]
+
+
+def get_table(particle, material):
+    """
+    Returns the StoppingTable for a particle in a material
+
+    Args:
+    -----
+    particle : str
+        Name of a particle in particles.TABLE
+    material : str
+        Name of a material in materials.TABLE
+    """
+    from .particles import TABLE as p_tbl
+    from .materials import TABLE as m_tbl
+    from .transport import CHARGED
+    prototype = p_tbl[particle](MeV, [0, 0], 0)
+    if prototype.species != CHARGED:
+        raise ValueError("%s is not a charged particle" % particle)
+    return stopping_table(prototype.mass, prototype.charge, m_tbl[material])
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains tallies, i.e. accumulators of the deposited energy.
+
+Usage example:
+--------------
+> tally = MeshTally(world.bbox, (600, 400))
+> tally.fill(pos_x, pos_y, dE)
+> rgba = tally.to_image(scale='log')
+>
+> let_tally = LETTally(masses)
+> let_tally.fill(vol, let, dE)
+> gray, sievert = let_tally.dose(), let_tally.dose_equivalent()
+>
+> histories = HistoryTally(len(names))
+> histories.fill(primary, vol, dE)
+> histories.close(first_unfinished_primary)
+> total, error = histories.sum, histories.error()
+"""
+import numpy as np
+
+
+class MeshTally(object):
+    """
+    Deposited energy on a regular 2D mesh over a bbox
+
+    Args:
+    -----
+    bbox : tuple
+        (x0, y0, x1, y1) of the mesh
+    shape : tuple
+        Number of (rows, columns) of the mesh
+
+    Attributes:
+    -----------
+    values : array
+        Summed energy per mesh cell, values[0, 0] is the cell at (x0, y0)
+    """
+    def __init__(self, bbox, shape):
+        self.bbox = tuple(bbox)
+        self.shape = tuple(shape)
+        self.values = np.zeros(self.shape)
+
+    def fill(self, pos_x, pos_y, dE):
+        """
+        Add the deposits dE at the positions pos_x, pos_y.
+        Deposits outside of the bbox are ignored.
+        """
+        x0, y0, x1, y1 = self.bbox
+        ny, nx = self.shape
+        col = np.floor((pos_x - x0)/(x1 - x0)*nx).astype(int)
+        row = np.floor((pos_y - y0)/(y1 - y0)*ny).astype(int)
+        ok = (row >= 0) & (row < ny) & (col >= 0) & (col < nx)
+        self.values += np.bincount(row[ok]*nx + col[ok], dE[ok],
+                                   minlength=nx*ny).reshape(self.shape)
+
+    def clear(self):
+        self.values[:] = 0
+
+    def to_image(self, scale='linear', gain=1., color=(255, 0, 0),
+                 decades=4):
+        """
+        Returns the tally as an RGBA image (top row first)
+
+        The opacity of every pixel gives its value relative to the maximum.
+
+        Args:
+        -----
+        scale : str
+            'linear' or 'log' (default='linear')
+        gain : float
+            Values above max/gain are saturated (default=1)
+        color : tuple
+            RGB color of the heatmap (default=red)
+        decades : int
+            Number of decades shown by the log scale (default=4)
+        """
+        image = np.zeros(self.shape + (4,), np.uint8)
+        image[..., :3] = color
+        vmax = self.values.max()
+        if vmax <= 0:
+            return image[::-1]
+        level = self.values*gain/vmax
+        if scale == 'log':
+            with np.errstate(divide='ignore'):
+                level = 1 + np.log10(level)/decades
+        image[..., 3] = np.clip(level, 0, 1)*255
+        return image[::-1]
+
+    def save(self, fn):
+        """
+        Writes the tally to the numpy .npz file fn
+        """
+        np.savez(fn, values=self.values, bbox=np.array(self.bbox))
+
+
+class LETTally(object):
+    """
+    Deposited energy per volume in logarithmic LET bins
+
+    The memory and the cost of dose and dose_equivalent only depend on the
+    number of volumes and bins, not on the number of deposits. The quality
+    factor is taken at the (logarithmic) center of every bin.
+
+    Args:
+    -----
+    masses : array
+        Mass of every volume in kg
+    edges : array
+        Increasing LET bin edges in keV/um (default=20 bins per decade
+        from 0.1 to 10^4 keV/um)
+
+    Attributes:
+    -----------
+    values : array
+        Summed energy in MeV per (volume, bin). Bin 0 holds the deposits
+        below the first edge (e.g. of gammas), the last bin those above the
+        last edge.
+    quality : array
+        Quality factor of every bin
+    """
+    def __init__(self, masses, edges=None):
+        from .physics import quality_factor, keV, um
+        self.masses = np.asarray(masses, float)
+        if edges is None:
+            edges = np.logspace(-1, 4, 101)
+        self.edges = np.asarray(edges, float)
+        centers = np.concatenate(([self.edges[0]],
+                                  np.sqrt(self.edges[1:]*self.edges[:-1]),
+                                  [self.edges[-1]]))
+        self.quality = quality_factor(centers*keV/um)
+        self.values = np.zeros((len(self.masses), len(self.edges) + 1))
+
+    def fill(self, vol, let, dE):
+        """
+        Add the deposits dE (MeV) with the LET let (J/m) to the volumes
+        vol. Deposits with vol < 0 are ignored.
+        """
+        from .physics import keV, um
+        ok = vol >= 0
+        n_bins = self.values.shape[1]
+        index = np.searchsorted(self.edges, let[ok]/(keV/um), side='right')
+        self.values += np.bincount(vol[ok]*n_bins + index, dE[ok],
+                                   minlength=self.values.size
+                                   ).reshape(self.values.shape)
+
+    def clear(self):
+        self.values[:] = 0
+
+    def _per_mass(self, energy):
+        from .physics import MeV
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.masses > 0, energy*MeV/self.masses, 0.)
+
+    def dose(self, values=None):
+        """
+        Returns the absorbed dose in Gy per volume (of self.values or the
+        given values)
+        """
+        if values is None:
+            values = self.values
+        return self._per_mass(values.sum(axis=1))
+
+    def dose_equivalent(self, values=None):
+        """
+        Returns the dose equivalent in Sv per volume (of self.values or the
+        given values)
+        """
+        if values is None:
+            values = self.values
+        return self._per_mass(values.dot(self.quality))
+
+
+def history_error(total, squares, n):
+    """
+    Returns the standard error of the totals of n histories, from the
+    total and the sum of squares of the deposits per history
+    """
+    total = np.asarray(total, float)
+    if n < 2:
+        return np.where(total != 0, np.inf, 0.)
+    variance = np.maximum(squares - total**2/n, 0)/(n - 1)
+    return np.sqrt(n*variance)
+
+
+class HistoryTally(object):
+    """
+    Deposited energy per volume and history, for the statistical error
+
+    A history is a primary with all of its secondaries (the particles with
+    the same primary id). Its deposits are collected until it is finished,
+    then they are added to the sum and to the sum of squares of the
+    deposits per history. Primary ids increase, so all histories below the
+    smallest id of the live particles are finished.
+
+    Args:
+    -----
+    n_volumes : int
+        Number of volumes
+    first : int
+        Id of the first history (default=0)
+
+    Attributes:
+    -----------
+    n : int
+        Number of finished histories
+    sum, squares : array
+        Sum of the deposits and of their squares per volume (finished
+        histories only)
+    """
+    def __init__(self, n_volumes, first=0):
+        self.n_volumes = n_volumes
+        self.clear(first)
+
+    def clear(self, first=0):
+        """
+        Drop all histories, the next one has the id first
+        """
+        self.first = first
+        self.n = 0
+        self.sum = np.zeros(self.n_volumes)
+        self.squares = np.zeros(self.n_volumes)
+        self.open = np.zeros((0, self.n_volumes))
+
+    def fill(self, primary, vol, dE):
+        """
+        Add the deposits dE to the volumes vol of the histories primary.
+        Deposits with vol < 0 are ignored.
+        """
+        ok = vol >= 0
+        if not ok.any():
+            return
+        rows = primary[ok] - self.first
+        n_rows = rows.max() + 1
+        if n_rows > len(self.open):
+            self.open = np.concatenate((self.open, np.zeros(
+                (n_rows - len(self.open), self.n_volumes))))
+        self.open[:n_rows] += np.bincount(
+            rows*self.n_volumes + vol[ok], dE[ok],
+            minlength=n_rows*self.n_volumes).reshape(n_rows, -1)
+
+    def close(self, upto):
+        """
+        Finish all histories with an id below upto
+        """
+        n_closed = upto - self.first
+        if n_closed <= 0:
+            return
+        closed = self.open[:n_closed]
+        self.sum += closed.sum(axis=0)
+        self.squares += (closed**2).sum(axis=0)
+        self.open = self.open[n_closed:].copy()
+        self.n += n_closed
+        self.first = upto
+
+    def error(self):
+        """
+        Returns the standard error of sum
+        """
+        return history_error(self.sum, self.squares, self.n)
+
+    def relative_error(self):
+        """
+        Returns error()/sum, inf for volumes without deposits
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.sum > 0, self.error()/self.sum, np.inf)
+
+    def get_state(self):
+        """
+        Returns the tally as dict of arrays, see set_state
+        """
+        return {'first': np.array(self.first), 'n': np.array(self.n),
+                'sum': self.sum, 'squares': self.squares, 'open': self.open}
+
+    def set_state(self, state):
+        """
+        Replaces the tally by that of a get_state dict
+        """
+        self.first = int(state['first'])
+        self.n = int(state['n'])
+        self.sum = np.array(state['sum'], float)
+        self.squares = np.array(state['squares'], float)
+        self.open = np.array(state['open'], float).reshape(-1,
+                                                           self.n_volumes)
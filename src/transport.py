@@ -0,0 +1,977 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the batch transport engine.
+
+All particles of a run are kept in a ParticleStore, a structure of arrays
+(energy, position, direction, mass, charge, species, statistical weight).
+One call of ParticleStore.step advances every live particle with numpy
+array operations instead of looping over the particles one by one.
+
+Interactions can produce secondaries (recoil protons of neutrons, Compton
+and photo electrons of gammas, delta rays of charged particles). Those
+above the ProductionCuts of the material are collected on a SecondaryStack
+during a step and added to the store at its end; all others deposit their
+energy locally. By default there are no cuts, i.e. nothing is tracked.
+
+The weights only differ from 1 with the variance reduction of variance.py.
+
+Usage example:
+--------------
+> store = ParticleStore(world)
+> i = store.add(CHARGED, amu, q_e, 100*MeV, 0., 0., 0.)
+> idx, pos, edep, dl = store.step(1*cm)
+>
+> store.cuts = ProductionCuts(default=1*MeV, cuts={'CsI': 10*MeV})
+"""
+import numpy as np
+from .physics import mm, eV, MeV, keV, deg, c_light, amu, q_e, m_e, pi, \
+    epsilon_0
+from .tables import stopping_table, cross_section_table, majorant_table
+
+#species codes
+PASSIVE = 0
+CHARGED = 1
+NEUTRON = 2
+GAMMA = 3
+
+#length of a single transport substep
+SUBSTEP = .1*mm
+
+#(species, mass, charge) of the secondaries
+RECOIL_PROTON = (CHARGED, 1*amu, 1*q_e)
+ELECTRON = (CHARGED, m_e, 1*q_e)
+
+
+class ProductionCuts(object):
+    """
+    Energy thresholds above which secondaries are tracked, per material
+
+    Args:
+    -----
+    default : float
+        Cut of all materials not in cuts (default=inf, no secondaries)
+    cuts : dict
+        Cut energy of materials by their name in materials.TABLE
+        (default={})
+    """
+    def __init__(self, default=np.inf, cuts=None):
+        self.default = default
+        self.cuts = dict(cuts or {})
+        self._energies = {}
+
+    @property
+    def enabled(self):
+        """
+        True if any secondary can be tracked
+        """
+        return self.default < np.inf or \
+            any(cut < np.inf for cut in self.cuts.values())
+
+    def energies(self, materials):
+        """
+        Returns the cut of each material and an additional inf at the end
+        for "no material" (index -1)
+        """
+        key = tuple(id(material) for material in materials)
+        if key not in self._energies:
+            from .materials import TABLE as m_tbl
+            names = dict((id(m_tbl[name]), name) for name in m_tbl
+                         if m_tbl.is_built(name))
+            self._energies[key] = np.array(
+                [self.cuts.get(names.get(id(material)), self.default)
+                 for material in materials] + [np.inf])
+        return self._energies[key]
+
+
+class ArrayStack(object):
+    """
+    Preallocated, growable column arrays of the entries collected in a step
+
+    Args:
+    -----
+    capacity : int
+        Number of preallocated entries (default=256)
+    """
+    fields = ()
+
+    def __init__(self, capacity=256):
+        self.size = 0
+        for name, dtype in self.fields:
+            setattr(self, name, np.zeros(capacity, dtype))
+
+    def __len__(self):
+        return self.size
+
+    def push(self, **columns):
+        """
+        Append entries, all fields are given as arrays (or scalars)
+        """
+        n = len(columns[self.fields[0][0]])
+        capacity = len(getattr(self, self.fields[0][0]))
+        if self.size + n > capacity:
+            capacity = max(self.size + n, 2*capacity)
+            for name, dtype in self.fields:
+                new = np.zeros(capacity, dtype)
+                new[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, new)
+        for name, dtype in self.fields:
+            getattr(self, name)[self.size:self.size+n] = columns[name]
+        self.size += n
+
+    def keep(self, mask):
+        """
+        Drop all entries without mask set
+        """
+        n = np.count_nonzero(mask)
+        for name, dtype in self.fields:
+            array = getattr(self, name)
+            array[:n] = array[:self.size][mask]
+        self.size = n
+
+    def clear(self):
+        self.size = 0
+
+
+class SecondaryStack(ArrayStack):
+    """
+    The secondaries produced in a step (and the copies of split particles)
+    """
+    fields = (('energy', float), ('x', float), ('y', float), ('dir', float),
+              ('mass', float), ('charge', float), ('species', np.int8),
+              ('primary', np.int64), ('weight', float), ('importance', float))
+
+    def pop_all(self, store):
+        """
+        Move all secondaries into the ParticleStore store, returns their
+        slot indices
+        """
+        n = self.size
+        self.size = 0
+        return store.add_many(self.species[:n], self.mass[:n],
+                              self.charge[:n], self.energy[:n], self.x[:n],
+                              self.y[:n], self.dir[:n], self.primary[:n],
+                              self.weight[:n], self.importance[:n])
+
+
+class DepositStack(ArrayStack):
+    """
+    Energy deposits of a step that do not carry the weight of the particle
+    in whose slot they happen (the collided part of forced collisions)
+    """
+    fields = (('slot', int), ('x', float), ('y', float), ('edep', float),
+              ('weight', float))
+
+
+class ParticleStore(object):
+    """
+    Structure of arrays holding the state of many particles
+
+    Slots of removed particles are reused by later particles, so the index
+    of a live particle never changes. Particle objects use this to act as
+    views on a single slot.
+
+    Args:
+    -----
+    world : Volume
+        The world volume (default=None)
+    capacity : int
+        Number of preallocated particle slots (default=64)
+    rng : numpy.random.RandomState
+        Source of random numbers (default=numpy.random)
+
+    Attributes:
+    -----------
+    tolerance : float
+        Accuracy limit of large steps, see step_length (default=0.02).
+        None disables large steps.
+    max_step : float
+        Upper limit of the step length (default=None)
+    woodcock : bool
+        Transport neutrons and gammas from interaction to interaction with
+        Woodcock tracking (see flight) instead of substeps (default=True)
+    stats : RunStats
+        Wall time counters, switched off by default
+    cuts : ProductionCuts
+        Thresholds of the tracked secondaries (default=none tracked)
+    secondaries : SecondaryStack
+        Secondaries of the running step
+    rejection : RangeRejection
+        Kill charged particles that cannot reach a scoring volume, see
+        geometry.RangeRejection (default=None)
+    variance : VarianceReduction
+        Splitting, Russian roulette and forced collisions, see variance.py
+        (default=None)
+    deposits : DepositStack
+        Deposits of the last step with a weight of their own
+    weight_buf : array
+        weight_buf[i, j] is the weight of the deposit edep[i, j] of the
+        last step
+    """
+    fields = (('energy', float), ('x', float), ('y', float), ('dir', float),
+              ('mass', float), ('charge', float), ('species', np.int8),
+              ('primary', np.int64), ('weight', float),
+              ('importance', float), ('alive', bool))
+
+    def __init__(self, world=None, capacity=64, rng=None):
+        self.world = world
+        self.rng = rng if rng is not None else np.random
+        self.capacity = 0
+        for name, dtype in self.fields:
+            setattr(self, name, np.zeros(0, dtype))
+        self.n_slots = 0
+        self._free = []
+        self.next_primary = 0
+        self.tolerance = 0.02
+        self.max_step = None
+        self.woodcock = True
+        from .stats import RunStats
+        self.stats = RunStats(enabled=False)
+        self.cuts = ProductionCuts()
+        self.secondaries = SecondaryStack()
+        self.rejection = None
+        self.variance = None
+        self.deposits = DepositStack()
+        self.pos_buf = np.zeros((0, 0, 2))
+        self.edep_buf = np.zeros((0, 0))
+        self.dl_buf = np.zeros((0, 0))
+        self.weight_buf = np.zeros((0, 0))
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        """
+        Enlarge all particle arrays to at least capacity slots
+        """
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2*self.capacity)
+        for name, dtype in self.fields:
+            new = np.zeros(capacity, dtype)
+            new[:self.capacity] = getattr(self, name)
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def _allocate(self, n):
+        """
+        Returns n free slot indices
+        """
+        reused = self._free[len(self._free)-n:] if n else []
+        del self._free[len(self._free)-len(reused):]
+        n_new = n - len(reused)
+        self._grow(self.n_slots + n_new)
+        idx = np.concatenate((np.array(reused, int),
+                              np.arange(self.n_slots, self.n_slots + n_new)))
+        self.n_slots += n_new
+        return idx
+
+    def add(self, species, mass, charge, energy, pos_x, pos_y, direction):
+        """
+        Add a single particle, returns its slot index
+        """
+        return self.add_many(species, mass, charge, [energy], [pos_x],
+                             [pos_y], [direction])[0]
+
+    def add_many(self, species, mass, charge, energy, pos_x, pos_y,
+                 direction, primary=None, weight=1., importance=0.):
+        """
+        Add particles from arrays, returns the slot indices
+
+        species, mass and charge can be scalars shared by all particles.
+        primary is the id of the primary particle each particle belongs to;
+        by default every particle is a new primary with the next free id.
+        weight is the statistical weight, importance that of the volume the
+        particle was last seen in (0: not seen yet), see variance.py.
+        """
+        energy = np.asarray(energy, float)
+        if primary is None:
+            primary = np.arange(self.next_primary,
+                                self.next_primary + len(energy))
+            self.next_primary += len(energy)
+        idx = self._allocate(len(energy))
+        self.energy[idx] = energy
+        self.x[idx] = pos_x
+        self.y[idx] = pos_y
+        self.dir[idx] = direction
+        self.mass[idx] = mass
+        self.charge[idx] = charge
+        self.species[idx] = species
+        self.primary[idx] = primary
+        self.weight[idx] = weight
+        self.importance[idx] = importance
+        self.alive[idx] = True
+        return idx
+
+    def adopt(self, particle):
+        """
+        Move a Particle view into this store
+        """
+        old, i = particle._store, particle._index
+        j = self.add(old.species[i], old.mass[i], old.charge[i],
+                     old.energy[i], old.x[i], old.y[i], old.dir[i])
+        self.weight[j] = old.weight[i]
+        old.remove([i])
+        particle._store, particle._index = self, j
+        return j
+
+    def remove(self, idx):
+        """
+        Free the slots idx
+        """
+        idx = np.asarray(idx, int)
+        self.alive[idx] = False
+        self._free.extend(idx.tolist())
+
+    def live(self):
+        """
+        Returns the slot indices of all live particles
+        """
+        return np.flatnonzero(self.alive[:self.n_slots])
+
+    def __len__(self):
+        return self.n_slots - len(self._free)
+
+    def get_state(self):
+        """
+        Returns the particle arrays and the free slots as dict of arrays,
+        see set_state
+        """
+        state = dict((name, getattr(self, name)[:self.n_slots])
+                     for name, dtype in self.fields)
+        state['free'] = np.array(self._free, int)
+        state['next_primary'] = np.array(self.next_primary)
+        return state
+
+    def set_state(self, state):
+        """
+        Replaces all particles by those of a get_state dict
+        """
+        n_slots = len(state['alive'])
+        self._grow(n_slots)
+        for name, dtype in self.fields:
+            array = getattr(self, name)
+            array[:] = 0
+            array[:n_slots] = state[name]
+        self.n_slots = n_slots
+        self._free = state['free'].tolist()
+        self.next_primary = int(state['next_primary'])
+
+    def step(self, ds):
+        """
+        Propagate all live particles by ds
+
+        Inside homogeneous regions the particles take steps as large as the
+        distance to the next volume boundary allows, limited by tolerance
+        (see step_length). Close to boundaries substeps of SUBSTEP are used.
+        With woodcock set, neutrons and gammas fly from interaction to
+        interaction instead (see flight). The secondaries produced in the
+        step are added at its end, they are first moved by the next step.
+        With rejection set, charged particles which cannot reach a scoring
+        volume deposit their energy in place at the end of the step, in an
+        additional substep of length 0. With variance set the particles are
+        split or rouletted at its end (see _split_and_roulette); the
+        deposits of forced collisions are put on deposits.
+
+        Returns:
+        --------
+        idx, pos, edep, dl : array, array, array, array
+            idx are the slot indices of the propagated particles,
+            pos[i, j] is the position of the energy deposit edep[i, j] and
+            dl[i, j] the length of substep i of particle idx[j].
+            The energy loss of a substep is computed for the material at
+            its start position, which is also its pos. For a Woodcock
+            flight pos is the end point, where the interaction happens.
+            The deposits are energies, they are scored with the weights of
+            weight_buf.
+        """
+        idx = self.live()
+        self.deposits.clear()
+        remaining = np.empty(len(idx))
+        remaining.fill(int(ds/SUBSTEP)*SUBSTEP)
+        n = 0
+        while True:
+            active = (remaining > SUBSTEP*1e-6) & \
+                (self.energy[idx] >= 1*eV)
+            if not active.any():
+                break
+            if self.pos_buf.shape[0] <= n or \
+               self.pos_buf.shape[1] < len(idx):
+                self._grow_buffers(n+1, len(idx))
+            pos_x = self.pos_buf[n, :len(idx), 0]
+            pos_y = self.pos_buf[n, :len(idx), 1]
+            pos_x[:] = self.x[idx]
+            pos_y[:] = self.y[idx]
+            dl = self.dl_buf[n, :len(idx)]
+            dl[:] = 0
+            edep = self.edep_buf[n, :len(idx)]
+            edep[:] = 0
+            self.weight_buf[n, :len(idx)] = self.weight[idx]
+            flying = active & self._is_flying(idx)
+            stepping = active & ~flying
+            if stepping.any():
+                sel = idx[stepping]
+                with self.stats.phase('step_length'):
+                    dl[stepping] = self.step_length(sel, remaining[stepping])
+                with self.stats.phase('energy_loss'):
+                    edep[stepping] = self.substep(sel, dl[stepping])
+            if flying.any():
+                sel = idx[flying]
+                with self.stats.phase('flight'):
+                    dl[flying], edep[flying] = self.flight(sel,
+                                                           remaining[flying])
+                pos_x[flying] = self.x[sel]
+                pos_y[flying] = self.y[sel]
+            remaining -= dl
+            n += 1
+        if self.rejection is not None:
+            n = self._reject(idx, n)
+        if self.variance is not None:
+            self._split_and_roulette(idx)
+        if len(self.secondaries):
+            self.secondaries.pop_all(self)
+        return idx, self.pos_buf[:n, :len(idx)], \
+            self.edep_buf[:n, :len(idx)], self.dl_buf[:n, :len(idx)]
+
+    def _reject(self, idx, n):
+        """
+        Range rejection of the charged particles idx, see rejection.
+        The deposits go to row n of the buffers, returns the number of used
+        rows.
+        """
+        cols = np.flatnonzero((self.species[idx] == CHARGED) &
+                              (self.energy[idx] >= 1*eV))
+        if not len(cols):
+            return n
+        sel = idx[cols]
+        with self.stats.phase('geometry'):
+            distance = self.rejection.distance(self.x[sel], self.y[sel])
+        residual = np.empty(len(sel))
+        residual.fill(np.inf)
+        for table, mask in self._group_by_table(sel):
+            residual[mask] = table.range(self.energy[sel[mask]])
+        kill = residual < distance
+        if not kill.any():
+            return n
+        if self.pos_buf.shape[0] <= n or self.pos_buf.shape[1] < len(idx):
+            self._grow_buffers(n+1, len(idx))
+        self.pos_buf[n, :len(idx), 0] = self.x[idx]
+        self.pos_buf[n, :len(idx), 1] = self.y[idx]
+        self.dl_buf[n, :len(idx)] = 0
+        self.weight_buf[n, :len(idx)] = self.weight[idx]
+        edep = self.edep_buf[n, :len(idx)]
+        edep[:] = 0
+        edep[cols[kill]] = self.energy[sel[kill]]
+        self.energy[sel[kill]] = 0
+        return n + 1
+
+    def _grow_buffers(self, rows, columns):
+        """
+        Enlarge the position, deposit, step length and weight buffers
+        """
+        old_rows, old_columns = self.pos_buf.shape[:2]
+        #only the dimension that is too small grows (by doubling)
+        rows = max(rows, 2*old_rows) if rows > old_rows else old_rows
+        columns = max(columns, 2*old_columns) if columns > old_columns \
+            else old_columns
+        pos_buf = np.zeros((rows, columns, 2))
+        edep_buf = np.zeros((rows, columns))
+        dl_buf = np.zeros((rows, columns))
+        weight_buf = np.zeros((rows, columns))
+        n = self.pos_buf.shape[1]
+        pos_buf[:old_rows, :n] = self.pos_buf
+        edep_buf[:old_rows, :n] = self.edep_buf
+        dl_buf[:old_rows, :n] = self.dl_buf
+        weight_buf[:old_rows, :n] = self.weight_buf
+        self.pos_buf, self.edep_buf, self.dl_buf = pos_buf, edep_buf, dl_buf
+        self.weight_buf = weight_buf
+
+    def step_length(self, idx, remaining):
+        """
+        Returns the length of the next substep of the particles idx
+
+        The step is the distance to the closest volume boundary (safety),
+        but at least SUBSTEP and at most remaining. If tolerance is set,
+        a charged particle looses at most this fraction of its residual
+        range and a neutral particle travels at most this fraction of its
+        mean free path in a single step. With tolerance=None all steps are
+        SUBSTEP long.
+        """
+        if self.tolerance is None:
+            return np.minimum(SUBSTEP, remaining)
+        with self.stats.phase('geometry'):
+            safety = self.get_geometry().get_safety(self.x[idx], self.y[idx])
+        length = np.maximum(safety, SUBSTEP)
+        if self.max_step:
+            length = np.minimum(length, self.max_step)
+        species = self.species[idx]
+        charged = np.flatnonzero(species == CHARGED)
+        for table, mask in self._group_by_table(idx[charged]):
+            sel = charged[mask]
+            length[sel] = np.minimum(length[sel], self.tolerance*
+                                     table.range(self.energy[idx[sel]]))
+        for code, kind in ((NEUTRON, 'neutron'), (GAMMA, 'gamma')):
+            neutral = np.flatnonzero(species == code)
+            if not len(neutral):
+                continue
+            for material, mask in self._group_by_material(idx[neutral]):
+                sel = neutral[mask]
+                table = cross_section_table(material, kind)
+                length[sel] = np.minimum(length[sel], self.tolerance*
+                                         table.mfp(self.energy[idx[sel]]))
+        return np.clip(length, SUBSTEP, remaining)
+
+    def substep(self, idx, ds):
+        """
+        Advance the particles idx by a single substep ds (scalar or one
+        length per particle)
+
+        Particles with less than 1 eV are not moved. Neutral particles in
+        a forced volume of variance collide in every substep (see
+        _forced_collisions) and loose no energy themselves.
+        Returns the energy deposit of each particle, i.e. its energy loss
+        without the energy of the secondaries put on the stack.
+        """
+        ds = np.broadcast_to(ds, idx.shape)
+        edep = np.zeros(len(idx))
+        moving = self.energy[idx] >= 1*eV
+        sel = idx[moving]
+        ds = ds[moving]
+        dE = np.zeros(len(sel))
+        carried = np.zeros(len(sel))
+        species = self.species[sel]
+        forced = np.zeros(len(sel), bool)
+        if self.variance is not None and self.variance.forcing:
+            neutral = np.flatnonzero((species == NEUTRON) |
+                                     (species == GAMMA))
+            with self.stats.phase('geometry'):
+                forced[neutral] = self.variance.is_forced(
+                    self.x[sel[neutral]], self.y[sel[neutral]])
+            if forced.any():
+                self._forced_collisions(sel[forced], ds[forced])
+        for code, energy_loss in ((CHARGED, self._charged_loss),
+                                  (NEUTRON, self._neutron_loss),
+                                  (GAMMA, self._gamma_loss)):
+            mask = (species == code) & ~forced
+            if mask.any():
+                dE[mask], carried[mask] = energy_loss(sel[mask], ds[mask])
+        dE = np.minimum(dE, self.energy[sel])
+        self.energy[sel] -= dE
+        self.x[sel] += np.cos(self.dir[sel])*ds
+        self.y[sel] += np.sin(self.dir[sel])*ds
+        edep[moving] = np.maximum(dE - carried, 0)
+        return edep
+
+    def _is_flying(self, idx):
+        """
+        Returns True for the particles idx transported by flight
+
+        Close to and inside of forced volumes neutral particles take
+        substeps, so that they cannot fly over a forced volume.
+        """
+        if not self.woodcock:
+            return np.zeros(len(idx), bool)
+        species = self.species[idx]
+        flying = (species == NEUTRON) | (species == GAMMA)
+        if self.variance is not None and self.variance.forcing and \
+           flying.any():
+            with self.stats.phase('geometry'):
+                flying[flying] = self.variance.forced_distance(
+                    self.x[idx[flying]], self.y[idx[flying]]) > 0
+        return flying
+
+    def flight(self, idx, remaining):
+        """
+        Woodcock (delta) tracking of the neutral particles idx
+
+        Each particle flies a distance sampled from the majorant cross
+        section of all materials of the world, at most remaining. After a
+        full flight a real interaction takes place at the new position with
+        probability sigma/majorant, otherwise the collision is virtual and
+        the particle flies on in the next call.
+
+        The energy transfer of a real interaction is given to a secondary
+        (see _interaction_secondaries) or deposited locally. With forced
+        volumes (see variance) the flight ends at the distance to the
+        closest one, without a collision.
+
+        Returns:
+        --------
+        dl, edep : array, array
+            The flight length and energy deposit of each particle
+        """
+        rand = self.rng.rand
+        materials = self.get_geometry().materials
+        dl = np.zeros(len(idx))
+        edep = np.zeros(len(idx))
+        carried = np.zeros(len(idx))
+        species = self.species[idx]
+        if self.variance is not None and self.variance.forcing:
+            with self.stats.phase('geometry'):
+                distance = self.variance.forced_distance(self.x[idx],
+                                                         self.y[idx])
+            remaining = np.minimum(remaining, np.maximum(distance, SUBSTEP))
+        for code, kind, deposit in ((NEUTRON, 'neutron', neutron_deposit),
+                                    (GAMMA, 'gamma', gamma_deposit)):
+            mask = species == code
+            if not mask.any():
+                continue
+            sel = idx[mask]
+            majorant = majorant_table(materials, kind).total_sigma(
+                self.energy[sel])
+            with np.errstate(divide='ignore'):
+                free = -np.log(1 - rand(len(sel)))/majorant
+            length = np.minimum(free, remaining[mask])
+            self.x[sel] += np.cos(self.dir[sel])*length
+            self.y[sel] += np.sin(self.dir[sel])*length
+            collided = np.flatnonzero(free <= remaining[mask])
+            sigma = np.zeros(len(collided))
+            for material, m in self._group_by_material(sel[collided]):
+                hit = sel[collided[m]]
+                sigma[m] = cross_section_table(material, kind).total_sigma(
+                    self.energy[hit])
+            real = collided[rand(len(collided))*majorant[collided] < sigma]
+            loss = np.zeros(len(sel))
+            loss[real] = deposit(self.energy[sel[real]], rand)
+            away = np.zeros(len(sel))
+            away[real] = self._interaction_secondaries(sel[real], loss[real])
+            self._scatter(sel, loss)
+            dl[mask] = length
+            edep[mask] = loss
+            carried[mask] = away
+        edep = np.minimum(edep, self.energy[idx])
+        self.energy[idx] -= edep
+        return dl, np.maximum(edep - carried, 0)
+
+    def get_velocity(self, idx):
+        """
+        Returns the velocities of the particles idx
+        """
+        energy = self.energy[idx]
+        mass = self.mass[idx]
+        return np.sqrt(1-(energy/(mass*c_light**2)+1)**-2)*c_light
+
+    def get_geometry(self):
+        """
+        Returns the CompiledGeometry of the world
+        """
+        return self.world.compile()
+
+    def lookup(self, idx):
+        """
+        Returns the volume and material indices at the positions of the
+        particles idx
+        """
+        with self.stats.phase('geometry'):
+            return self.get_geometry().lookup(self.x[idx], self.y[idx])
+
+    def _group_by_material(self, idx):
+        """
+        Yields (material, mask) for all materials at the positions of idx
+        """
+        materials = self.get_geometry().materials
+        mat = self.lookup(idx)[1]
+        for m in np.unique(mat[mat >= 0]):
+            yield materials[m], mat == m
+
+    def _group_by_table(self, idx):
+        """
+        Yields (StoppingTable, mask) for all combinations of particle type
+        and material of the charged particles idx
+        """
+        materials = self.get_geometry().materials
+        mat = self.lookup(idx)[1]
+        masses, i_mass = np.unique(self.mass[idx], return_inverse=True)
+        charges, i_charge = np.unique(self.charge[idx], return_inverse=True)
+        key = (i_mass*len(charges) + i_charge)*(len(materials)+1) + mat + 1
+        for k in np.unique(key[mat >= 0]):
+            mask = key == k
+            i = np.flatnonzero(mask)[0]
+            yield stopping_table(masses[i_mass[i]], charges[i_charge[i]],
+                                 materials[mat[i]]), mask
+
+    def _charged_loss(self, idx, ds):
+        """
+        Continuous energy loss from the range tables (Bethe Bloch)
+
+        With a finite cut delta rays above it are produced, see
+        _delta_rays. Returns the energy loss and the energy given to
+        secondaries.
+        """
+        dE = np.zeros(len(idx))
+        carried = np.zeros(len(idx))
+        cuts = None
+        if self.cuts.enabled:
+            cuts = self.cuts.energies(self.get_geometry().materials)
+        for table, mask in self._group_by_table(idx):
+            energy = self.energy[idx[mask]]
+            dE[mask] = energy - table.energy_after(energy, ds[mask])
+            if cuts is not None:
+                materials = self.get_geometry().materials
+                cut = cuts[materials.index(table.material)]
+                if cut < np.inf:
+                    dE[mask], carried[mask] = self._delta_rays(
+                        idx[mask], ds[mask], dE[mask], table, cut)
+        return dE, carried
+
+    def _delta_rays(self, idx, ds, dE, table, cut):
+        """
+        Delta rays above cut of the charged particles idx in the material
+        of table over the substeps ds with the (unrestricted) loss dE
+
+        The number of delta rays is Poisson distributed with the 1/T**2
+        spectrum of free electrons, their mean energy is taken off the
+        continuous loss, so the mean total loss stays that of the table.
+
+        Returns the energy loss and the energy given to delta rays.
+        """
+        rand = self.rng.rand
+        energy = self.energy[idx]
+        mass = self.mass[idx]
+        mc2 = m_e*c_light**2
+        gamma = energy/(mass*c_light**2) + 1
+        beta2 = 1 - gamma**-2
+        ratio = m_e/mass
+        t_max = 2*mc2*beta2*gamma**2/(1 + 2*gamma*ratio + ratio**2)
+        #the faster of two electrons is the primary
+        t_max = np.where(mass == m_e, energy/2, t_max)
+        above = t_max > cut
+        if not above.any():
+            return dE, np.zeros(len(idx))
+        z = self.charge[idx]/q_e
+        edens = table.material.get_e_density()
+        k = 2*pi*edens*z**2*(q_e**2/(4*pi*epsilon_0))**2/(mc2*beta2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_energy = np.where(above, k*ds*np.log(t_max/cut), 0)
+            mean_number = np.where(above, k*ds*(1/cut - 1/t_max), 0)
+        number = self.rng.poisson(mean_number)
+        parent = np.repeat(np.arange(len(idx)), number)
+        u = rand(len(parent))
+        t = cut*t_max[parent]/(t_max[parent] - u*(t_max[parent] - cut))
+        carried = np.bincount(parent, t, minlength=len(idx))
+        continuous = np.maximum(dE - mean_energy, 0)
+        #too much energy for the rest of the track: deposit everything
+        ok = continuous + carried <= energy
+        emitted = ok[parent]
+        cos_theta = np.sqrt(np.clip(t/t_max[parent]*(t_max[parent] + 2*mc2)/
+                                    (t + 2*mc2), 0, 1))
+        self._push(idx[parent[emitted]], t[emitted], ELECTRON,
+                   cos_theta[emitted])
+        return np.where(ok, continuous + carried, dE), \
+            np.where(ok, carried, 0)
+
+    def _interaction_secondaries(self, idx, transfer, weight=None):
+        """
+        Put the secondary of an interaction of the neutral particles idx
+        with the energy transfer transfer on the stack if it is above the
+        cut of the material; returns the energy carried away. The
+        secondaries have the weights weight (default: those of idx).
+
+        Neutrons produce recoil protons (elastic scattering on hydrogen,
+        cos(theta)**2 = T/E), gammas Compton electrons (photo electrons
+        for a full transfer).
+        """
+        if not self.cuts.enabled or not len(idx):
+            return np.zeros(len(idx))
+        cuts = self.cuts.energies(self.get_geometry().materials)
+        keep = transfer > cuts[self.lookup(idx)[1]]
+        carried = np.where(keep, transfer, 0)
+        if not keep.any():
+            return carried
+        sel, transfer = idx[keep], transfer[keep]
+        weight = self.weight[sel] if weight is None else weight[keep]
+        energy = self.energy[sel]
+        neutron = self.species[sel] == NEUTRON
+        mc2 = m_e*c_light**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos_theta = np.where(neutron, np.sqrt(transfer/energy),
+                                 (1 + mc2/energy)*np.sqrt(
+                                     transfer/(transfer + 2*mc2)))
+        cos_theta = np.clip(np.nan_to_num(cos_theta), 0, 1)
+        for secondary, mask in ((RECOIL_PROTON, neutron),
+                                (ELECTRON, ~neutron)):
+            if mask.any():
+                self._push(sel[mask], transfer[mask], secondary,
+                           cos_theta[mask], weight[mask])
+        return carried
+
+    def _push(self, parent, energy, secondary, cos_theta, weight=None):
+        """
+        Put secondaries of the particles parent on the stack, at an angle
+        arccos(cos_theta) to the left or right of the parent direction.
+        They have the weights weight (default: those of parent).
+        """
+        species, mass, charge = secondary
+        side = np.where(self.rng.rand(len(parent)) < .5, -1, 1)
+        self.secondaries.push(energy=energy, x=self.x[parent],
+                              y=self.y[parent],
+                              dir=self.dir[parent] +
+                              side*np.arccos(cos_theta),
+                              mass=mass, charge=charge, species=species,
+                              primary=self.primary[parent],
+                              weight=self.weight[parent] if weight is None
+                              else weight,
+                              importance=self.importance[parent])
+
+    def _split_and_roulette(self, idx):
+        """
+        Geometry splitting and Russian roulette of the particles idx at the
+        end of a step, and the weight cutoff of them and of the new
+        secondaries, see variance.py
+
+        Killed particles get the energy 0 without a deposit, the copies of
+        split particles are put on the secondary stack.
+        """
+        variance = self.variance
+        rand = self.rng.rand
+        sel = idx[self.energy[idx] >= 1*eV]
+        with self.stats.phase('geometry'):
+            importance = variance.get_importance(self.x[sel], self.y[sel])
+        last = self.importance[sel]
+        ratio = importance/np.where(last > 0, last, importance)
+        self.importance[sel] = importance
+        low = np.flatnonzero(ratio < 1)
+        if len(low):
+            alive = rand(len(low)) < ratio[low]
+            self.weight[sel[low[alive]]] /= ratio[low[alive]]
+            self.energy[sel[low[~alive]]] = 0
+        high = np.flatnonzero(ratio > 1)
+        if len(high):
+            r = ratio[high]
+            n_copies = np.floor(r).astype(int)
+            n_copies += rand(len(r)) < r - n_copies
+            self.weight[sel[high]] /= r
+            parent = np.repeat(sel[high], n_copies - 1)
+            self.secondaries.push(energy=self.energy[parent],
+                                  x=self.x[parent], y=self.y[parent],
+                                  dir=self.dir[parent],
+                                  mass=self.mass[parent],
+                                  charge=self.charge[parent],
+                                  species=self.species[parent],
+                                  primary=self.primary[parent],
+                                  weight=self.weight[parent],
+                                  importance=self.importance[parent])
+        sel = sel[self.energy[sel] >= 1*eV]
+        weight = variance.roulette(self.weight[sel], rand)
+        self.weight[sel] = weight
+        self.energy[sel[weight == 0]] = 0
+        stack = self.secondaries
+        if len(stack):
+            weight = variance.roulette(stack.weight[:len(stack)], rand)
+            stack.weight[:len(stack)] = weight
+            stack.keep(weight > 0)
+
+    def _forced_collisions(self, idx, ds):
+        """
+        Forced collisions of the neutral particles idx over the substeps ds
+
+        With the interaction probability p of the substep, the collided
+        part continues with the weight w*p as a new particle (after the
+        energy transfer of a collision, which is deposited or given to a
+        secondary), the particle itself flies on uncollided with the weight
+        w*(1-p).
+        """
+        rand = self.rng.rand
+        species = self.species[idx]
+        for code, kind, deposit in ((NEUTRON, 'neutron', neutron_deposit),
+                                    (GAMMA, 'gamma', gamma_deposit)):
+            mask = species == code
+            if not mask.any():
+                continue
+            sel = idx[mask]
+            sigma = np.zeros(len(sel))
+            for material, m in self._group_by_material(sel):
+                sigma[m] = cross_section_table(material, kind).total_sigma(
+                    self.energy[sel[m]])
+            p = -np.expm1(-sigma*ds[mask])
+            sel, p = sel[p > 0], p[p > 0]
+            energy = self.energy[sel]
+            weight = self.weight[sel]*p
+            transfer = np.minimum(deposit(energy, rand), energy)
+            carried = self._interaction_secondaries(sel, transfer, weight)
+            self.deposits.push(slot=sel, x=self.x[sel], y=self.y[sel],
+                               edep=np.maximum(transfer - carried, 0),
+                               weight=weight)
+            rest = energy - transfer
+            direction = self.dir[sel] + np.where(
+                transfer > 10*keV, (rand(len(sel))-.5)*80*deg, 0)
+            go = rest >= 1*eV
+            parent = sel[go]
+            self.secondaries.push(energy=rest[go], x=self.x[parent],
+                                  y=self.y[parent], dir=direction[go],
+                                  mass=self.mass[parent],
+                                  charge=self.charge[parent],
+                                  species=self.species[parent],
+                                  primary=self.primary[parent],
+                                  weight=weight[go],
+                                  importance=self.importance[parent])
+            self.weight[sel] *= 1 - p
+
+    def _scatter(self, idx, dE):
+        """
+        Random change of direction for particles with dE above 10 keV
+        """
+        hit = dE > 10*keV
+        self.dir[idx[hit]] += (self.rng.rand(hit.sum())-.5)*80*deg
+
+    def _neutron_loss(self, idx, ds):
+        """
+        straggeling
+        """
+        rand = self.rng.rand
+        dE = np.zeros(len(idx))
+        for material, mask in self._group_by_material(idx):
+            sel = idx[mask]
+            energy = self.energy[sel]
+            loss = np.zeros(len(sel))
+            sigma = cross_section_table(material, 'neutron'
+                                        ).channel_sigma(energy)
+            for channel in sigma:
+                hit = ds[mask]*channel > rand(len(sel))
+                loss += np.where(hit, neutron_deposit(energy, rand), 0)
+                self._scatter(sel, loss)
+            dE[mask] = loss
+        hit = np.flatnonzero(dE > 0)
+        carried = np.zeros(len(idx))
+        carried[hit] = self._interaction_secondaries(
+            idx[hit], np.minimum(dE[hit], self.energy[idx[hit]]))
+        return dE, carried
+
+    def _gamma_loss(self, idx, ds):
+        """
+        scattering and photo ion
+        Simple 'model' which takes the overall mfp and sets every edep below
+        0.1MeV as photo ionization.
+        """
+        rand = self.rng.rand
+        dE = np.zeros(len(idx))
+        for material, mask in self._group_by_material(idx):
+            sel = idx[mask]
+            energy = self.energy[sel]
+            loss = np.zeros(len(sel))
+            sigma = cross_section_table(material, 'gamma'
+                                        ).channel_sigma(energy)
+            for channel in sigma:
+                hit = ds[mask]*channel > rand(len(sel))
+                loss += np.where(hit, gamma_deposit(energy, rand), 0)
+                self._scatter(sel, loss)
+            dE[mask] = loss
+        hit = np.flatnonzero(dE > 0)
+        carried = np.zeros(len(idx))
+        carried[hit] = self._interaction_secondaries(
+            idx[hit], np.minimum(dE[hit], self.energy[idx[hit]]))
+        return dE, carried
+
+
+def neutron_deposit(energy, rand=np.random.rand):
+    """
+    Energy deposit of neutron interactions with the given energies
+    """
+    return np.minimum(20*MeV, energy*rand(len(energy)))
+
+
+def gamma_deposit(energy, rand=np.random.rand):
+    """
+    Energy deposit of gamma interactions with the given energies
+    """
+    u = rand(len(energy))
+    return np.where(energy < 0.1*MeV, energy,
+                    np.where(energy < 3.*MeV, energy*(.5+u/2),
+                             np.minimum(20*MeV, energy*u/2)))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the variance reduction settings of a ParticleStore.
+
+Every particle carries a statistical weight (1 for a primary) and every
+tally scores energy times weight. The weight games of ParticleStore.step
+change the number of particles without changing the expected tallies:
+
+- Geometry splitting and Russian roulette: every volume has an importance.
+  A particle that ends a step in a volume with an importance r times that
+  of its last volume is split into r copies (r > 1) or survives with
+  probability r (r < 1); the weights are divided by r.
+- Forced collisions: neutrons and gammas in a forced volume collide in
+  every substep. The collided part continues as a new particle with the
+  weight w*p (p the interaction probability of the substep), the parent
+  flies on uncollided with the weight w*(1-p).
+- Weight cutoff: particles below weight_cutoff (mostly the collided parts
+  of forced collisions) play Russian roulette for the survival weight
+  2*weight_cutoff.
+
+The settings of the geometries are in settings.VARIANCE_REDUCTION.
+
+Usage example:
+--------------
+> run_manager.set_variance_reduction({'importance': {'A (Si)': 4},
+>                                     'forced': ['A (Si)']})
+> run_manager.run()
+"""
+import numpy as np
+
+
+class VarianceReduction(object):
+    """
+    Importances and forced volumes of the weight games of a ParticleStore
+
+    Args:
+    -----
+    geometry : CompiledGeometry
+        The compiled world
+    importance : array
+        Importance of every volume in the order of geometry.volumes
+        (default=1 everywhere). Outside of all volumes it is 1.
+    forced : array
+        True for the volumes with forced collisions (default=none)
+    weight_cutoff : float
+        Weight below which particles play Russian roulette (default=0.01)
+
+    Attributes:
+    -----------
+    forced_map : array
+        Distance of every pixel to the closest forced pixel, see
+        CompiledGeometry.distance_map
+    """
+    def __init__(self, geometry, importance=None, forced=None,
+                 weight_cutoff=.01):
+        n = len(geometry.volumes)
+        self.geometry = geometry
+        importance = np.ones(n) if importance is None else \
+            np.asarray(importance, float)
+        if np.any(importance <= 0):
+            raise ValueError("importances have to be positive")
+        #the last entry belongs to "no volume" (index -1)
+        self.importance = np.append(importance, 1.)
+        forced = np.zeros(n, bool) if forced is None else \
+            np.asarray(forced, bool)
+        self.forced = np.append(forced, False)
+        self.weight_cutoff = weight_cutoff
+        labels = geometry.labels
+        targets = np.zeros(labels.shape, bool)
+        targets[labels >= 0] = self.forced[labels[labels >= 0]]
+        self.forced_map = geometry.distance_map(targets)
+
+    @property
+    def forcing(self):
+        """
+        True if there is any forced volume
+        """
+        return bool(self.forced.any())
+
+    def get_importance(self, pos_x, pos_y):
+        """
+        Returns the importance at the positions
+        """
+        return self.importance[self.geometry.lookup(pos_x, pos_y)[0]]
+
+    def is_forced(self, pos_x, pos_y):
+        """
+        Returns True for the positions inside of a forced volume
+        """
+        return self.forced[self.geometry.lookup(pos_x, pos_y)[0]]
+
+    def forced_distance(self, pos_x, pos_y):
+        """
+        Returns the distance from the positions to the closest forced
+        volume (0 close to it and outside of the raster)
+        """
+        return self.geometry.sample(self.forced_map, pos_x, pos_y)
+
+    def roulette(self, weight, rand):
+        """
+        Russian roulette of the weights below weight_cutoff with the
+        survival weight 2*weight_cutoff, returns the new weights (0 for
+        killed particles)
+        """
+        weight = np.array(weight, float)
+        low = np.flatnonzero(weight < self.weight_cutoff)
+        if len(low):
+            survival = 2*self.weight_cutoff
+            alive = rand(len(low))*survival < weight[low]
+            weight[low] = np.where(alive, survival, 0)
+        return weight
+
+
+def variance_reduction(geometry, names, settings):
+    """
+    Returns the VarianceReduction of a settings dict (see
+    settings.VARIANCE_REDUCTION) for the compiled geometry with the volume
+    names
+
+    The dict has the keys 'importance' (dict of the importance by volume
+    name, 1 for all others), 'forced' (list of volume names) and
+    'weight_cutoff', all of them optional.
+    """
+    importance = dict(settings.get('importance') or {})
+    forced = list(settings.get('forced') or [])
+    unknown = (set(importance) | set(forced)) - set(names)
+    if unknown:
+        raise ValueError("unknown volumes %s" % ', '.join(sorted(unknown)))
+    return VarianceReduction(
+        geometry, [importance.get(name, 1.) for name in names],
+        [name in forced for name in names],
+        settings.get('weight_cutoff', .01))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the background simulation thread.
+
+The SimulationThread calls RunManager.step in its own thread and publishes
+a snapshot of the run after every step. A gui picks up the latest snapshot
+at its own refresh rate; snapshots published in between are dropped.
+
+Usage example:
+--------------
+> worker = SimulationThread(run_manager)
+> worker.start()
+> worker.add_particle(particle)
+> snapshot = worker.latest()
+"""
+import threading
+import time
+
+
+class SimulationThread(threading.Thread):
+    """
+    Runs the steps of a RunManager in a background thread
+
+    All access to the run_manager from other threads has to go through
+    add_particle, clear and latest (or hold self.lock).
+
+    Args:
+    -----
+    run_manager : RunManager
+        The run to propagate. Its draw_on_step is switched off, drawing is
+        left to the consumer of the snapshots.
+    realtime : bool
+        If True, make at most one step per interval (animation), else step
+        as fast as possible (default=True)
+    interval : float
+        Minimum time between two steps in seconds in realtime mode
+        (default=0.02)
+    """
+    def __init__(self, run_manager, realtime=True, interval=.02):
+        super(SimulationThread, self).__init__()
+        self.daemon = True
+        self.run_manager = run_manager
+        run_manager.draw_on_step = False
+        self.realtime = realtime
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._work = threading.Event()
+        self._stopped = False
+        self._seq = 0
+        self._snapshot = None
+        self._taken = 0
+
+    def add_particle(self, particle):
+        """
+        Add a particle to the run and resume stepping
+        """
+        with self.lock:
+            self.run_manager.add_particle(particle)
+            self._publish()
+        self._work.set()
+
+    def clear(self):
+        """
+        Remove all particles and reset the tallies
+        """
+        with self.lock:
+            self.run_manager.clear()
+            self._publish()
+
+    def stop(self):
+        """
+        End the thread
+        """
+        self._stopped = True
+        self._work.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self._stopped:
+            self._work.wait()
+            start = time.time()
+            with self.lock:
+                if len(self.run_manager.store):
+                    self.run_manager.step()
+                else:
+                    self._work.clear()
+                self._publish()
+            if self.realtime:
+                time.sleep(max(0, self.interval - (time.time() - start)))
+            else:
+                time.sleep(0) #let the gui thread run
+
+    def _publish(self):
+        """
+        Store a snapshot of the current state, called with the lock held
+        """
+        store = self.run_manager.store
+        idx = store.live()
+        self._seq += 1
+        self._snapshot = {'seq': self._seq,
+                          'pos_x': store.x[idx],
+                          'pos_y': store.y[idx],
+                          'edeps': self.run_manager.edeps.copy(),
+                          'let': self.run_manager.let_tally.values.copy(),
+                          'errors': self.run_manager.history_tally.error()}
+
+    def latest(self):
+        """
+        Returns the newest snapshot, or None if nothing changed since the
+        last call.
+
+        A snapshot is a dict with 'seq', the particle positions 'pos_x' and
+        'pos_y', the energy per volume 'edeps', the LETTally values 'let',
+        the statistical errors of the energies 'errors' and a copy of the
+        MeshTally 'tally' (or None).
+        """
+        with self.lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot['seq'] == self._taken:
+                return None
+            self._taken = snapshot['seq']
+            tally = self.run_manager.mesh_tally
+            if tally is not None:
+                from .tally import MeshTally
+                copy = MeshTally(tally.bbox, tally.shape)
+                copy.values[:] = tally.values
+                tally = copy
+            snapshot['tally'] = tally
+        return snapshot
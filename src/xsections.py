@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains the cross section store.
+
+The text tables in X-sections/ are parsed once and kept as binary .npy
+files in X-sections/.cache/. Later loads memory map the cache file. The
+cache file name contains a hash of the source file content and of the
+parse options, so a changed source file is parsed again automatically.
+
+Usage example:
+--------------
+> energy, sigma = load_neutron("X-sections/n_X_section_H.txt")
+> energy, attenuation = load_table("X-sections/g_X_section_Si.txt",
+>                                  usecols=[0, 2]).T
+"""
+import os
+import numpy as np
+from .files import replace
+
+CACHE_DIR = '.cache'
+
+
+def _cache_file(fn, options):
+    """
+    Returns the name of the cache file for fn parsed with options
+    """
+    from hashlib import sha1
+    with open(fn, 'rb') as source:
+        key = sha1(source.read() + repr(options)).hexdigest()[:16]
+    directory, name = os.path.split(fn)
+    return os.path.join(directory, CACHE_DIR, '%s.%s.npy' % (name, key))
+
+
+def load_table(fn, usecols=None, skiprows=0):
+    """
+    Returns the numeric table in the text file fn as 2D array
+
+    The arguments are those of numpy.loadtxt. If the cache cannot be
+    written, the table is parsed on every call.
+    """
+    cache = _cache_file(fn, (usecols, skiprows))
+    if os.path.exists(cache):
+        return np.load(cache, mmap_mode='r')
+    table = np.loadtxt(fn, usecols=usecols, skiprows=skiprows, ndmin=2)
+    tmp = '%s.%d.tmp' % (cache, os.getpid())
+    try:
+        directory = os.path.dirname(cache)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'wb') as f:
+            np.save(f, table)
+        replace(tmp, cache)
+    except (IOError, OSError):
+        pass
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return table
+
+
+def load_neutron(fn, skiprows=0):
+    """
+    Returns energy and sigma of an ENDF neutron table with three
+    (energy, sigma) pairs per line, as in X-sections/n_X_section_*.txt
+    """
+    table = load_table(fn, usecols=[0, 1, 2, 3, 4, 5], skiprows=skiprows)
+    return table[:, ::2].ravel(), table[:, 1::2].ravel()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from settings import HUMAN as geometry
+from settings import GEOMETRIES
+geometry = GEOMETRIES['HUMAN']
 from src import RunManager, start_gui
 run_manager = RunManager(geometry)
 start_gui(run_manager)